@@ -6,6 +6,9 @@ import numpy as np
 import torch
 import warnings
 
+from sid_trie import SIDTrie
+from title_trie import TitleTrie
+
 from transformers.utils import add_start_docstrings
 
 LOGITS_PROCESSOR_INPUTS_DOCSTRING = r"""
@@ -25,17 +28,33 @@ class ConstrainedLogitsProcessor(LogitsProcessor):
 
     def __init__(
         self,
-        prefix_allowed_tokens_fn: Callable[[int, torch.Tensor], List[int]],
-        num_beams: int,
+        prefix_allowed_tokens_fn: Callable[[int, torch.Tensor], List[int]] = None,
+        num_beams: int = 1,
         base_model: str = None,
-        eos_token_id: int = None
+        eos_token_id: int = None,
+        trie: Optional[Union[SIDTrie, TitleTrie]] = None,
+        use_cursor: bool = False,
+        blocked: Optional[torch.Tensor] = None,
     ):
         self._prefix_allowed_tokens_fn = prefix_allowed_tokens_fn
         self._num_beams = num_beams
         self.count=0
         self.base_model = base_model
         self.eos_token_id = eos_token_id
-        if self.base_model.lower().find("gpt2") > -1:
+        # Used as given (on the device of the scores), so availability updates on it reach the next step
+        self.trie = trie
+        # Cursor mode keeps one trie node per row and advances it with the last chosen token
+        # instead of replaying the generated tail, which also drops the dependence on
+        # `count`/`prefix_index` matching the tokenizer.
+        self.use_cursor = use_cursor and trie is not None
+        self._cursor = None
+        self._generated = None
+        self._prompt_len = None
+        # Per-prompt `(batch, num_nodes)` mask of excluded trie nodes, see `SIDTrie.blocked_nodes`
+        self.blocked = blocked
+        # The same mask merged with the trie's unavailable items, fixed for one generate call
+        self._blocked = None
+        if self.base_model is not None and self.base_model.lower().find("gpt2") > -1:
             self.prefix_index = 4
         else:
             self.prefix_index = 3
@@ -43,9 +62,13 @@ class ConstrainedLogitsProcessor(LogitsProcessor):
     
     @add_start_docstrings(LOGITS_PROCESSOR_INPUTS_DOCSTRING)
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.use_cursor:
+            return self._call_cursor(input_ids, scores)
+        if self.trie is not None:
+            return self._call_trie(input_ids, scores)
+
         scores = torch.nn.functional.log_softmax(scores, dim=-1)
         mask = torch.full_like(scores, float('-inf'))
-            
         for batch_id, beam_sent in enumerate(input_ids.view(-1, self._num_beams, input_ids.shape[-1])):
             for beam_id, sent in enumerate(beam_sent):
                 if self.count == 0:
@@ -70,4 +93,73 @@ class ConstrainedLogitsProcessor(LogitsProcessor):
         self.count += 1
 
         scores = scores + mask
-        return scores
\ No newline at end of file
+        return scores
+
+    def _call_trie(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        # Walk all rows through the compiled trie at once: the prompt tail selects the root (see
+        # `match_prefix`), then the `count` generated tokens are replayed from it.
+        trie = self.trie
+        if self.count == 0:
+            self._blocked = trie.decoding_mask(self.blocked)
+            nodes = trie.match_prefix(input_ids)
+        else:
+            nodes = trie.walk(trie.match_prefix(input_ids[:, :-self.count]), input_ids[:, -self.count:])
+
+        invalid = nodes < 0
+        if invalid.any():
+            warnings.warn(
+                f"No valid tokens found for {int(invalid.sum())} sequences at step {self.count}. "
+                f"This indicates the model generated an unexpected token. "
+            )
+
+        self.count += 1
+
+        scores = torch.nn.functional.log_softmax(scores, dim=-1)
+        return scores + trie.allowed_mask(nodes, scores, blocked=self._blocked, group_size=self._num_beams)
+
+    def reset(self):
+        self.count = 0
+        self._cursor = None
+        self._generated = None
+        self._prompt_len = None
+        self._blocked = None
+
+    def _recover_beam_idx(self, generated: torch.LongTensor) -> torch.LongTensor:
+        # `generate` does not expose beam_idx to logits processors. Rows of the same batch share the
+        # prompt, so the parent of a row is any previous row of its batch whose generated tokens equal
+        # this row's tokens without the last one; identical tails sit on the same trie node.
+        rows = generated.size(0)
+        num_batches = rows // self._num_beams
+        cur = generated[:, :-1].view(num_batches, self._num_beams, 1, -1)
+        prev = self._generated.view(num_batches, 1, self._num_beams, -1)
+        local = (cur == prev).all(dim=-1).int().argmax(dim=-1)
+        offset = torch.arange(num_batches, device=generated.device).unsqueeze(1) * self._num_beams
+        return (local + offset).view(-1)
+
+    def _call_cursor(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        trie = self.trie
+        if self._cursor is None:
+            # Rows whose prompt does not end with the response header start invalid, as in `_call_trie`
+            self._blocked = trie.decoding_mask(self.blocked)
+            self._prompt_len = input_ids.size(1)
+            self._cursor = trie.match_prefix(input_ids)
+        else:
+            generated = input_ids[:, self._prompt_len:]
+            if self._num_beams > 1 and generated.size(1) > 1:
+                cursor = self._cursor[self._recover_beam_idx(generated)]
+            else:
+                cursor = self._cursor
+            self._cursor = trie.step(cursor, input_ids[:, -1])
+        self._generated = input_ids[:, self._prompt_len:]
+
+        invalid = self._cursor < 0
+        if invalid.any():
+            warnings.warn(
+                f"No valid tokens found for {int(invalid.sum())} sequences at step {self.count}. "
+                f"This indicates the model generated an unexpected token. "
+            )
+
+        self.count += 1
+
+        scores = torch.nn.functional.log_softmax(scores, dim=-1)
+        return scores + trie.allowed_mask(self._cursor, scores, blocked=self._blocked, group_size=self._num_beams)
@@ -0,0 +1,252 @@
+"""
+Batch scheduling for offline evaluation.
+
+Prompt lengths vary a lot with the history length, so consecutive chunks of `batch_size`
+samples are mostly padding. Samples are instead grouped by token length, and batches are
+returned as lists of sample indices so results can be scattered back to the original order.
+`AutoBatchSizer` learns the largest batch that fits a memory budget for every prompt length
+and backs off on out-of-memory errors.
+"""
+
+import json
+import os
+
+import torch
+
+
+def length_batches(lengths, batch_size=None, max_tokens=None):
+    """Group sample indices into batches of similar length, longest first.
+
+    Args:
+        lengths: prompt length of every sample.
+        batch_size: maximum number of samples per batch.
+        max_tokens: maximum padded tokens per batch (`len(batch) * longest prompt`). A sample
+            longer than the budget still gets a batch of its own.
+
+    Returns:
+        list of index lists. Every sample appears exactly once.
+    """
+    if not batch_size and not max_tokens:
+        raise ValueError("length_batches needs batch_size or max_tokens")
+    # Longest first, so the largest batch shapes (and any OOM) show up at the start of the run
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches = []
+    batch = []
+    for i in order:
+        # Sorted descending, so the first sample of the batch is its longest
+        longest = lengths[batch[0]] if batch else lengths[i]
+        full = (batch_size and len(batch) >= batch_size) or \
+            (max_tokens and batch and (len(batch) + 1) * longest > max_tokens)
+        if full:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def pad_batch(sequences, pad_token_id, device=None):
+    """Left-pad token id lists into `(input_ids, attention_mask)` tensors."""
+    lengths = torch.tensor([len(seq) for seq in sequences], dtype=torch.long)
+    width = int(lengths.max()) if len(sequences) > 0 else 0
+    attention_mask = (torch.arange(width) >= width - lengths.unsqueeze(1)).long()
+    input_ids = torch.full((len(sequences), width), pad_token_id, dtype=torch.long)
+    input_ids[attention_mask.bool()] = torch.tensor([t for seq in sequences for t in seq], dtype=torch.long)
+    return input_ids.to(device), attention_mask.to(device)
+
+
+def is_oom_error(error):
+    """Out-of-memory errors of the CUDA and CPU allocators."""
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    message = str(error)
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+
+class MemoryMeter:
+    """Current and peak memory of `device`: allocated CUDA memory, or the process RSS on CPU.
+
+    The CPU peak is the kernel's RSS high-water mark (VmHWM), reset through /proc/self/clear_refs
+    where available; elsewhere it falls back to the RSS sampled after the run.
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.cuda = self.device.type == "cuda"
+
+    def total(self):
+        if self.cuda:
+            return torch.cuda.get_device_properties(self.device).total_memory
+        import psutil
+        return psutil.virtual_memory().total
+
+    def current(self):
+        if self.cuda:
+            return torch.cuda.memory_allocated(self.device)
+        import psutil
+        return psutil.Process().memory_info().rss
+
+    def reset_peak(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+    def peak(self):
+        if self.cuda:
+            return torch.cuda.max_memory_allocated(self.device)
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return self.current()
+
+    def free_cached(self):
+        if self.cuda:
+            torch.cuda.empty_cache()
+
+
+class AutoBatchSizer:
+    """Largest batch that fits a memory budget, learned per (prompt length bucket, num_beams).
+
+    For every key the sizer keeps the largest batch size that ran within the budget and the
+    smallest one that did not (out-of-memory error, or measured peak above the budget). New sizes
+    are extrapolated linearly from the measured per-sample memory of the last run, at most
+    doubling, and bisect between the two bounds once an upper bound is known. Unseen lengths
+    start from the closest known bucket scaled by the length ratio. The bounds can be saved to a
+    JSON file; it is only meaningful for the same model, decoder and device.
+
+    Args:
+        device: device the batches run on.
+        num_beams: beams per prompt, part of the key.
+        max_memory: budget in bytes for the device memory (CUDA) or the process RSS (CPU),
+            defaults to `memory_fraction` of the device total.
+        start: batch size for the first length seen.
+        max_batch_size: hard cap on the batch size.
+        length_step: prompt lengths are rounded up to a multiple of this for the key.
+        cache_file: JSON file to load the bounds from and save them to.
+    """
+
+    def __init__(
+        self, device, num_beams, max_memory=None, memory_fraction=0.9, start=4, max_batch_size=None,
+        length_step=64, cache_file=None,
+    ):
+        self.meter = MemoryMeter(device)
+        self.num_beams = num_beams
+        self.max_memory = max_memory or int(self.meter.total() * memory_fraction)
+        self.start = start
+        self.max_batch_size = max_batch_size
+        self.length_step = length_step
+        self.cache_file = cache_file
+        self.good = {}
+        self.bad = {}
+        self.per_sample = {}
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file) as f:
+                state = json.load(f)
+            self.good = {int(k): v for k, v in state.get(str(num_beams), {}).get("good", {}).items()}
+            self.bad = {int(k): v for k, v in state.get(str(num_beams), {}).get("bad", {}).items()}
+
+    def _bucket(self, length):
+        return -(-length // self.length_step) * self.length_step
+
+    def size(self, length):
+        """Batch size to try next for prompts of `length` tokens."""
+        bucket = self._bucket(length)
+        good, bad = self.good.get(bucket), self.bad.get(bucket)
+        if good is None:
+            known = sorted(self.good, key=lambda b: abs(b - bucket))
+            size = max(self.good[known[0]] * known[0] // bucket, 1) if known else self.start
+        elif bad is None:
+            size = good * 2
+            if bucket in self.per_sample:
+                base, per_sample = self.per_sample[bucket]
+                size = min(size, max(int((self.max_memory - base) / per_sample), good))
+        else:
+            size = (good + bad) // 2
+        if bad is not None:
+            size = min(size, bad - 1)
+        if self.max_batch_size:
+            size = min(size, self.max_batch_size)
+        return max(size, 1)
+
+    def _record(self, bucket, batch_size, fits):
+        if fits:
+            self.good[bucket] = max(self.good.get(bucket, 0), batch_size)
+            return
+        self.bad[bucket] = min(self.bad.get(bucket, batch_size), batch_size)
+        # A smaller batch may have fit before only thanks to a shorter longest prompt in the bucket
+        if self.good.get(bucket, 0) >= batch_size:
+            self.good.pop(bucket)
+            if batch_size > 1:
+                self.good[bucket] = batch_size - 1
+
+    def run(self, fn, length, batch_size):
+        """Call `fn()` on a batch of `batch_size` prompts of at most `length` tokens.
+
+        Returns `(True, result)`, or `(False, None)` after an out-of-memory error, in which case
+        the caller retries with a smaller `size()`. An error on a single prompt is re-raised.
+        """
+        bucket = self._bucket(length)
+        self.meter.free_cached()
+        base = self.meter.current()
+        self.meter.reset_peak()
+        oom = False
+        try:
+            result = fn()
+        except Exception as e:
+            if not is_oom_error(e) or batch_size == 1:
+                raise
+            oom = True
+        if oom:
+            # Outside the except block, so the traceback no longer pins the batch tensors
+            self.meter.free_cached()
+            self._record(bucket, batch_size, fits=False)
+            self.save()
+            return False, None
+        peak = self.meter.peak()
+        self.per_sample[bucket] = (base, max(peak - base, 1) / batch_size)
+        self._record(bucket, batch_size, fits=peak <= self.max_memory or batch_size == 1)
+        self.save()
+        return True, result
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        state = {}
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file) as f:
+                state = json.load(f)
+        state[str(self.num_beams)] = {"good": self.good, "bad": self.bad}
+        tmp_path = f"{self.cache_file}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.cache_file)
+
+
+def auto_batches(lengths, fn, sizer, max_tokens=None):
+    """Run `fn(batch)` over all samples, longest first, with batches sized by `sizer`.
+
+    Yields `(batch, result)` for every batch that completed; batches that ran out of memory
+    are retried smaller.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    pos = 0
+    while pos < len(order):
+        longest = lengths[order[pos]]
+        size = min(sizer.size(longest), len(order) - pos)
+        if max_tokens:
+            size = max(min(size, max_tokens // max(longest, 1)), 1)
+        batch = order[pos:pos + size]
+        ok, result = sizer.run(lambda: fn(batch), longest, len(batch))
+        if ok:
+            yield batch, result
+            pos += len(batch)
@@ -0,0 +1,282 @@
+"""
+CPU micro-benchmarks for constrained SID decoding.
+
+Uses a tiny randomly initialized Qwen2 model and a synthetic 3-level catalog, so it runs
+without checkpoints or a GPU. Timings compare decoders on identical inputs.
+
+Usage:
+    python bench_decoding.py beam --num_beams 50 --batch_size 8
+    python bench_decoding.py exhaustive --num_items 3000 --top_k 50
+    python bench_decoding.py availability --num_items 100000 --disabled 0.1
+    python bench_decoding.py schedule --schedules "8/16,16/32,32/50" --top_k 50
+    python bench_decoding.py static --arch llama --num_beams 50 --batch_size 8
+"""
+
+import random
+import time
+
+import fire
+import torch
+from transformers import (
+    GenerationConfig, LlamaConfig, LlamaForCausalLM, LogitsProcessorList, Qwen2Config, Qwen2ForCausalLM,
+)
+
+from LogitProcessor import ConstrainedLogitsProcessor
+from sid_decoding import SIDBeamSearch, SIDExhaustiveScorer, StaticSIDBeamSearch, prefill_cache
+from sid_trie import SIDTrie
+
+EOS = 0
+NEWLINE = 1
+PREFIX = [2, 3, 4]
+
+
+def tiny_model(vocab_size=32000, hidden_size=64, num_layers=2, seed=0, arch="qwen2"):
+    torch.manual_seed(seed)
+    config_cls, model_cls = {"qwen2": (Qwen2Config, Qwen2ForCausalLM), "llama": (LlamaConfig, LlamaForCausalLM)}[arch]
+    config = config_cls(
+        vocab_size=vocab_size, hidden_size=hidden_size, intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers, num_attention_heads=4, num_key_value_heads=2,
+        eos_token_id=EOS, pad_token_id=EOS, tie_word_embeddings=False,
+    )
+    return model_cls(config).eval()
+
+
+def synthetic_catalog(num_items=3000, codebook_size=256, levels=3, seed=0):
+    """Random distinct SIDs `<a_x><b_y><c_z>\\n EOS`, level tokens placed after the prompt tokens."""
+    rng = random.Random(seed)
+    sids = set()
+    while len(sids) < num_items:
+        sids.add(tuple(rng.randrange(codebook_size) for _ in range(levels)))
+    base = 100
+    sequences = [
+        [base + level * codebook_size + code for level, code in enumerate(sid)] + [NEWLINE, EOS]
+        for sid in sorted(sids)
+    ]
+    return SIDTrie.from_sequences(sequences, prefix_ids=PREFIX, eos_token_id=EOS)
+
+
+def synthetic_prompts(batch_size=8, prompt_len=128, vocab_low=5, vocab_high=100, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(vocab_low, vocab_high, (batch_size, prompt_len), generator=g)
+    input_ids[:, -len(PREFIX):] = torch.tensor(PREFIX)
+    return input_ids, torch.ones_like(input_ids)
+
+
+def timeit(fn, repeat=3):
+    fn()  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return (time.perf_counter() - start) / repeat, out
+
+
+def generate_items(model, trie, input_ids, attention_mask, num_beams, prefill_once=False):
+    clp = ConstrainedLogitsProcessor(
+        num_beams=num_beams, base_model="", eos_token_id=EOS, trie=trie, use_cursor=True
+    )
+    config = GenerationConfig(
+        num_beams=num_beams, num_return_sequences=num_beams, max_new_tokens=trie.depth + 1,
+        length_penalty=0.0, pad_token_id=EOS, eos_token_id=EOS, do_sample=False,
+    )
+    with torch.no_grad():
+        cache_kwargs = {}
+        if prefill_once:
+            cache_kwargs["past_key_values"], input_ids, attention_mask = prefill_cache(
+                model, input_ids, attention_mask, num_beams
+            )
+        sequences = model.generate(
+            input_ids, attention_mask=attention_mask, generation_config=config,
+            logits_processor=LogitsProcessorList([clp]), **cache_kwargs
+        )
+    completions = sequences[:, input_ids.size(1):]
+    nodes = trie.walk(trie.root(completions.size(0)), completions)
+    return trie.leaf_item[nodes.clamp(min=0)].view(-1, num_beams)
+
+
+def beam(
+    num_items: int = 3000,
+    vocab_size: int = 32000,
+    hidden_size: int = 64,
+    num_layers: int = 2,
+    batch_size: int = 8,
+    prompt_len: int = 128,
+    num_beams: int = 50,
+    repeat: int = 3,
+    threads: int = 0,
+):
+    """HF `generate` + ConstrainedLogitsProcessor against the fixed-depth SIDBeamSearch."""
+    if threads > 0:
+        torch.set_num_threads(threads)
+    model = tiny_model(vocab_size, hidden_size, num_layers)
+    trie = synthetic_catalog(num_items)
+    input_ids, attention_mask = synthetic_prompts(batch_size, prompt_len)
+
+    t_gen, ref = timeit(lambda: generate_items(model, trie, input_ids, attention_mask, num_beams), repeat)
+    print(f"{'generate':24s}: {t_gen * 1000:8.1f} ms/batch")
+    t, out = timeit(lambda: generate_items(model, trie, input_ids, attention_mask, num_beams, prefill_once=True), repeat)
+    agree = (out == ref).float().mean().item()
+    print(f"{'generate (prefill once)':24s}: {t * 1000:8.1f} ms/batch  speedup {t_gen / t:5.2f}x  same items {agree:.3f}")
+    for restrict_vocab in (False, True):
+        search = SIDBeamSearch(model, trie, num_beams, restrict_vocab=restrict_vocab)
+        t, out = timeit(lambda: search(input_ids, attention_mask), repeat)
+        agree = (out.item_ids == ref).float().mean().item()
+        name = "SIDBeamSearch" + (" (SID vocab)" if restrict_vocab else "")
+        print(f"{name:24s}: {t * 1000:8.1f} ms/batch  speedup {t_gen / t:5.2f}x  same items {agree:.3f}")
+
+
+def exhaustive(
+    num_items: int = 3000,
+    vocab_size: int = 32000,
+    hidden_size: int = 64,
+    num_layers: int = 2,
+    batch_size: int = 8,
+    prompt_len: int = 128,
+    top_k: int = 50,
+    chunk_size: int = 1024,
+    repeat: int = 3,
+    threads: int = 0,
+):
+    """Exact all-item scoring against SIDBeamSearch: latency and overlap of the top-K items."""
+    if threads > 0:
+        torch.set_num_threads(threads)
+    model = tiny_model(vocab_size, hidden_size, num_layers)
+    trie = synthetic_catalog(num_items)
+    input_ids, attention_mask = synthetic_prompts(batch_size, prompt_len)
+
+    scorer = SIDExhaustiveScorer(model, trie, top_k, chunk_size=chunk_size)
+    t_ex, exact = timeit(lambda: scorer(input_ids, attention_mask), repeat)
+    print(f"{'SIDExhaustiveScorer':24s}: {t_ex * 1000:8.1f} ms/batch  ({trie.num_nodes} trie nodes)")
+    search = SIDBeamSearch(model, trie, top_k)
+    t, out = timeit(lambda: search(input_ids, attention_mask), repeat)
+    recall = torch.tensor([
+        len(set(a) & set(b)) / top_k for a, b in zip(out.item_ids.tolist(), exact.item_ids.tolist())
+    ]).mean().item()
+    print(f"{'SIDBeamSearch':24s}: {t * 1000:8.1f} ms/batch  recall of exact top-{top_k} {recall:.3f}")
+
+
+def schedule(
+    schedules: str = "4/8,8/16,16/32,32/50,50/50",
+    num_items: int = 3000,
+    vocab_size: int = 32000,
+    hidden_size: int = 64,
+    num_layers: int = 2,
+    batch_size: int = 8,
+    prompt_len: int = 128,
+    top_k: int = 50,
+    repeat: int = 3,
+    threads: int = 0,
+):
+    """SIDBeamSearch with per-level beam widths: wall time and recall of the exact top-K.
+
+    `schedules` is a comma-separated list of `/`-separated widths for the first SID levels;
+    the remaining steps keep `top_k` beams. The exact top-K comes from SIDExhaustiveScorer.
+    """
+    if threads > 0:
+        torch.set_num_threads(threads)
+    model = tiny_model(vocab_size, hidden_size, num_layers)
+    trie = synthetic_catalog(num_items)
+    input_ids, attention_mask = synthetic_prompts(batch_size, prompt_len)
+    exact = SIDExhaustiveScorer(model, trie, top_k)(input_ids, attention_mask).item_ids.tolist()
+
+    def recall(out):
+        return sum(len(set(a) & set(b)) for a, b in zip(out.item_ids.tolist(), exact)) / (top_k * len(exact))
+
+    search = SIDBeamSearch(model, trie, top_k)
+    t_full, out = timeit(lambda: search(input_ids, attention_mask), repeat)
+    print(f"{f'{top_k} beams at every level':28s}: {t_full * 1000:8.1f} ms/batch  recall@{top_k} {recall(out):.3f}")
+    for widths in (schedules.split(",") if isinstance(schedules, str) else schedules):
+        search = SIDBeamSearch(model, trie, top_k, beam_schedule=widths)
+        t, out = timeit(lambda: search(input_ids, attention_mask), repeat)
+        name = "/".join(str(w) for w in search.widths(trie.depth))
+        print(f"{name:28s}: {t * 1000:8.1f} ms/batch  recall@{top_k} {recall(out):.3f}  relative {t / t_full:5.2f}x")
+
+
+def static(
+    arch: str = "qwen2",
+    num_items: int = 3000,
+    vocab_size: int = 32000,
+    hidden_size: int = 64,
+    num_layers: int = 2,
+    batch_size: int = 8,
+    prompt_len: int = 128,
+    num_beams: int = 50,
+    repeat: int = 3,
+    threads: int = 0,
+):
+    """Generated tokens/s of evaluate.py's default path (`generate`, prompts prefilled once),
+    SIDBeamSearch and StaticSIDBeamSearch, eager and under `torch.compile`."""
+    if threads > 0:
+        torch.set_num_threads(threads)
+    model = tiny_model(vocab_size, hidden_size, num_layers, arch=arch)
+    trie = synthetic_catalog(num_items)
+    input_ids, attention_mask = synthetic_prompts(batch_size, prompt_len)
+    tokens = batch_size * num_beams * trie.depth
+
+    t_gen, ref = timeit(lambda: generate_items(model, trie, input_ids, attention_mask, num_beams, prefill_once=True), repeat)
+    print(f"{'generate (evaluate.py)':28s}: {tokens / t_gen:10.0f} tokens/s")
+    runs = [
+        ("SIDBeamSearch", SIDBeamSearch(model, trie, num_beams, restrict_vocab=False)),
+        ("StaticSIDBeamSearch", StaticSIDBeamSearch(model, trie, num_beams, restrict_vocab=False)),
+        ("StaticSIDBeamSearch compiled", StaticSIDBeamSearch(model, trie, num_beams, restrict_vocab=False, compile=True)),
+    ]
+    for name, search in runs:
+        start = time.perf_counter()
+        search(input_ids, attention_mask)
+        warmup = time.perf_counter() - start
+        t, out = timeit(lambda: search(input_ids, attention_mask), repeat)
+        agree = (out.item_ids == ref).float().mean().item()
+        print(
+            f"{name:28s}: {tokens / t:10.0f} tokens/s  speedup {t_gen / t:5.2f}x  "
+            f"same items {agree:.3f}  first call {warmup:6.1f} s"
+        )
+
+
+def availability(
+    num_items: int = 100000,
+    vocab_size: int = 32000,
+    hidden_size: int = 64,
+    num_layers: int = 2,
+    batch_size: int = 8,
+    prompt_len: int = 128,
+    num_beams: int = 50,
+    disabled: float = 0.1,
+    update_size: int = 1000,
+    repeat: int = 3,
+    threads: int = 0,
+):
+    """Latency of `set_available` + `sync_availability`, and SIDBeamSearch with part of the catalog disabled."""
+    if threads > 0:
+        torch.set_num_threads(threads)
+    trie = synthetic_catalog(num_items)
+    rng = random.Random(0)
+    items = list(range(num_items))
+
+    def update(batch, available):
+        trie.set_available(batch, available)
+        trie.sync_availability()
+
+    for n in (1, update_size):
+        batch = rng.sample(items, n)
+        t_off, _ = timeit(lambda: (update(batch, False), update(batch, True)), repeat=20)
+        print(f"{f'toggle {n} items':24s}: {t_off / 2 * 1000:8.3f} ms/update  ({trie.num_nodes} trie nodes)")
+    assert not trie.sync_availability().any()
+
+    model = tiny_model(vocab_size, hidden_size, num_layers)
+    input_ids, attention_mask = synthetic_prompts(batch_size, prompt_len)
+    search = SIDBeamSearch(model, trie, num_beams)
+    t_all, full = timeit(lambda: search(input_ids, attention_mask), repeat)
+    print(f"{'SIDBeamSearch':24s}: {t_all * 1000:8.1f} ms/batch  all items available")
+    # Disable part of the catalog, always including the best items of the unrestricted search
+    off = set(rng.sample(items, int(num_items * disabled))) | set(full.item_ids[:, :num_beams // 2].flatten().tolist())
+    update(sorted(off), False)
+    t, out = timeit(lambda: search(input_ids, attention_mask), repeat)
+    leaked = sum(item in off for item in out.item_ids.flatten().tolist())
+    invalid = int((out.item_ids < 0).sum())
+    print(
+        f"{'SIDBeamSearch':24s}: {t * 1000:8.1f} ms/batch  {len(off)} items disabled, "
+        f"relative {t / t_all:5.2f}x  disabled returned {leaked}  invalid {invalid}"
+    )
+
+
+if __name__ == '__main__':
+    fire.Fire({"beam": beam, "exhaustive": exhaustive, "availability": availability, "schedule": schedule, "static": static})
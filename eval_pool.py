@@ -0,0 +1,147 @@
+"""
+Multi-process evaluation driver.
+
+Worker processes each load the model once, then pull batches of sample indices from the
+parent and stream their predictions back. The parent keeps the queue of pending batches and
+the batch every worker is holding, so when a worker dies its batch goes back to the queue
+and is picked up by the next idle worker. Tokenized inputs are handed over as shared-memory
+tensors and the SID trie is loaded memory-mapped from its on-disk index, so neither is
+copied per worker.
+"""
+
+import collections
+import os
+import sys
+import traceback
+from multiprocessing.connection import wait
+
+import torch
+import torch.multiprocessing as mp
+
+
+def pack_sequences(sequences):
+    """Token id lists as one flat shared-memory tensor plus offsets."""
+    offsets = torch.zeros(len(sequences) + 1, dtype=torch.long)
+    offsets[1:] = torch.tensor([len(seq) for seq in sequences], dtype=torch.long).cumsum(0)
+    flat = torch.tensor([t for seq in sequences for t in seq], dtype=torch.long)
+    return flat.share_memory_(), offsets.share_memory_()
+
+
+def unpack_sequences(flat, offsets, indices):
+    return [flat[offsets[i]:offsets[i + 1]].tolist() for i in indices]
+
+
+def worker_devices(num_workers):
+    """One device per worker (round-robin over GPUs) and the CPU threads each may use."""
+    if torch.cuda.is_available():
+        return [f"cuda:{i % torch.cuda.device_count()}" for i in range(num_workers)], None
+    return ["cpu"] * num_workers, max((os.cpu_count() or 1) // num_workers, 1)
+
+
+def _worker(worker_id, device, num_threads, init_fn, init_args, conn):
+    try:
+        # Without a cap every CPU worker would start one thread per core
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        predict = init_fn(device, *init_args)
+        conn.send(("ready",))
+        while True:
+            batch = conn.recv()
+            if batch is None:
+                break
+            conn.send(("done", batch, predict(batch)))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+        sys.exit(1)
+
+
+def run_pool(init_fn, init_args, batches, num_workers, max_attempts=3, join_timeout=5.0):
+    """Evaluate `batches` on `num_workers` processes, yielding `(batch, result)` as they finish.
+
+    Every worker talks to the parent over its own pipe, so a worker that dies mid-write cannot
+    leave a shared queue locked for the others; its death shows up as end-of-file on the pipe.
+
+    Args:
+        init_fn: picklable `init_fn(device, *init_args)` run once in every worker, returning
+            `predict(batch) -> result` for a list of sample indices.
+        init_args: extra arguments of `init_fn`, shared tensors are passed by handle.
+        batches: lists of sample indices, dispatched in order to whichever worker is idle.
+        num_workers: number of worker processes.
+        max_attempts: how many workers a batch may take down before giving up on the run.
+    """
+    ctx = mp.get_context("spawn")
+    devices, num_threads = worker_devices(num_workers)
+    conns = {}
+    procs = {}
+    for worker_id, device in enumerate(devices):
+        conns[worker_id], child_conn = ctx.Pipe()
+        procs[worker_id] = ctx.Process(
+            target=_worker, args=(worker_id, device, num_threads, init_fn, init_args, child_conn), daemon=True
+        )
+        procs[worker_id].start()
+        # Only the worker holds the other end, so its exit closes the pipe
+        child_conn.close()
+    owner = {conn: worker_id for worker_id, conn in conns.items()}
+
+    pending = collections.deque(batches)
+    remaining = len(pending)
+    holding = {}
+    idle = set()
+    alive = set(procs)
+    attempts = collections.Counter()
+
+    def dispatch(worker_id):
+        if pending:
+            holding[worker_id] = pending.popleft()
+            conns[worker_id].send(holding[worker_id])
+        else:
+            idle.add(worker_id)
+
+    def lost(worker_id):
+        alive.discard(worker_id)
+        idle.discard(worker_id)
+        procs[worker_id].join(timeout=join_timeout)
+        batch = holding.pop(worker_id, None)
+        print(
+            f"Worker {worker_id} died (exit code {procs[worker_id].exitcode}), redistributing its batch",
+            file=sys.stderr,
+        )
+        if batch is not None:
+            attempts[tuple(batch)] += 1
+            if attempts[tuple(batch)] >= max_attempts:
+                raise RuntimeError(f"Batch {batch[:8]}... failed on {max_attempts} workers")
+            pending.appendleft(batch)
+            if idle:
+                dispatch(idle.pop())
+
+    try:
+        while remaining > 0:
+            if not alive:
+                raise RuntimeError("All evaluation workers died")
+            for conn in wait([conns[worker_id] for worker_id in alive]):
+                worker_id = owner[conn]
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    lost(worker_id)
+                    continue
+                if message[0] == "ready":
+                    dispatch(worker_id)
+                elif message[0] == "done":
+                    batch, result = message[1], message[2]
+                    holding.pop(worker_id, None)
+                    remaining -= 1
+                    yield batch, result
+                    dispatch(worker_id)
+                elif message[0] == "error":
+                    print(message[1], file=sys.stderr)
+    finally:
+        for worker_id in alive:
+            try:
+                conns[worker_id].send(None)
+            except OSError:
+                pass
+        for proc in procs.values():
+            proc.join(timeout=join_timeout)
+            if proc.is_alive():
+                proc.terminate()
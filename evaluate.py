@@ -4,9 +4,23 @@ import fire
 import torch
 import json
 import os
+import glob
+import re
+from contextlib import nullcontext
 from transformers import GenerationConfig,  AutoTokenizer, BitsAndBytesConfig, AutoModelForCausalLM, LogitsProcessorList, TemperatureLogitsWarper
 from data import  EvalD3Dataset, EvalSidDataset
 from LogitProcessor import ConstrainedLogitsProcessor
+from sid_trie import item_index, load_item_sids, load_item_titles, load_or_build_sid_trie
+from title_trie import build_title_trie
+from batching import AutoBatchSizer, auto_batches, length_batches, pad_batch
+from sid_decoding import (
+    RestrictedLMHead, SIDBeamSearch, SIDExhaustiveScorer, SharedPrefixCache, StaticSIDBeamSearch, common_prefix,
+    parse_beam_schedule, prefill_cache, replaced_lm_head,
+)
+from eval_pool import pack_sequences, run_pool, unpack_sequences
+from result_stream import ResultWriter, completed_indices, iter_results, load_results
+from metrics import Predictions, SequentialTest, first_hit, per_sample_metrics, rank_metric
+from safetensors import safe_open
 from accelerate import Accelerator
 import random
 import bitsandbytes as bnb
@@ -21,10 +35,6 @@ P = 998244353
 MOD = int(1e9 + 9)
 import numpy as np
 
-def get_hash(x):
-    x = [str(_) for _ in x]
-    return '-'.join(x)
-
 def set_seed(seed):
     random.seed(seed)
     np.random.seed(seed)
@@ -35,136 +45,165 @@ def set_seed(seed):
     # torch.backends.cudnn.deterministic = True
     # torch.backends.cudnn.benchmark = False
     
-def main(
-    base_model: str = "",
-    train_file: str = "",
-    info_file: str = "",
-    category: str = "",
-    test_data_path: str = "",
-    result_json_data: str = "",
-    batch_size: int = 4,
-    K: int = 0,
-    seed: int = 42,
-    length_penalty: float=0.0,
-    max_new_tokens: int = 256,
-    num_beams: int = 50,
-):
-    random.seed(seed)
-    set_seed(seed)
-    os.environ["CUDA_VISIBLE_DEVICES"] = "0"
-    category_dict = {"Industrial_and_Scientific": "industrial and scientific items", "Office_Products": "office products", "Toys_and_Games": "toys and games", "Sports": "sports and outdoors", "Books": "books"}
-    category = category_dict[category]
-    print(category)
+class Evaluator:
+    """Model, constraints and decoder of one evaluation process."""
 
-    model = AutoModelForCausalLM.from_pretrained(base_model, torch_dtype=torch.bfloat16, device_map="auto")
-    model.eval()
-    with open(info_file, 'r') as f:
-        info = f.readlines()
-        # Parse new format: semantic_id \t item_title \t item_id
-        semantic_ids = [line.split('\t')[0].strip() + "\n" for line in info]
-        item_titles = [line.split('\t')[1].strip() + "\n" for line in info if len(line.split('\t')) >= 2]
-        
-        # Format for tokenization
-        info_semantic = [f'''### Response:\n{_}''' for _ in semantic_ids]
-        info_titles = [f'''### Response:\n{_}''' for _ in item_titles]
+    def __init__(
+        self,
+        base_model,
+        info_file,
+        device,
+        num_beams=50,
+        max_new_tokens=256,
+        length_penalty=0.0,
+        title_constraint=False,
+        trie_cache_dir=None,
+        restrict_vocab=False,
+        decoder="generate",
+        exhaustive_chunk_size=1024,
+        beam_schedule=None,
+        compile_decoder=False,
+        prefill_once=True,
+        prefix_ids=None,
+        auto_batch=False,
+        batch_size=4,
+        max_memory_gb=0.0,
+        batch_size_cache=None,
+    ):
+        self.base_model = base_model
+        self.device = device
+        self.num_beams = num_beams
+        self.max_new_tokens = max_new_tokens
+        self.length_penalty = length_penalty
+        self.title_constraint = title_constraint
+        self.restrict_vocab = restrict_vocab
+        self.decoder = decoder
+        self.exhaustive_chunk_size = exhaustive_chunk_size
+        self.beam_schedule = beam_schedule
+        self.compile_decoder = compile_decoder
+        self.static_search = None
+        self.prefill_once = prefill_once
+        self.trie_cache_dir = trie_cache_dir
 
+        model = AutoModelForCausalLM.from_pretrained(base_model, torch_dtype=torch.bfloat16, device_map={"": device})
+        model.eval()
+        tokenizer = AutoTokenizer.from_pretrained(base_model)
 
-    tokenizer = AutoTokenizer.from_pretrained(base_model)
-    
-    # Create prefixID for semantic IDs (existing functionality)
-    if base_model.lower().find("llama") > -1:
-        prefixID = [tokenizer(_).input_ids[1:] for _ in info_semantic]
-        prefixTitleID = [tokenizer(_).input_ids[1:] for _ in info_titles]
-    else:
-        prefixID = [tokenizer(_).input_ids for _ in info_semantic]
-        prefixTitleID = [tokenizer(_).input_ids for _ in info_titles]
-    if base_model.lower().find("gpt2") > -1:
-        prefix_index = 4
-    else:
-        prefix_index = 3
-    
-    # Build hash_dict for semantic IDs (existing functionality)
-    hash_dict = dict()
-    # print(f"eos token: {tokenizer.eos_token_id}")
-    for index, ID in enumerate(prefixID):
-        ID.append(tokenizer.eos_token_id)
-        for i in range(prefix_index, len(ID)):
-            if i == prefix_index:
-                hash_number = get_hash(ID[:i])
-            else:
-                hash_number = get_hash(ID[prefix_index:i])
-            if hash_number not in hash_dict:
-                hash_dict[hash_number] = set()
-            hash_dict[hash_number].add(ID[i])
-        hash_number = get_hash(ID[prefix_index:])
-
-    # Build hash_dict_title for item titles (new functionality)
-    hash_dict_title = dict()
-    for index, ID in enumerate(prefixTitleID):
-        ID.append(tokenizer.eos_token_id)
-        for i in range(prefix_index, len(ID)):
-            if i == prefix_index:
-                hash_number = get_hash(ID[:i])
-            else:
-                hash_number = get_hash(ID[prefix_index:i])
-            if hash_number not in hash_dict_title:
-                hash_dict_title[hash_number] = set()
-            hash_dict_title[hash_number].add(ID[i])
-        hash_number = get_hash(ID[prefix_index:])
-
-    # Convert sets to lists for both dictionaries
-    for key in hash_dict.keys():
-        hash_dict[key] = list(hash_dict[key])
-    for key in hash_dict_title.keys():
-        hash_dict_title[key] = list(hash_dict_title[key])
-
-    # Define prefix constraint functions
-    def prefix_allowed_tokens_fn_semantic(batch_id, input_ids):
-        hash_number = get_hash(input_ids)
-        if hash_number in hash_dict:
-            return hash_dict[hash_number]
-        return []
-        
-    def prefix_allowed_tokens_fn_title(batch_id, input_ids):
-        hash_number = get_hash(input_ids)
-        if hash_number in hash_dict_title:
-            return hash_dict_title[hash_number]
-        return []
-
-    # Default to semantic constraints (backward compatibility)
-    prefix_allowed_tokens_fn = prefix_allowed_tokens_fn_semantic
-    # prefix_allowed_tokens_fn = prefix_allowed_tokens_fn_title
-    
-    tokenizer.pad_token = tokenizer.eos_token
-    tokenizer.pad_token_id = tokenizer.eos_token_id
-    tokenizer.padding_side = "left"
-    
-    # val_dataset = EvalD3Dataset(train_file=test_data_path, tokenizer=tokenizer, max_len=2560, category=category, test=True, K=K, seed=seed)
-    val_dataset = EvalSidDataset(train_file=test_data_path, tokenizer=tokenizer, max_len=2560, category=category, test=True, K=K, seed=seed)
-        
-    encodings = [val_dataset[i] for i in range(len(val_dataset))]
-    # encodings = [val_dataset[i] for i in indexes]
-    test_data = val_dataset.get_all()
+        tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+        tokenizer.padding_side = "left"
+        model.config.pad_token_id = model.config.eos_token_id = tokenizer.eos_token_id
+        model.config.bos_token_id = tokenizer.bos_token_id
+        self.model = model.to(device)
+        self.tokenizer = tokenizer
 
-    model.config.pad_token_id = model.config.eos_token_id = tokenizer.eos_token_id
-    model.config.bos_token_id = tokenizer.bos_token_id
+        self.catalogs = {}
+        self.restricted_heads = {}
+        self.prefix_ids = None
+        self.prefix_cache = None
+        self.set_catalog(info_file, prefix_ids)
 
-    def evaluate(
-            encodings,
-            num_beams=10,
-            max_new_tokens=64,
-            length_penalty=1.0,
-            **kwargs,
-    ):
-        maxLen = max([len(_["input_ids"]) for _ in encodings])
+        self.sizer = None
+        if auto_batch:
+            # Batch sizes learned per prompt length within the memory budget, starting from batch_size
+            self.sizer = AutoBatchSizer(
+                device, num_beams, max_memory=int(max_memory_gb * 2 ** 30) or None, start=batch_size,
+                cache_file=batch_size_cache,
+            )
 
-        padding_encodings = {"input_ids": []}
-        attention_mask = []
+    def set_catalog(self, info_file, prefix_ids=None):
+        """Point the constraints at the catalog of `info_file` and the prompts sharing `prefix_ids`.
 
-        for  _ in encodings:
-            L = len(_["input_ids"])
-            padding_encodings["input_ids"].append([tokenizer.pad_token_id] * (maxLen - L) + _["input_ids"])
-            attention_mask.append([0] * (maxLen - L) + [1] * L) 
+        Tries (and title constraints) are kept per catalog, so a session can go back and forth
+        between categories without rebuilding them.
+        """
+        if info_file not in self.catalogs:
+            # Compiled prefix trie for semantic IDs, loaded from the shared on-disk index and moved to the
+            # device once: decoders use it as given, so `set_available` on `self.sid_trie` reaches them
+            sid_trie = load_or_build_sid_trie(
+                info_file, self.tokenizer, self.base_model, cache_dir=self.trie_cache_dir
+            ).to(self.device)
+            # Radix trie over the tokenized titles, when titles are generated instead of SIDs
+            title_trie = None
+            if self.title_constraint:
+                title_trie = build_title_trie(info_file, self.tokenizer, self.base_model).to(self.device)
+            self.catalogs[info_file] = (sid_trie, title_trie)
+        self.sid_trie, self.title_trie = self.catalogs[info_file]
+
+        # Every prompt starts with the same instruction block, encode it once for the whole run
+        if prefix_ids != self.prefix_ids:
+            self.prefix_ids = prefix_ids
+            self.prefix_cache = SharedPrefixCache(self.model, prefix_ids) if prefix_ids else None
+
+    def load_weights(self, checkpoint):
+        """Swap in the weights of `checkpoint` (a directory of safetensors files) in place.
+
+        Tensors are read one at a time straight onto the device and copied into the existing
+        parameters, so the model, tokenizer and trie are not rebuilt between checkpoints.
+        """
+        files = sorted(glob.glob(os.path.join(checkpoint, "*.safetensors")))
+        if not files:
+            raise FileNotFoundError(f"No safetensors weights in {checkpoint}")
+        params = self.model.state_dict()
+        loaded = set()
+        with torch.no_grad():
+            for file in files:
+                with safe_open(file, framework="pt", device=str(self.device)) as f:
+                    for name in f.keys():
+                        if name not in params:
+                            raise ValueError(f"{file} has weights for {name}, which the model does not have")
+                        params[name].copy_(f.get_tensor(name))
+                        loaded.add(params[name].data_ptr())
+        # Tied weights (e.g. lm_head and the embeddings) are saved once
+        missing = [name for name, param in params.items() if param.data_ptr() not in loaded]
+        if missing:
+            raise ValueError(f"{checkpoint} is missing weights for {missing[:5]}")
+        self.restricted_heads.clear()
+        if self.prefix_ids:
+            self.prefix_cache = SharedPrefixCache(self.model, self.prefix_ids)
+
+    def head_context(self):
+        # Only trie tokens and EOS survive the mask, so project onto that subset of the LM head. The head
+        # is built once per catalog and weights; `generate` still gets full-vocabulary logits back from it
+        if self.restrict_vocab and self.decoder == "generate":
+            trie = self.title_trie if self.title_constraint else self.sid_trie
+            if trie not in self.restricted_heads:
+                self.restricted_heads[trie] = RestrictedLMHead(self.model.get_output_embeddings(), trie.vocab_ids)
+            return replaced_lm_head(self.model, self.restricted_heads[trie])
+        return nullcontext()
+
+    def evaluate(self, encodings, num_beams=10, max_new_tokens=64, length_penalty=1.0, **kwargs):
+        model, tokenizer, sid_trie, base_model = self.model, self.tokenizer, self.sid_trie, self.base_model
+        input_ids, attention_mask = pad_batch([_["input_ids"] for _ in encodings], tokenizer.pad_token_id, self.device)
+        maxLen = input_ids.size(1)
+        blocked = None
+        if "excluded" in encodings[0]:
+            # Items each prompt must not be recommended, pruned from the trie for its beams
+            excluded, _ = pad_batch([_["excluded"] for _ in encodings], -1)
+            blocked = sid_trie.blocked_nodes(excluded).to(self.device)
+
+        if self.decoder in ("sid_beam", "static_beam", "exhaustive"):
+            if self.decoder == "static_beam":
+                # Kept across batches, so its compiled steps are reused until the catalog or prefix changes
+                key = (sid_trie, self.prefix_cache, num_beams, length_penalty)
+                if self.static_search is None or self.static_search[0] != key:
+                    self.static_search = (key, StaticSIDBeamSearch(
+                        model, sid_trie, num_beams, length_penalty=length_penalty, restrict_vocab=self.restrict_vocab,
+                        prefix_cache=self.prefix_cache, compile=self.compile_decoder,
+                    ))
+                search = self.static_search[1]
+            elif self.decoder == "sid_beam":
+                search = SIDBeamSearch(
+                    model, sid_trie, num_beams, length_penalty=length_penalty,
+                    restrict_vocab=self.restrict_vocab, prefix_cache=self.prefix_cache,
+                    beam_schedule=self.beam_schedule,
+                )
+            else:
+                search = SIDExhaustiveScorer(
+                    model, sid_trie, num_beams, length_penalty=length_penalty, restrict_vocab=self.restrict_vocab,
+                    chunk_size=self.exhaustive_chunk_size, prefix_cache=self.prefix_cache,
+                )
+            return search(input_ids, attention_mask, blocked=blocked).item_ids.tolist()
         
         # print(f"num_beams: {num_beams}")
         generation_config = GenerationConfig(
@@ -181,64 +220,379 @@ def main(
         
         with torch.no_grad():
             clp = ConstrainedLogitsProcessor(
-                prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
                 num_beams=num_beams,
                 base_model=base_model,
-                eos_token_id=model.config.eos_token_id
+                eos_token_id=model.config.eos_token_id,
+                trie=self.title_trie if self.title_constraint else sid_trie,
+                use_cursor=True,
+                blocked=blocked,
             )
             logits_processor = LogitsProcessorList([clp])
 
+            # generate expands the prompts to batch * num_beams before prefill; encode them once instead
+            cache_kwargs = {}
+            if self.prefill_once:
+                cache_kwargs["past_key_values"], input_ids, attention_mask = prefill_cache(
+                    model, input_ids, attention_mask, num_beams, self.prefix_cache
+                )
+
             generation_output = model.generate(
-                torch.tensor(padding_encodings["input_ids"]).to(device),
-                attention_mask=torch.tensor(attention_mask).to(device),
+                input_ids,
+                attention_mask=attention_mask,
                 generation_config=generation_config,
                 return_dict_in_generate=True,
                 output_scores=True,
                 logits_processor=logits_processor,
+                **cache_kwargs
             )
        
         batched_completions = generation_output.sequences[:, maxLen:]
-       
-        
-        if base_model.lower().find("llama") > -1:
-            output = tokenizer.batch_decode(batched_completions, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-        else:
-            output = tokenizer.batch_decode(batched_completions, skip_special_tokens=True)
-            
-        output = [_.split("Response:\n")[-1].strip() for _ in output]
-        real_outputs = [output[i * num_beams: (i + 1) * num_beams] for i in range(len(output) // num_beams)]
-        return real_outputs
-    
-    model = model.to(device)
+        # Every constrained completion ends on a trie leaf, which already names the item
+        trie = self.title_trie if self.title_constraint else sid_trie
+        return trie.completion_items(batched_completions).view(-1, num_beams).tolist()
 
-    from tqdm import tqdm
-    outputs = []
-    new_encodings = []
-    BLOCK = (len(encodings) + batch_size - 1) // batch_size
-    for i in range(BLOCK):
-        new_encodings.append(encodings[i * batch_size: (i + 1) * batch_size])
+    def predict(self, encodings):
+        with self.head_context():
+            return self.evaluate(
+                encodings, max_new_tokens=self.max_new_tokens, num_beams=self.num_beams, length_penalty=self.length_penalty
+            )
+
+    def run(self, encodings):
+        """Predictions for `encodings`, split further by the batch sizer when auto batching."""
+        if self.sizer is None:
+            return self.predict(encodings)
+        outputs = [None] * len(encodings)
+        lengths = [len(_["input_ids"]) for _ in encodings]
+        for batch, output in auto_batches(lengths, lambda b: self.predict([encodings[i] for i in b]), self.sizer):
+            for i, predict in zip(batch, output):
+                outputs[i] = predict
+        return outputs
+
+
+def unpack_encodings(flat, offsets, batch, excluded=None):
+    """Encodings of `batch` from the packed prompts, with the packed exclusion sets if any."""
+    encodings = [{"input_ids": ids} for ids in unpack_sequences(flat, offsets, batch)]
+    if excluded is not None:
+        for encoding, items in zip(encodings, unpack_sequences(*excluded, batch)):
+            encoding["excluded"] = items
+    return encodings
+
+
+def init_worker(device, options, flat, offsets, excluded=None):
+    evaluator = Evaluator(device=device, **options)
+
+    def predict(batch):
+        return evaluator.run(unpack_encodings(flat, offsets, batch, excluded))
+
+    return predict
+
+
+def init_sweep_worker(device, options, flat, offsets, batches, excluded=None):
+    evaluator = Evaluator(device=device, **options)
 
+    def evaluate_checkpoint(task):
+        evaluator.load_weights(task[0])
+        outputs = [None] * (len(offsets) - 1)
+        for batch in batches:
+            output = evaluator.run(unpack_encodings(flat, offsets, batch, excluded))
+            for i, predict in zip(batch, output):
+                outputs[i] = predict
+        return outputs
+
+    return evaluate_checkpoint
+
+
+def find_checkpoints(path):
+    """Directories under `path` (and `path` itself) holding safetensors weights, by training step."""
+    candidates = [path] + sorted(os.path.join(path, name) for name in os.listdir(path))
+    found = [d for d in candidates if os.path.isdir(d) and glob.glob(os.path.join(d, "*.safetensors"))]
+
+    def step(d):
+        match = re.search(r"(\d+)$", os.path.basename(os.path.normpath(d)))
+        return int(match.group(1)) if match else float("inf")
+
+    return sorted(found, key=lambda d: (step(d), d))
+
+
+def result_metrics(path, info_file):
+    names, values = per_sample_metrics(Predictions.load(path, info_file), topk=(1, 3, 5, 10, 20, 50))
+    return dict(zip(names, values.mean(axis=0).tolist()))
+
+
+def print_metrics_table(title, table):
+    """One row per run: HR@K, NDCG@K and the invalid rate at the largest K."""
+    names = list(next(iter(table.values())))
+    columns = [name for name in names if name.startswith(("HR@", "NDCG@"))] + [names[-1]]
+    width = max(len(title), *(len(row) for row in table))
+    print(f"{title:>{width}s} | " + " | ".join(f"{name:>9s}" for name in columns))
+    for row, metrics in table.items():
+        print(f"{row:>{width}s} | " + " | ".join(f"{metrics[name]:9.4f}" for name in columns))
+
+
+# Evaluators stay loaded between main() calls, so a session loads the model once for all categories
+_resident = {}
+
+
+def resident_evaluator(options, auto_batch):
+    catalog = ("info_file", "prefix_ids", "decoder")
+    key = tuple(sorted((k, v) for k, v in options.items() if k not in catalog)) + (("auto_batch", auto_batch),)
+    if key not in _resident:
+        _resident[key] = Evaluator(device=device, auto_batch=auto_batch, **options)
+    evaluator = _resident[key]
+    evaluator.set_catalog(options["info_file"], options["prefix_ids"])
+    evaluator.decoder = options["decoder"]
+    return evaluator
+
+
+def main(
+    base_model: str = "",
+    train_file: str = "",
+    info_file: str = "",
+    category: str = "",
+    test_data_path: str = "",
+    result_json_data: str = "",
+    batch_size: int = 4,
+    K: int = 0,
+    seed: int = 42,
+    length_penalty: float=0.0,
+    max_new_tokens: int = 256,
+    num_beams: int = 50,
+    title_constraint: bool = False,
+    trie_cache_dir: str = None,
+    restrict_vocab: bool = False,  # only saves head memory with --decoder sid_beam/static_beam/exhaustive
+    decoder: str = "generate",
+    exhaustive_max_items: int = 10000,
+    exhaustive_chunk_size: int = 1024,
+    beam_schedule: str = None,
+    compile_decoder: bool = False,
+    prefill_once: bool = True,
+    shared_prefix: bool = True,
+    max_batch_tokens: int = 0,
+    auto_batch: bool = False,
+    max_memory_gb: float = 0.0,
+    batch_size_cache: str = None,
+    workers: int = 0,
+    resume: bool = False,
+    save_text: bool = True,
+    sequential: bool = False,
+    reference: str = None,
+    stop_metric: str = "NDCG@10",
+    precision: float = 0.0,
+    alpha: float = 0.05,
+    check_every: int = 256,
+    min_samples: int = 512,
+    checkpoints: str = None,
+    exclude_history: bool = False,
+    session: str = None,
+):
+    if session:
+        return run_session(session, {k: v for k, v in locals().items() if k != "session"})
+    random.seed(seed)
+    set_seed(seed)
+    if workers <= 1:
+        os.environ["CUDA_VISIBLE_DEVICES"] = "0"
+    category_dict = {"Industrial_and_Scientific": "industrial and scientific items", "Office_Products": "office products", "Toys_and_Games": "toys and games", "Sports": "sports and outdoors", "Books": "books"}
+    category = category_dict.get(category, category.replace("_", " ").lower())
+    print(category)
+
+    tokenizer = AutoTokenizer.from_pretrained(base_model)
+    
+    # Build the on-disk trie index once here, every worker then maps the same file
+    sid_trie = load_or_build_sid_trie(info_file, tokenizer, base_model, cache_dir=trie_cache_dir)
+    if decoder not in ("generate", "sid_beam", "static_beam", "exhaustive"):
+        raise ValueError(f"Unknown decoder {decoder}, expected 'generate', 'sid_beam', 'static_beam' or 'exhaustive'")
+    if decoder != "generate" and title_constraint:
+        raise ValueError(f"The {decoder} decoder only supports semantic ID constraints")
+    if exclude_history and title_constraint:
+        raise ValueError("exclude_history needs the semantic ID trie, not title constraints")
+    # Scoring every item costs one forward row per trie node, beam search wins on large catalogs
+    if decoder == "exhaustive" and sid_trie.num_items > exhaustive_max_items:
+        print(f"{sid_trie.num_items} items > exhaustive_max_items={exhaustive_max_items}, falling back to sid_beam")
+        decoder = "sid_beam"
+    beam_schedule = parse_beam_schedule(beam_schedule)
+    if beam_schedule and decoder != "sid_beam":
+        raise ValueError(f"beam_schedule needs the sid_beam decoder, {decoder} keeps one beam width")
+    beam_schedule = tuple(beam_schedule) if beam_schedule else None
     
-    for idx, encodings in enumerate(tqdm(new_encodings)):
-        # Use standard evaluation
-        output = evaluate(encodings, max_new_tokens=max_new_tokens, num_beams=num_beams, length_penalty=length_penalty)
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.pad_token_id = tokenizer.eos_token_id
+    tokenizer.padding_side = "left"
+    
+    # val_dataset = EvalD3Dataset(train_file=test_data_path, tokenizer=tokenizer, max_len=2560, category=category, test=True, K=K, seed=seed)
+    val_dataset = EvalSidDataset(train_file=test_data_path, tokenizer=tokenizer, max_len=2560, category=category, test=True, K=K, seed=seed)
         
-        outputs = outputs + output
-       
-    for i, test in enumerate(test_data):
-        test["predict"] = outputs[i]
-  
+    encodings = [val_dataset[i] for i in range(len(val_dataset))]
+    # encodings = [val_dataset[i] for i in indexes]
+    test_data = val_dataset.get_all()
 
-    for i in range(len(test_data)):
-        if 'dedup' in test_data[i]:
-            test_data[i].pop('dedup')  
-    with open(result_json_data, 'w') as f:
-        json.dump(test_data, f, indent=4)
+    # Predictions are item indices; SIDs (or titles) are only looked up for the human-readable copy
+    item_sids = load_item_sids(info_file)
+    sid2item = item_index(item_sids)
+    item_names = load_item_titles(info_file) if title_constraint else item_sids
+    if exclude_history:
+        # Items the user already interacted with are never recommended again
+        for encoding, history in zip(encodings, val_dataset.data["history_item_sid"]):
+            encoding["excluded"] = [sid2item[sid] for sid in eval(history) if sid in sid2item]
+    excluded = pack_sequences([_["excluded"] for _ in encodings]) if exclude_history else None
+    prefix_ids = common_prefix([_["input_ids"] for _ in encodings]) if shared_prefix else []
+    if prefix_ids:
+        print(f"Shared prompt prefix: {len(prefix_ids)} tokens")
+    options = dict(
+        base_model=base_model, info_file=info_file, num_beams=num_beams, max_new_tokens=max_new_tokens,
+        length_penalty=length_penalty, title_constraint=title_constraint, trie_cache_dir=trie_cache_dir,
+        restrict_vocab=restrict_vocab, decoder=decoder, exhaustive_chunk_size=exhaustive_chunk_size,
+        beam_schedule=beam_schedule, compile_decoder=compile_decoder,
+        prefill_once=prefill_once, prefix_ids=prefix_ids, batch_size=batch_size, max_memory_gb=max_memory_gb,
+        batch_size_cache=batch_size_cache,
+    )
 
-if __name__ == '__main__':
-    fire.Fire(main)
+    def to_record(i, predict):
+        record = dict(test_data[i], target_item=sid2item.get(test_data[i]["output"].strip(' \n"'), -2))
+        record.pop('dedup', None)
+        record["predict_items"] = predict
+        if save_text:
+            record["predict"] = [item_names[j] if j >= 0 else "" for j in predict]
+        return record
 
+    from tqdm import tqdm
+    if checkpoints:
+        # Tokenized test set, trie and batches are shared by the whole sweep, checkpoints only swap weights
+        paths = find_checkpoints(checkpoints)
+        print(f"Evaluating {len(paths)} checkpoints under {checkpoints}, results in {result_json_data}")
+        os.makedirs(result_json_data, exist_ok=True)
+        lengths = [len(_["input_ids"]) for _ in encodings]
+        batches = length_batches(lengths, batch_size=batch_size, max_tokens=max_batch_tokens or None)
+        flat, offsets = pack_sequences([_["input_ids"] for _ in encodings])
+        init_args = (dict(options, auto_batch=auto_batch), flat, offsets, batches, excluded)
+        tasks = [[path] for path in paths]
+        if workers > 1:
+            # Every worker evaluates whole checkpoints
+            runs = run_pool(init_sweep_worker, init_args, tasks, workers)
+        else:
+            evaluate_checkpoint = init_sweep_worker(device, *init_args)
+            runs = ((task, evaluate_checkpoint(task)) for task in tasks)
 
+        table = {}
+        for task, outputs in tqdm(runs, total=len(tasks)):
+            path = os.path.join(result_json_data, f"{os.path.basename(os.path.normpath(task[0]))}.jsonl")
+            with ResultWriter(path) as writer:
+                for i, predict in enumerate(outputs):
+                    writer.write(i, to_record(i, predict))
+            table[task[0]] = result_metrics(path, info_file)
 
+        print_metrics_table("checkpoint", {os.path.basename(os.path.normpath(path)): table[path] for path in paths})
+        with open(os.path.join(result_json_data, "sweep_metrics.json"), "w") as f:
+            json.dump(table, f, indent=4)
+        return
 
+    # Predictions are streamed to a JSONL file; a .json target is written from it at the end
+    stream_path = result_json_data if result_json_data.endswith(".jsonl") else f"{result_json_data}.partial.jsonl"
+    done = completed_indices(stream_path) if resume else set()
+    todo = [i for i in range(len(encodings)) if i not in done]
+    if done:
+        print(f"Resuming: {len(done)} samples already in {stream_path}, {len(todo)} left")
 
+    def stop_value(predict, target):
+        return rank_metric(first_hit(np.array([predict]) == target), stop_metric)[0]
+
+    test = None
+    rounds = [todo]
+    if sequential:
+        # Samples in random order, scored in rounds of check_every, so the run can stop after any round
+        random.Random(seed).shuffle(todo)
+        rounds = [todo[i:i + check_every] for i in range(0, len(todo), check_every)]
+        reference_values = None
+        if reference:
+            ref = Predictions.load(reference, info_file)
+            if len(ref) != len(encodings):
+                raise ValueError(f"{reference} has {len(ref)} samples, the test set {len(encodings)}")
+            reference_values = rank_metric(first_hit(ref.items == ref.targets[:, None]), stop_metric)
+        test = SequentialTest(reference_values, precision=precision, alpha=alpha, min_samples=min_samples)
+        if done:
+            for i, record in iter_results(stream_path):
+                test.update([i], [stop_value(record["predict_items"], record["target_item"])])
+
+    lengths = [len(encodings[i]["input_ids"]) for i in todo]
+    # Batches of similar prompt length, capped by batch_size and optionally by padded tokens
+    batches = [
+        [chunk[j] for j in batch]
+        for chunk in rounds
+        for batch in length_batches(
+            [len(encodings[i]["input_ids"]) for i in chunk], batch_size=batch_size, max_tokens=max_batch_tokens or None
+        )
+    ]
+    if not todo:
+        runs = iter(())
+    elif workers > 1:
+        # Workers pull these batches as they become idle; with auto_batch each one may split its batch further
+        flat, offsets = pack_sequences([_["input_ids"] for _ in encodings])
+        runs = run_pool(init_worker, (dict(options, auto_batch=auto_batch), flat, offsets, excluded), batches, workers)
+    else:
+        evaluator = resident_evaluator(options, auto_batch)
+        if auto_batch and not sequential:
+            runs = (
+                ([todo[j] for j in batch], output)
+                for batch, output in auto_batches(
+                    lengths, lambda batch: evaluator.predict([encodings[todo[j]] for j in batch]), evaluator.sizer,
+                    max_tokens=max_batch_tokens or None,
+                )
+            )
+        else:
+            # Sequential rounds keep their batches; auto_batch then only splits within a batch
+            runs = ((batch, evaluator.run([encodings[i] for i in batch])) for batch in batches)
+
+    next_check = len(test) + check_every if test is not None else 0
+    with ResultWriter(stream_path, resume=resume) as writer, tqdm(total=len(encodings), initial=len(done)) as pbar:
+        for batch, output in runs:
+            for i, predict in zip(batch, output):
+                record = to_record(i, predict)
+                writer.write(i, record)
+                if test is not None:
+                    test.update([i], [stop_value(predict, record["target_item"])])
+            pbar.update(len(batch))
+            if test is not None and len(test) >= next_check:
+                next_check = len(test) + check_every
+                if test.check():
+                    # Closing the generator also shuts the worker pool down
+                    runs.close()
+                    break
+
+    if test is not None:
+        (mean, half), diff = test.bounds()
+        print(f"Scored {len(test)}/{len(encodings)} samples, " + (f"stopped early: {test.reason}" if test.reason else "no early stop"))
+        print(f"{stop_metric}: {mean:.4f} +- {half:.4f}")
+        if diff is not None:
+            print(f"{stop_metric} - reference: {diff[0]:+.4f} +- {diff[1]:.4f}")
+
+    if stream_path != result_json_data:
+        with open(result_json_data, 'w') as f:
+            json.dump(load_results(stream_path), f, indent=4)
+        os.remove(stream_path)
+
+def run_session(session, options):
+    """Evaluate every entry of the JSON list `session` in this process, keeping the model loaded.
+
+    Entries give `category`, `test_data_path` and `info_file`, and may override any other option
+    of `main`. Results default to `<result_json_data>/final_result_<category>.jsonl`.
+    """
+    if options["workers"] > 1 or options["checkpoints"]:
+        raise ValueError("A session evaluates in one process, without --workers or --checkpoints")
+    with open(session) as f:
+        entries = json.load(f)
+    result_dir = options["result_json_data"]
+    os.makedirs(result_dir, exist_ok=True)
+    table = {}
+    for entry in entries:
+        entry = dict(entry)
+        entry.setdefault("result_json_data", os.path.join(result_dir, f"final_result_{entry['category']}.jsonl"))
+        main(**dict(options, **entry))
+        table[entry["category"]] = result_metrics(entry["result_json_data"], entry["info_file"])
+        print_metrics_table("category", {entry["category"]: table[entry["category"]]})
+
+    print_metrics_table("category", table)
+    with open(os.path.join(result_dir, "session_metrics.json"), "w") as f:
+        json.dump(table, f, indent=4)
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
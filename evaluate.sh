@@ -21,73 +21,38 @@ do
         continue
     fi
     
-    temp_dir="./temp/${category}-${exp_name_clean}"
-    echo "Creating temp directory: $temp_dir"
-    mkdir -p "$temp_dir"
-    
-    echo "Splitting test data..."
-    python ./split.py --input_path "$test_file" --output_path "$temp_dir" --cuda_list "0,1,2,3,4,5,6,7"
-    
-    if [[ ! -f "$temp_dir/0.csv" ]]; then
-        echo "Error: Data splitting failed for category $category"
-        continue
-    fi
-    
-    cudalist="0 1 2 3 4 5 6 7"  
-    echo "Starting parallel evaluation (STANDARD MODE)..."
-    for i in ${cudalist}
-    do
-        if [[ -f "$temp_dir/${i}.csv" ]]; then
-            echo "Starting evaluation on GPU $i for category ${category}"
-            CUDA_VISIBLE_DEVICES=$i python -u ./evaluate.py \
-                --base_model "$exp_name" \
-                --info_file "$info_file" \
-                --category ${category} \
-                --test_data_path "$temp_dir/${i}.csv" \
-                --result_json_data "$temp_dir/${i}.json" \
-                --batch_size 8 \
-                --num_beams 50 \
-                --max_new_tokens 256 \
-                --temperature 1.0 \
-                --guidance_scale 1.0 \
-                --length_penalty 0.0 &
-        else
-            echo "Warning: Split file $temp_dir/${i}.csv not found, skipping GPU $i"
-        fi
-    done
-    echo "Waiting for all evaluation processes to complete..."
-    wait
-    
-    result_files=$(ls "$temp_dir"/*.json 2>/dev/null | wc -l)
-    if [[ $result_files -eq 0 ]]; then
-        echo "Error: No result files generated for category $category"
-        continue
-    fi
-    
+    echo "Prebuilding SID trie index..."
+    python ./sid_trie.py --base_model "$exp_name" --info_file "$info_file"
+
     output_dir="./results/${exp_name_clean}"
     echo "Creating output directory: $output_dir"
     mkdir -p "$output_dir"
 
-    actual_cuda_list=$(ls "$temp_dir"/*.json 2>/dev/null | sed 's/.*\///g' | sed 's/\.json//g' | tr '\n' ',' | sed 's/,$//')
-    echo "Merging results from GPUs: $actual_cuda_list"
-    
-    python ./merge.py \
-        --input_path "$temp_dir" \
-        --output_path "$output_dir/final_result_${category}.json" \
-        --cuda_list "$actual_cuda_list"
-    
-    if [[ ! -f "$output_dir/final_result_${category}.json" ]]; then
-        echo "Error: Result merging failed for category $category"
+    echo "Starting parallel evaluation (STANDARD MODE)..."
+    python -u ./evaluate.py \
+        --base_model "$exp_name" \
+        --info_file "$info_file" \
+        --category ${category} \
+        --test_data_path "$test_file" \
+        --result_json_data "$output_dir/final_result_${category}.jsonl" \
+        --workers 8 \
+        --batch_size 8 \
+        --num_beams 50 \
+        --max_new_tokens 256 \
+        --length_penalty 0.0
+
+    if [[ ! -f "$output_dir/final_result_${category}.jsonl" ]]; then
+        echo "Error: Evaluation failed for category $category"
         continue
     fi
     
     echo "Calculating metrics..."
     python ./calc.py \
-        --path "$output_dir/final_result_${category}.json" \
+        --path "$output_dir/final_result_${category}.jsonl" \
         --item_path "$info_file"
     
     echo "Completed processing for category: $category"
-    echo "Results saved to: $output_dir/final_result_${category}.json"
+    echo "Results saved to: $output_dir/final_result_${category}.jsonl"
     echo "----------------------------------------" 
 done
 
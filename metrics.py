@@ -0,0 +1,328 @@
+"""
+Vectorized offline metrics for evaluation results.
+
+A result file is loaded into an `(N, beams)` matrix of item indices (-1 for predictions outside
+the catalog) and an `(N, beams, levels)` tensor of SID codes, so every metric is a few NumPy ops
+whatever the SID depth:
+
+    HR@K / NDCG@K        rank of the first exact hit
+    L<l>@K               some top-K prediction shares level l of the target SID
+    L1..<l>@K            some top-K prediction shares the first l levels of the target SID
+    invalid@K            share of the top-K predictions that are not catalog items
+
+Confidence intervals come from a bootstrap over samples. A per-sample metric takes few distinct
+values, so a bootstrap replicate is drawn as multinomial counts over those values instead of
+resampling all N samples, which keeps millions of samples fast. Several result files
+can be compared in one run; when they cover the same samples the difference to the first file
+gets a paired bootstrap interval. `SequentialTest` tracks a running metric with bounds that
+stay valid under repeated looks, for evaluations that stop early (`evaluate.py --sequential`).
+
+Usage:
+    python metrics.py --paths results/a/final_result_Office_Products.jsonl --info_file ./data/Amazon/info/xxx.txt
+    python metrics.py --paths a.jsonl,b.jsonl --info_file ./data/Amazon/info/xxx.txt --topk 1,5,10
+"""
+
+import re
+from statistics import NormalDist
+
+import fire
+import numpy as np
+
+from result_stream import load_results
+from sid_trie import item_index, load_item_sids
+
+SID_CODE = re.compile(r"<[a-z]_(\d+)>")
+
+
+def parse_sid(sid):
+    """Codes of a semantic ID string, e.g. '<a_223><b_80><c_216>' -> [223, 80, 216]."""
+    return [int(code) for code in SID_CODE.findall(sid)]
+
+
+def sid_codes(sids, levels=None):
+    """`(len(sids), levels)` code matrix, -1 past the depth of each SID (and for empty ones)."""
+    parsed = [parse_sid(sid) for sid in sids]
+    levels = levels or max((len(codes) for codes in parsed), default=0)
+    codes = np.full((len(parsed), levels), -1, dtype=np.int32)
+    for i, row in enumerate(parsed):
+        codes[i, :len(row)] = row[:levels]
+    return codes
+
+
+def _is_sid(text):
+    return bool(text) and SID_CODE.sub("", text) == ""
+
+
+def _strip(text):
+    return text.strip(' "\n')
+
+
+def _matrix(rows, fill=-1, dtype=np.int64):
+    """Rows of unequal length as a matrix padded with `fill`."""
+    width = max((len(row) for row in rows), default=0)
+    out = np.full((len(rows), width), fill, dtype=dtype)
+    for i, row in enumerate(rows):
+        out[i, :len(row)] = row
+    return out
+
+
+class Predictions:
+    """Predictions of one result file as index arrays.
+
+    Attributes:
+        items: `(N, beams)` predicted item indices, -1 for predictions outside the catalog.
+        targets: `(N,)` target item indices, -2 for targets outside the catalog.
+        codes: `(N, beams, levels)` SID codes of the predictions, -1 for invalid ones.
+        target_codes: `(N, levels)` SID codes of the targets.
+    """
+
+    def __init__(self, items, targets, codes, target_codes):
+        self.items = items
+        self.targets = targets
+        self.codes = codes
+        self.target_codes = target_codes
+
+    def __len__(self):
+        return len(self.targets)
+
+    @property
+    def num_beams(self):
+        return self.items.shape[1]
+
+    @property
+    def num_levels(self):
+        return self.codes.shape[2]
+
+    def select(self, index):
+        """Predictions of the samples picked by `index` (mask or indices)."""
+        return Predictions(self.items[index], self.targets[index], self.codes[index], self.target_codes[index])
+
+    @classmethod
+    def load(cls, path, info_file=None):
+        """Read a result file written by `evaluate.py` (JSONL stream or legacy JSON list).
+
+        With `info_file`, items are catalog indices and SID codes come from the catalog. Without
+        it, results must carry the predicted SID strings, items are indexed by distinct SID and a
+        prediction is invalid when it does not parse as a SID.
+        """
+        data = load_results(path)
+        target_sids = [_strip(sample["output"][0] if isinstance(sample["output"], list) else sample["output"])
+                       for sample in data]
+        if info_file is not None:
+            catalog = load_item_sids(info_file)
+            sid2item = item_index(catalog)
+            if "predict_items" in data[0]:
+                items = _matrix([sample["predict_items"] for sample in data])
+            else:
+                items = _matrix([[sid2item.get(_strip(p), -1) for p in sample["predict"]] for sample in data])
+            targets = np.array([sid2item.get(sid, -2) for sid in target_sids], dtype=np.int64)
+            catalog_codes = sid_codes(catalog)
+            target_codes = sid_codes(target_sids, levels=catalog_codes.shape[1])
+        else:
+            if "predict" not in data[0]:
+                raise ValueError(f"{path} only stores item indices, pass --info_file to map them to SIDs")
+            predicted = _matrix([[_strip(p) for p in sample["predict"]] for sample in data], fill="", dtype=object)
+            # Items are indices into the distinct strings, shared with the targets
+            names, inverse = np.unique(
+                np.concatenate([predicted.ravel(), np.array(target_sids, dtype=object)]), return_inverse=True
+            )
+            valid = np.array([_is_sid(name) for name in names], dtype=bool)[inverse]
+            inverse = np.where(valid, inverse, -1)
+            items = inverse[:predicted.size].reshape(predicted.shape)
+            targets = np.where(inverse[predicted.size:] >= 0, inverse[predicted.size:], -2)
+            catalog_codes = sid_codes(names.tolist())
+            target_codes = sid_codes(target_sids, levels=catalog_codes.shape[1])
+        codes = catalog_codes[items.clip(min=0)]
+        codes[items < 0] = -1
+        return cls(items, targets, codes, target_codes)
+
+
+def first_hit(matches):
+    """Rank of the first True of every row of `matches` (N, beams), `beams` when there is none."""
+    rank = matches.argmax(axis=1)
+    return np.where(matches.any(axis=1), rank, matches.shape[1])
+
+
+def rank_metric(rank, name):
+    """Per-sample `HR@K` or `NDCG@K` from the rank of the first exact hit."""
+    kind, _, k = name.partition("@")
+    if kind == "HR":
+        return (rank < int(k)).astype(np.float64)
+    if kind == "NDCG":
+        return np.where(rank < int(k), 1.0 / np.log2(rank + 2.0), 0.0)
+    raise ValueError(f"Unknown ranking metric {name}, expected HR@K or NDCG@K")
+
+
+def per_sample_metrics(predictions, topk=(1, 3, 5, 10, 20, 50)):
+    """Per-sample metric values.
+
+    Returns:
+        names: metric names.
+        values: `(N, len(names))` float matrix, the mean of a column is the metric.
+    """
+    topk = [k for k in topk if k <= predictions.num_beams]
+    names, columns = [], []
+
+    rank = first_hit(predictions.items == predictions.targets[:, None])
+    for kind in ("HR", "NDCG"):
+        for k in topk:
+            names.append(f"{kind}@{k}")
+            columns.append(rank_metric(rank, names[-1]))
+
+    # Targets without a SID at some level can never match there
+    target_codes = predictions.target_codes[:, None, :]
+    level_match = (predictions.codes == target_codes) & (target_codes >= 0)
+    prefix_match = np.logical_and.accumulate(level_match, axis=2)
+    levels = predictions.num_levels
+    level_rank = np.stack([first_hit(level_match[:, :, l]) for l in range(levels)], axis=1)
+    prefix_rank = np.stack([first_hit(prefix_match[:, :, l]) for l in range(levels)], axis=1)
+    for l in range(levels):
+        for k in topk:
+            names.append(f"L{l + 1}@{k}")
+            columns.append(level_rank[:, l] < k)
+    for l in range(1, levels):
+        for k in topk:
+            names.append(f"L1..{l + 1}@{k}")
+            columns.append(prefix_rank[:, l] < k)
+
+    invalid = np.cumsum(predictions.items < 0, axis=1)
+    for k in topk:
+        names.append(f"invalid@{k}")
+        columns.append(invalid[:, k - 1] / k)
+    return names, np.stack(columns, axis=1).astype(np.float64)
+
+
+def bootstrap_ci(values, n_boot=1000, alpha=0.05, seed=0):
+    """Percentile bootstrap interval of the column means of `values` (N, M).
+
+    Every column takes few distinct values, so a replicate of its mean is drawn as multinomial
+    counts over those values, equivalent to resampling the N samples with replacement.
+    """
+    rng = np.random.default_rng(seed)
+    low, high = np.empty(values.shape[1]), np.empty(values.shape[1])
+    for m in range(values.shape[1]):
+        distinct, counts = np.unique(values[:, m], return_counts=True)
+        means = rng.multinomial(len(values), counts / len(values), size=n_boot) @ distinct / len(values)
+        low[m], high[m] = np.quantile(means, [alpha / 2, 1 - alpha / 2])
+    return low, high
+
+
+class SequentialTest:
+    """Running mean of a per-sample metric in [0, 1], with bounds that stay valid under repeated looks.
+
+    The j-th look uses a normal interval at level `alpha / (j * (j + 1))`, which sums to `alpha`
+    over any number of looks, so checking after every round does not inflate the error rate.
+    Looks only start once `min_samples` samples are in.
+
+    Args:
+        reference: per-sample values of the same metric for a reference run over the same test
+            set, indexed by sample index. The test stops once the paired difference is separated
+            from zero.
+        precision: stop once the interval half-width of the mean is at most this, 0 to disable.
+    """
+
+    def __init__(self, reference=None, precision=0.0, alpha=0.05, min_samples=512):
+        self.reference = reference
+        self.precision = precision
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.indices = []
+        self.values = []
+        self.looks = 0
+        self.reason = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def update(self, indices, values):
+        self.indices.extend(indices)
+        self.values.extend(values)
+
+    def _interval(self, values, z):
+        mean = float(np.mean(values))
+        half = z * float(np.std(values, ddof=1)) / np.sqrt(len(values)) if len(values) > 1 else float("inf")
+        return mean, half
+
+    def bounds(self):
+        """`(mean, half_width)` of the metric and, with a reference, of the paired difference."""
+        alpha = self.alpha / (max(self.looks, 1) * (max(self.looks, 1) + 1))
+        z = NormalDist().inv_cdf(1 - alpha / 2)
+        values = np.asarray(self.values, dtype=np.float64)
+        diff = None
+        if self.reference is not None:
+            diff = self._interval(values - self.reference[np.asarray(self.indices)], z)
+        return self._interval(values, z), diff
+
+    def check(self):
+        """Look at the data so far; returns the stopping reason, or None to keep going."""
+        if len(self) < self.min_samples:
+            return None
+        self.looks += 1
+        (mean, half), diff = self.bounds()
+        if diff is not None and abs(diff[0]) > diff[1]:
+            self.reason = "separated from the reference"
+        elif self.precision and half <= self.precision:
+            self.reason = "precision target reached"
+        return self.reason
+
+
+def _as_list(value):
+    if isinstance(value, str):
+        return [v for v in value.split(",") if v]
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def main(paths, info_file=None, topk="1,3,5,10,20,50", n_boot=1000, alpha=0.05, seed=0):
+    """Print every metric of every result file with bootstrap confidence intervals.
+
+    Args:
+        paths: one result file or several, comma separated.
+        info_file: catalog the results were produced against, needed for results that only store
+            item indices and for the invalid-item rates.
+        topk: cut-offs.
+        n_boot: bootstrap replicates, 0 to skip the intervals.
+        alpha: 1 - confidence level of the intervals.
+    """
+    paths = _as_list(paths)
+    topk = [int(k) for k in _as_list(topk)]
+    results = []
+    for path in paths:
+        predictions = Predictions.load(path, info_file)
+        names, values = per_sample_metrics(predictions, topk)
+        results.append((names, values))
+        print(f"{path}: {len(predictions)} samples, {predictions.num_beams} beams, "
+              f"{predictions.num_levels} SID levels")
+
+    names = results[0][0]
+    for other, _ in results[1:]:
+        if other != names:
+            raise ValueError("Result files differ in beams or SID depth, compare them with a common --topk")
+    paired = len(results) > 1 and all(len(values) == len(results[0][1]) for _, values in results)
+
+    columns = []
+    for i, (_, values) in enumerate(results):
+        mean = values.mean(axis=0)
+        low, high = bootstrap_ci(values, n_boot, alpha, seed) if n_boot else (mean, mean)
+        columns.append((f"[{i}]", mean, low, high))
+        if paired and i > 0:
+            diff = values - results[0][1]
+            mean = diff.mean(axis=0)
+            low, high = bootstrap_ci(diff, n_boot, alpha, seed) if n_boot else (mean, mean)
+            columns.append((f"[{i}]-[0]", mean, low, high))
+
+    print(f"\nmean [{100 * (1 - alpha):g}% bootstrap CI]" if n_boot else "\nmean")
+    for i, path in enumerate(paths):
+        print(f"  [{i}] {path}")
+    width = 28 if n_boot else 10
+    print(f"{'metric':>12s} | " + " | ".join(f"{title:>{width}s}" for title, *_ in columns))
+    for m, name in enumerate(names):
+        cells = []
+        for _, mean, low, high in columns:
+            cells.append(f"{mean[m]:8.4f} [{low[m]:7.4f}, {high[m]:7.4f}]" if n_boot else f"{mean[m]:{width}.4f}")
+        print(f"{name:>12s} | " + " | ".join(f"{cell:>{width}s}" for cell in cells))
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
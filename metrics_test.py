@@ -0,0 +1,84 @@
+import unittest
+import tempfile
+import contextlib
+import io
+import json
+import math
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import calc
+from metrics import Predictions, per_sample_metrics
+from result_stream import ResultWriter
+
+CATALOG = ["<a_1><b_1><c_1>", "<a_1><b_2><c_1>", "<a_2><b_1><c_3>", "<a_3><b_3><c_3>"]
+# Hits at rank 1 for the first two samples, none for the last; CC counts the invalid
+# predictions before the hit: 0 + 1 + 2
+RESULTS = [
+    {"output": "<a_1><b_1><c_1>\n", "predict": ["<a_1><b_2><c_1>", "<a_1><b_1><c_1>", "<a_2><b_1><c_3>"]},
+    {"output": "<a_2><b_1><c_3>\n", "predict": ["<a_9>", "<a_2><b_1><c_3>", "bad"]},
+    {"output": "<a_3><b_3><c_3>\n", "predict": ["x", "<a_1><b_1><c_1>", "<a_3><b_3>"]},
+]
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.info_file = os.path.join(self.tmp.name, "info.txt")
+        with open(self.info_file, "w") as f:
+            for i, sid in enumerate(CATALOG):
+                f.write(f"{sid}\titem {i}\t{i}\n")
+        self.result_file = os.path.join(self.tmp.name, "result.json")
+        with open(self.result_file, "w") as f:
+            json.dump(RESULTS, f)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_load(self):
+        predictions = Predictions.load(self.result_file, self.info_file)
+        self.assertEqual(predictions.items.tolist(), [[1, 0, 2], [-1, 2, -1], [-1, 0, -1]])
+        self.assertEqual(predictions.targets.tolist(), [0, 2, 3])
+        self.assertEqual(predictions.codes[0, 2].tolist(), [2, 1, 3])
+        self.assertTrue((predictions.codes[1, 0] == -1).all())
+
+    def test_per_sample_metrics(self):
+        names, values = per_sample_metrics(Predictions.load(self.result_file, self.info_file), topk=(1, 3))
+        mean = dict(zip(names, values.mean(axis=0)))
+        self.assertEqual(mean["HR@1"], 0.0)
+        self.assertAlmostEqual(mean["HR@3"], 2 / 3)
+        self.assertAlmostEqual(mean["NDCG@3"], 2 / 3 / math.log2(3))
+        # <a_1> of the first prediction matches the first target, <a_3> of the last does not parse
+        self.assertAlmostEqual(mean["L1@1"], 1 / 3)
+        self.assertAlmostEqual(mean["L1..2@3"], 2 / 3)
+        self.assertAlmostEqual(mean["invalid@3"], (0 + 2 + 2) / 9)
+        self.assertNotIn("HR@5", names)
+
+    def test_calc_matches_old_numbers(self):
+        """calc.py prints what it printed before the metrics rewrite, CC summed over the files"""
+        stream_file = os.path.join(self.tmp.name, "result.jsonl")
+        with ResultWriter(stream_file) as writer:
+            for index in reversed(range(len(RESULTS))):
+                writer.write(index, RESULTS[index])
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            calc.gao([self.result_file, stream_file], self.info_file)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 10)
+        for first in (0, 5):
+            n_beam, topk, ndcg, hr, _ = lines[first:first + 5]
+            self.assertEqual(n_beam, "3")
+            self.assertEqual(topk, "[1, 3]")
+            np.testing.assert_allclose(
+                np.fromstring(ndcg.split("[")[1].rstrip("]"), sep=" "), [0.0, 0.42061984], atol=1e-8
+            )
+            np.testing.assert_allclose(np.fromstring(hr.split("[")[1].rstrip("]"), sep=" "), [0.0, 2 / 3])
+        self.assertEqual([lines[4], lines[9]], ["3", "6"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,6 +17,7 @@ import re
 import textwrap
 import warnings
 from collections import defaultdict
+from contextlib import nullcontext
 from typing import Any, Callable, Optional, Sized, Union
 from unittest.mock import patch
 
@@ -62,6 +63,12 @@ from transformers import (
     )
 
 from LogitProcessor import ConstrainedLogitsProcessor
+from sid_trie import load_item_sids, load_or_build_sid_trie
+from sid_decoding import (
+    SIDBeamSearch, SharedPrefixCache, common_prefix, grouped_completion_logits, hidden_states_head,
+    kv_cache_enabled, prefill_cache, token_logps,
+)
+from ref_logp_cache import RefLogpCache, prompt_digest, weights_fingerprint
 from transformers.generation import LogitsProcessor
 import math
 
@@ -119,6 +126,22 @@ class RepeatRandomSampler(Sampler):
         return self.num_samples * self.repeat_count
 
 
+class RefLogpCacheCallback(TrainerCallback):
+    """Empties the reference log-prob cache whenever `SyncRefModelCallback` updates the reference model.
+
+    The on-disk tier is tagged with `namespace` and the sync step, so a resumed run, whose reference
+    model is reloaded from the initial weights, does not read values of a synced one.
+    """
+
+    def __init__(self, cache: RefLogpCache, namespace: str):
+        self.cache = cache
+        self.namespace = namespace
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if state.global_step % args.ref_model_sync_steps == 0:
+            self.cache.clear(namespace=f"{self.namespace}|sync{state.global_step}")
+
+
 class ReReTrainer(Trainer):
     """
     Trainer for the Group Relative Policy Optimization (GRPO) method adapted to recommendation. This algorithm was initially proposed in the
@@ -224,6 +247,7 @@ class ReReTrainer(Trainer):
         #* eval
         test_during_training: bool = True,
         test_beam: int = 20,
+        test_beam_schedule: Optional[list[int]] = None,
 
         #*loss
         dapo: bool = False,
@@ -231,6 +255,13 @@ class ReReTrainer(Trainer):
         sibling_grpo: bool = False,
         sibling_alpha: float = 0.5,
 
+        #* reference log-prob cache
+        ref_logp_cache_size: int = 0,
+        ref_logp_cache_dir: Optional[str] = None,
+        grouped_forward: bool = False,
+        logps_chunk_size: int = 0,
+        sid_logps: bool = False,
+
         #* others
         info_file: str = None,
         # logits_processor: Optional[LogitsProcessor] = None,
@@ -249,6 +280,12 @@ class ReReTrainer(Trainer):
             model_name = model if isinstance(model, str) else model.config._name_or_path
             model_name = model_name.split("/")[-1]
             args = GRPOConfig(f"{model_name}-GRPO")
+        if (logps_chunk_size > 0 or sid_logps) and is_deepspeed_zero3_enabled():
+            # `token_logps` projects against `lm_head.weight`, which ZeRO-3 partitions across ranks
+            raise ValueError("`logps_chunk_size` and `sid_logps` are not supported with DeepSpeed ZeRO-3")
+        if ref_logp_cache_size > 0 and is_deepspeed_zero3_enabled():
+            # Ranks skip the reference forward on cache hits, while ZeRO-3 gathers every layer from all of them
+            raise ValueError("`ref_logp_cache_size` and `ref_logp_cache_dir` are not supported with DeepSpeed ZeRO-3")
 
         # Models
         # Trained model
@@ -388,11 +425,15 @@ class ReReTrainer(Trainer):
         self.length_penalty = length_penalty
         self.test_during_training = test_during_training
         self.test_beam = test_beam
+        self.test_beam_schedule = test_beam_schedule
         self.dynamic_sampling = dynamic_sampling
         self.dapo = dapo
         self.gspo = gspo
         self.sibling_grpo = sibling_grpo
         self.sibling_alpha = sibling_alpha
+        self.grouped_forward = grouped_forward
+        self.logps_chunk_size = logps_chunk_size
+        self.sid_logps = sid_logps
         # self.logits_processor = logits_processor
 
         # Check if the per_device_train/eval_batch_size * num processes can be divided by the number of generations
@@ -522,78 +563,116 @@ class ReReTrainer(Trainer):
             else:
                 self.ref_model = self.accelerator.prepare_model(self.ref_model, evaluation_mode=True)
 
+        # Reference log-probs of (prompt, item) pairs seen before, valid until the reference model changes
+        self.ref_logp_cache = None
+        self._ref_num_params = None
+        if ref_logp_cache_size > 0:
+            # Names the reference weights, so the on-disk tier is not read under other ones
+            ref_namespace = "|".join([
+                weights_fingerprint(model_id, self.ref_model if self.ref_model is not None else model),
+                str(model.dtype), "sid_logps" if sid_logps else "full_logps",
+            ])
+            self.ref_logp_cache = RefLogpCache(
+                ref_logp_cache_size, cache_dir=ref_logp_cache_dir,
+                namespace=f"{ref_namespace}|sync0" if args.sync_ref_model else ref_namespace,
+                rank=self.accelerator.process_index,
+            )
+
         if args.sync_ref_model:
             # print("Sync Begin")
             self.add_callback(SyncRefModelCallback(ref_model=self.ref_model, accelerator=self.accelerator))
+            if self.ref_logp_cache is not None:
+                self.add_callback(RefLogpCacheCallback(self.ref_logp_cache, ref_namespace))
 
         for i, reward_func in enumerate(self.reward_funcs):
             if isinstance(reward_func, PreTrainedModel):
                 self.reward_funcs[i] = self.accelerator.prepare_model(reward_func, evaluation_mode=True)
 
         
-        with open(self.info_file, 'r') as f:
-            info = f.readlines()
-            # Parse new format: semantic_id \t item_title \t item_id
-            semantic_ids = [line.split('\t')[0].strip() + "\n" for line in info]
-            item_titles = [line.split('\t')[1].strip() + "\n" for line in info if len(line.split('\t')) >= 2]
-            
-            # Format for tokenization
-            info_semantic = [f'''### Response:\n{_}''' for _ in semantic_ids]
-            info_titles = [f'''### Response:\n{_}''' for _ in item_titles]
+        tokenizer = AutoTokenizer.from_pretrained(self.base_model)
+        # The main process builds the on-disk index on a cache miss, the other ranks then map it. Decoders
+        # use the trie as given, so it is moved to the device once here.
+        with self.accelerator.main_process_first():
+            self.sid_trie = load_or_build_sid_trie(self.info_file, tokenizer, self.base_model)
+        self.sid_trie = self.sid_trie.to(self.accelerator.device)
+        self.item_sids = load_item_sids(self.info_file)
+        self.sid2item = dict()
+        for index, sid in enumerate(self.item_sids):
+            self.sid2item.setdefault(sid, index)
+
+        # Token prefix shared by the rollout prompts. Its KV cache is encoded once per policy update
+        # and reused by every generation of that step.
+        self.shared_prefix_ids = []
+        if train_dataset is not None and not isinstance(train_dataset, IterableDataset):
+            sample = [
+                maybe_apply_chat_template(train_dataset[i], processing_class)["prompt"]
+                for i in range(min(len(train_dataset), 1000))
+            ]
+            self.shared_prefix_ids = common_prefix(
+                processing_class(sample, add_special_tokens=False)["input_ids"]
+            )
+        self._prefix_cache = None
+        self._prefix_cache_step = -1
 
-            info = info_semantic
+    def _shared_prefix_cache(self, model):
+        if len(self.shared_prefix_ids) == 0:
+            return None
+        if (
+            self._prefix_cache is None
+            or self._prefix_cache.model is not model
+            or self._prefix_cache_step != self.state.global_step
+        ):
+            self._prefix_cache = SharedPrefixCache(model, self.shared_prefix_ids)
+            self._prefix_cache_step = self.state.global_step
+        return self._prefix_cache
 
-        # with open(self.info_file, 'r') as f:
-        #     info = f.readlines()
-        #     info = ["\"" + _[:-len(_.split('\t')[-1])].strip() + "\"\n" for _ in info]
-        #     info = [f'''### Response:\n{_}''' for _ in info]
+    def _generate(self, model, prompt_ids, prompt_mask):
+        """`generate` with the prompts encoded once, on top of the shared prefix cache.
+
+        Gradient checkpointing, which disables the KV cache in training mode, is turned off meanwhile.
+        Returns the prompts (repeated per returned sequence) followed by the completions, like `generate`.
+        """
+        config = self.generation_config
+        expand = config.num_beams if config.num_beams > 1 else config.num_return_sequences
+        with kv_cache_enabled(model):
+            cache, input_ids, attention_mask = prefill_cache(
+                model, prompt_ids, prompt_mask, expand, self._shared_prefix_cache(model)
+            )
+            completion_ids = model.generate(
+                input_ids, attention_mask=attention_mask, generation_config=config,
+                logits_processor=self.logits_processor, past_key_values=cache, use_cache=True,
+            )[:, input_ids.size(1):]
+        prompt_ids = prompt_ids.repeat_interleave(completion_ids.size(0) // prompt_ids.size(0), dim=0)
+        return torch.cat([prompt_ids, completion_ids], dim=1)
+
+    def test_search(self, model, prompt_ids, prompt_mask):
+        with kv_cache_enabled(model):
+            search = SIDBeamSearch(
+                model, self.sid_trie, self.test_beam, length_penalty=self.length_penalty, restrict_vocab=False,
+                prefix_cache=self._shared_prefix_cache(model), beam_schedule=self.test_beam_schedule,
+            )
+            return search(prompt_ids, prompt_mask)
+
+    def _decode_completions(self, completion_ids):
+        """Completion texts, looked up from the trie leaf of every constrained completion.
+
+        Only rows that do not end on an item (e.g. cut off by `max_completion_length`, or ground
+        truth added with special tokens) go through the tokenizer.
+        """
+        items = self.sid_trie.completion_items(completion_ids).tolist()
+        texts = [self.item_sids[item] + "\n" if item >= 0 else None for item in items]
+        rows = [i for i, text in enumerate(texts) if text is None]
+        if rows:
+            if self.base_model.lower().find("llama") > -1:
+                decoded = self.processing_class.batch_decode(
+                    completion_ids[rows], skip_special_tokens=True, clean_up_tokenization_spaces=False
+                )
+            else:
+                decoded = self.processing_class.batch_decode(completion_ids[rows], skip_special_tokens=True)
+            for i, text in zip(rows, decoded):
+                texts[i] = text
+        return texts
 
-        tokenizer = AutoTokenizer.from_pretrained(self.base_model)
-        if self.base_model.lower().find("llama") > -1: 
-            prefixID = [tokenizer(_).input_ids[1:] for _ in info]
-        else:
-            prefixID = [tokenizer(_).input_ids for _ in info]
-        
-        if self.base_model.lower().find("gpt2") > -1:
-            prefix_index = 4
-        else:
-            prefix_index = 3
-            
-        self.hash_dict = dict()
-        # sasrec_dict = dict()
-        for index, ID in enumerate(prefixID):
-            ID.append(tokenizer.eos_token_id)
-            for i in range(prefix_index, len(ID)):
-                if i == prefix_index:
-                    hash_number = self.get_hash(ID[:i])
-                else:
-                    hash_number = self.get_hash(ID[prefix_index:i])
-                if hash_number not in self.hash_dict:
-                    self.hash_dict[hash_number] = set()
-                    # sasrec_dict[hash_number] = set()
-                self.hash_dict[hash_number].add(ID[i])
-
-        for key in self.hash_dict.keys():
-            self.hash_dict[key] = list(self.hash_dict[key])
-
-        self.test_generation_config = GenerationConfig(max_new_tokens=self.max_completion_length,
-                                                            length_penalty=self.length_penalty,
-                                                            num_beams=self.test_beam,
-                                                            num_return_sequences=self.test_beam,
-                                                            do_sample=False,
-                                                            pad_token_id=self.processing_class.pad_token_id,
-                                                            eos_token_id=self.processing_class.eos_token_id,)
-
-    def get_hash(self, x):
-            x = [str(_) for _ in x]
-            return '-'.join(x)
-
-    def prefix_allowed_tokens_fn(self, batch_id, input_ids):
-            hash_number = self.get_hash(input_ids)
-            if hash_number in self.hash_dict:
-                return self.hash_dict[hash_number]
-            return []
-    
     def _set_signature_columns_if_needed(self):
         # If `self.args.remove_unused_columns` is True, non-signature columns are removed.
         # By default, this method sets `self._signature_columns` to the model's expected inputs.
@@ -628,16 +707,99 @@ class ReReTrainer(Trainer):
 
     # Get the per-token log probabilities for the completions for the model and the reference model
     def _get_per_token_logps(self, model, input_ids, attention_mask, logits_to_keep):
-        # We add 1 to `logits_to_keep` because the last logits of the sequence is later excluded
-        logits = model(input_ids=input_ids, attention_mask=attention_mask, logits_to_keep=logits_to_keep + 1).logits
-        logits = logits[:, :-1, :]  # (B, L-1, V), exclude the last logit: it corresponds to the next token pred
+        # With `logps_chunk_size` or `sid_logps` the model returns final hidden states, projected in `token_logps`
+        projected = self.logps_chunk_size > 0 or self.sid_logps
+        with hidden_states_head(self.accelerator.unwrap_model(model)) if projected else nullcontext() as lm_head:
+            if self._prompts_grouped(model, input_ids, attention_mask, logits_to_keep):
+                # Every prompt is encoded once and shared by the completions of its group
+                logits = grouped_completion_logits(
+                    model, input_ids, attention_mask, logits_to_keep, self.num_generations
+                )
+            else:
+                # We add 1 to `logits_to_keep` because the last logits of the sequence is later excluded
+                logits = model(
+                    input_ids=input_ids, attention_mask=attention_mask, logits_to_keep=logits_to_keep + 1
+                ).logits
+                logits = logits[:, :-1, :]  # (B, L-1, V), exclude the last logit: it corresponds to the next token pred
 
         input_ids = input_ids[:, -logits_to_keep:]
         # For transformers<=4.48, logits_to_keep argument isn't supported, so here we drop logits ourselves.
         # See https://github.com/huggingface/trl/issues/2770
         logits = logits[:, -logits_to_keep:]
+        if projected:
+            return token_logps(
+                logits, lm_head, input_ids, vocab_ids=self.sid_trie.vocab_ids if self.sid_logps else None,
+                chunk_size=self.logps_chunk_size,
+            )
         return selective_log_softmax(logits, input_ids)  #  compute logprobs for the input tokens
 
+    def _prompts_grouped(self, model, input_ids, attention_mask, logits_to_keep):
+        """Whether `grouped_forward` applies: consecutive groups of `num_generations` rows share their prompt."""
+        G = self.num_generations
+        if not self.grouped_forward or G < 2 or input_ids.size(0) % G or logits_to_keep >= input_ids.size(1):
+            return False
+        # Gradient checkpointing turns the KV cache off in training mode, with or without grad
+        unwrapped = self.accelerator.unwrap_model(model)
+        if unwrapped.training and getattr(unwrapped, "is_gradient_checkpointing", False):
+            return False
+        P = input_ids.size(1) - logits_to_keep
+        prompts = torch.cat([input_ids[:, :P], attention_mask[:, :P]], dim=1).view(-1, G, 2 * P)
+        return bool((prompts == prompts[:, :1]).all())
+
+    def _ref_per_token_logps(self, input_ids, attention_mask, logits_to_keep):
+        if self.ref_model is not None:
+            return self._get_per_token_logps(self.ref_model, input_ids, attention_mask, logits_to_keep)
+        with self.accelerator.unwrap_model(self.model).disable_adapter():
+            return self._get_per_token_logps(self.model, input_ids, attention_mask, logits_to_keep)
+
+    def _cached_ref_per_token_logps(self, input_ids, attention_mask, completion_mask, logits_to_keep):
+        """Reference log-probs with the rows found in `ref_logp_cache` served from it.
+
+        Only completions that spell a catalog item are cached, the others are always recomputed.
+        Rows repeating a (prompt, item) pair of the same batch are forwarded once. Logs the share
+        of rows not forwarded and the forward FLOPs saved (2 x parameters x tokens) to `_metrics`.
+        """
+        cache = self.ref_logp_cache
+        prompt_length = input_ids.size(1) - logits_to_keep
+        items = self.sid_trie.completion_items(input_ids[:, prompt_length:]).tolist()
+        lengths = completion_mask.sum(dim=1).tolist()
+        prompt_ids, prompt_mask = input_ids[:, :prompt_length].cpu(), attention_mask[:, :prompt_length].bool().cpu()
+
+        ref_per_token_logps = torch.zeros(input_ids.size(0), logits_to_keep, device=input_ids.device)
+        keys, forward, first = [None] * len(items), [], {}
+        for row, item in enumerate(items):
+            if item < 0:
+                forward.append(row)
+                continue
+            key = keys[row] = (prompt_digest(prompt_ids[row][prompt_mask[row]]), item)
+            logps = cache.get(key)
+            if logps is not None:
+                ref_per_token_logps[row, :logps.numel()] = logps.to(input_ids.device)
+            elif key not in first:
+                first[key] = row
+                forward.append(row)
+
+        if forward:
+            logps = self._ref_per_token_logps(input_ids[forward], attention_mask[forward], logits_to_keep)
+            ref_per_token_logps[forward] = logps.float()
+            for row in forward:
+                if keys[row] is not None:
+                    cache.put(keys[row], ref_per_token_logps[row, :lengths[row]])
+            cache.commit()
+        for row, key in enumerate(keys):
+            if key in first and first[key] != row:
+                ref_per_token_logps[row] = ref_per_token_logps[first[key]]
+
+        if self._ref_num_params is None:
+            model = self.ref_model if self.ref_model is not None else self.model
+            self._ref_num_params = sum(getattr(p, "ds_numel", p.numel()) for p in model.parameters())
+        forwarded = set(forward)
+        saved = [row for row in range(len(items)) if row not in forwarded]
+        saved_tokens = attention_mask[saved].sum().item() if saved else 0
+        self._metrics["ref_cache/hit_rate"].append(len(saved) / len(items))
+        self._metrics["ref_cache/saved_tflops"].append(2 * self._ref_num_params * saved_tokens / 1e12)
+        return ref_per_token_logps
+
     def _move_model_to_vllm(self):
         with unwrap_model_for_generation(
             self.model, self.accelerator, gather_deepspeed3_params=self.args.ds3_gather_for_generation
@@ -692,15 +854,15 @@ class ReReTrainer(Trainer):
         ccc = ConstrainedLogitsProcessor(
                 # guidance_scale=1.0,
                 # cf_logits=None,
-                prefix_allowed_tokens_fn=self.prefix_allowed_tokens_fn,
                 # cf_dict=sasrec_dict,
                 # unconditional_ids=None,
                 num_beams=self.num_generations if self.beam_search else 1,
                 base_model=self.base_model,
-                eos_token_id=self.processing_class.eos_token_id
+                eos_token_id=self.processing_class.eos_token_id,
+                trie=self.sid_trie,
+                use_cursor=True,
             )
         self.logits_processor = LogitsProcessorList([TemperatureLogitsWarper(temperature=self.temperature), ccc])
-        self.test_lp_list = LogitsProcessorList([ccc])
 
         # Generate completions using either vLLM or regular generation
         if self.args.use_vllm:
@@ -737,47 +899,20 @@ class ReReTrainer(Trainer):
                 hr = [0, 0, 0, 0]
 
                 if self.test_during_training:
-                    dedup_prompt = []
-                    dedup_mask = []
-                    dedup_target = []
-
-                    for i in range(len(prompt_ids)):
-                        if i % self.num_generations == 0:
-                            dedup_prompt.append(prompt_ids[i])
-                            dedup_mask.append(prompt_mask[i])
-                            dedup_target.append(targets[i])
-                    
-                    dedup_prompt_ids = torch.stack(dedup_prompt).to(device)
-                    dedup_prompt_mask = torch.stack(dedup_mask).to(device)
-                    # print(f"dedup_prompt_ids: {dedup_prompt_ids.shape}")
-                
-                    # print(f"test_beam: {self.test_beam}")
-                    with torch.no_grad():
-                        test_completion_ids = unwrapped_model.generate(
-                            dedup_prompt_ids, attention_mask=dedup_prompt_mask, generation_config=self.test_generation_config,
-                            logits_processor=self.test_lp_list,
-                        )
-                    
-                    # print(f"test_completion_ids: {test_completion_ids.shape}")
-                    if self.base_model.lower().find("llama")>-1:
-                        test_completions = self.processing_class.batch_decode(test_completion_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-                    else:
-                        test_completions = self.processing_class.batch_decode(test_completion_ids, skip_special_tokens=True)
-                    test_completions = [_.split("Response:\n")[-1] for _ in test_completions]
-                    test_comp_lis = [test_completions[i:i+self.test_beam] for i in range(0, len(test_completions), self.test_beam)]
-                    for i, comp_lis in enumerate(test_comp_lis):
-                        target = dedup_target[i]
-                        for j in range(len(comp_lis)):
-                            if comp_lis[j].strip("\n\"") == target.strip("\n\""):
-                                for index, k in enumerate(topk):
-                                    if j < k:
-                                        hr[index] += 1
-                                        ndcg[index] += 1 / math.log2(j+2) 
-                                break
-                    hr = [elm/len(dedup_target) for elm in hr]
-                    ndcg = [elm/len(dedup_target) for elm in ndcg]
-
-               
+                    dedup_prompt_ids = prompt_ids[::self.num_generations].to(device)
+                    dedup_prompt_mask = prompt_mask[::self.num_generations].to(device)
+                    dedup_target = targets[::self.num_generations]
+
+                    # Fixed-depth trie beam search returns catalog item indices directly
+                    test_items = self.test_search(unwrapped_model, dedup_prompt_ids, dedup_prompt_mask).item_ids
+                    target_items = torch.tensor(
+                        [self.sid2item.get(target.strip("\n\""), -2) for target in dedup_target], device=device
+                    )
+                    is_hit = test_items == target_items.unsqueeze(1)
+                    rank = torch.where(is_hit.any(dim=1), is_hit.int().argmax(dim=1), test_items.size(1))
+                    for index, k in enumerate(topk):
+                        hr[index] = (rank < k).float().mean().item()
+                        ndcg[index] = torch.where(rank < k, 1 / torch.log2(rank.float() + 2), 0.0).mean().item()
 
                 if self.beam_search:
                     dedup_prompt = []
@@ -789,10 +924,7 @@ class ReReTrainer(Trainer):
                     dedup_prompt_ids = torch.stack(dedup_prompt).to(device)
                     dedup_prompt_mask = torch.stack(dedup_mask).to(device)
                     # print(f"dedup_prompt_ids: {dedup_prompt_ids.shape}")
-                    prompt_completion_ids = unwrapped_model.generate(
-                        dedup_prompt_ids, attention_mask=dedup_prompt_mask, generation_config=self.generation_config,
-                        logits_processor=self.logits_processor,
-                    )
+                    prompt_completion_ids = self._generate(unwrapped_model, dedup_prompt_ids, dedup_prompt_mask)
                     # print(f"prompt_ids: {prompt_ids.shape}")
                     # print(f"prompt_completion_ids: {prompt_completion_ids.shape}")
                 else:
@@ -808,16 +940,10 @@ class ReReTrainer(Trainer):
                         extended_prompt_mask = torch.stack(lis2).to(device)
                         # print(f"extended_prompt_ids: {extended_prompt_ids.shape}")
                         # print(f"extended_prompt_mask: {extended_prompt_mask.shape}")
-                        prompt_completion_ids = unwrapped_model.generate(
-                            extended_prompt_ids, attention_mask=extended_prompt_mask, generation_config=self.generation_config,
-                            logits_processor=self.logits_processor,
-                        )
+                        prompt_completion_ids = self._generate(unwrapped_model, extended_prompt_ids, extended_prompt_mask)
                         prompt_length = prompt_ids.size(1)
                         extended_completion_ids = prompt_completion_ids[:, prompt_length:]
-                        if self.base_model.lower().find("llama")>-1:
-                            extended_completions_text = self.processing_class.batch_decode(extended_completion_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-                        else:
-                            extended_completions_text = self.processing_class.batch_decode(extended_completion_ids, skip_special_tokens=True)
+                        extended_completions_text = self._decode_completions(extended_completion_ids)
                         # print(f"extended_completions_text: {extended_completions_text}")
 
                         def select_completion(completions, target):
@@ -853,10 +979,7 @@ class ReReTrainer(Trainer):
                         # print(f"dynSam_prompt_completion_ids: {prompt_completion_ids.shape}")
                             
                     else:
-                        prompt_completion_ids = unwrapped_model.generate(
-                            prompt_ids, attention_mask=prompt_mask, generation_config=self.generation_config,
-                            logits_processor=self.logits_processor,
-                        )
+                        prompt_completion_ids = self._generate(unwrapped_model, prompt_ids, prompt_mask)
 
             if self.add_gt:
                 repeat = len(prompts) // num_categories
@@ -898,21 +1021,15 @@ class ReReTrainer(Trainer):
 
         logits_to_keep = completion_ids.size(1)  # we only need to compute the logits for the completion tokens
         with torch.inference_mode():
-            if self.ref_model is not None:
-                ref_per_token_logps = self._get_per_token_logps(
-                    self.ref_model, prompt_completion_ids, attention_mask, logits_to_keep
+            if self.ref_logp_cache is not None:
+                ref_per_token_logps = self._cached_ref_per_token_logps(
+                    prompt_completion_ids, attention_mask, completion_mask, logits_to_keep
                 )
             else:
-                with self.accelerator.unwrap_model(self.model).disable_adapter():
-                    ref_per_token_logps = self._get_per_token_logps(
-                        self.model, prompt_completion_ids, attention_mask, logits_to_keep
-                    )
+                ref_per_token_logps = self._ref_per_token_logps(prompt_completion_ids, attention_mask, logits_to_keep)
 
         # Decode the generated completions
-        if self.base_model.lower().find("llama")>-1:
-            completions_text = self.processing_class.batch_decode(completion_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-        else:
-            completions_text = self.processing_class.batch_decode(completion_ids, skip_special_tokens=True)
+        completions_text = self._decode_completions(completion_ids)
         # print(completions_text)
         if is_conversational(inputs[0]):
             completions = []
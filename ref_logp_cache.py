@@ -0,0 +1,138 @@
+"""
+Cache of reference-model log-probs for GRPO rollouts.
+
+The reference model is frozen (until `sync_ref_model` copies the policy into it), prompts come
+back every epoch and completions are constrained to the finite catalog, so the same (prompt,
+item) pairs are scored over and over. `RefLogpCache` keeps the per-token reference log-probs of
+a completion under the digest of its prompt tokens and its item index, in an LRU optionally
+backed by one SQLite file per process that outlives the run. `ReReTrainer` only forwards the
+rows it misses. The on-disk tier is tagged with a namespace naming the reference weights (see
+`weights_fingerprint`), and emptied when it is opened under another one.
+
+Left padding shifts every token of a prompt by the same offset, which rotary position
+embeddings do not see, so a hit matches a recomputation up to float rounding.
+"""
+
+import hashlib
+import os
+import sqlite3
+from collections import OrderedDict
+from contextlib import nullcontext
+
+import torch
+
+
+def prompt_digest(ids):
+    """Digest of a prompt's token ids, without padding."""
+    return hashlib.blake2b(ids.to(torch.int64).cpu().numpy().tobytes(), digest_size=16).hexdigest()
+
+
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".pt")
+
+
+def weights_fingerprint(model_id, model=None):
+    """Digest identifying a model's weights.
+
+    Covers the name, size and modification time of the weight files when `model_id` is a local
+    checkpoint directory, and a sample of the parameter values of `model` (LoRA adapters aside),
+    so retraining into the same directory or passing an in-memory model changes it. Parameters
+    partitioned by DeepSpeed ZeRO-3 are gathered first, so every rank must call this together.
+    """
+    h = hashlib.blake2b(str(model_id).encode(), digest_size=8)
+    if os.path.isdir(model_id):
+        for name in sorted(os.listdir(model_id)):
+            if name.endswith(WEIGHT_SUFFIXES):
+                stat = os.stat(os.path.join(model_id, name))
+                h.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    if model is not None:
+        params = [p for n, p in model.named_parameters() if "lora_" not in n]
+        sample = params[:2] + params[len(params) // 2:len(params) // 2 + 1] + params[-2:]
+        gathered = nullcontext()
+        if any(hasattr(p, "ds_id") for p in sample):
+            import deepspeed
+
+            gathered = deepspeed.zero.GatheredParameters(sample, modifier_rank=None)
+        with gathered:
+            for p in sample:
+                h.update(p.detach().flatten()[:4096].float().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+class RefLogpCache:
+    """LRU of per-token reference log-probs keyed by `(prompt digest, item index)`.
+
+    Values are float32 CPU tensors holding the log-probs of the completion tokens up to and
+    including EOS.
+
+    Args:
+        max_entries: completions kept in memory.
+        cache_dir: directory of the on-disk tier, None keeps the cache in memory only.
+        namespace: names the reference model; the on-disk tier is emptied when it changes.
+        rank: process index, every process writes its own file.
+    """
+
+    def __init__(self, max_entries=65536, cache_dir=None, namespace="", rank=0):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.namespace = namespace
+        self.db = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.db = sqlite3.connect(os.path.join(cache_dir, f"ref_logps_rank{rank}.sqlite"))
+            self.db.execute("CREATE TABLE IF NOT EXISTS logps (key TEXT PRIMARY KEY, value BLOB)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            row = self.db.execute("SELECT value FROM meta WHERE name = 'namespace'").fetchone()
+            if row is None or row[0] != namespace:
+                self.clear(namespace)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _db_key(key):
+        return f"{key[0]}:{key[1]}"
+
+    def _remember(self, key, logps):
+        self.entries[key] = logps
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        """Cached log-probs of `key`, None on a miss. Disk hits are promoted to memory."""
+        logps = self.entries.get(key)
+        if logps is not None:
+            self.entries.move_to_end(key)
+            return logps
+        if self.db is None:
+            return None
+        row = self.db.execute("SELECT value FROM logps WHERE key = ?", (self._db_key(key),)).fetchone()
+        if row is None:
+            return None
+        logps = torch.frombuffer(bytearray(row[0]), dtype=torch.float32)
+        self._remember(key, logps)
+        return logps
+
+    def put(self, key, logps):
+        logps = logps.detach().float().cpu()
+        self._remember(key, logps)
+        if self.db is not None:
+            self.db.execute(
+                "INSERT OR REPLACE INTO logps VALUES (?, ?)", (self._db_key(key), logps.numpy().tobytes())
+            )
+
+    def commit(self):
+        """Make the entries written since the last commit durable."""
+        if self.db is not None:
+            self.db.commit()
+
+    def clear(self, namespace=None):
+        """Drop every entry, e.g. after the reference model was updated, and tag the on-disk tier
+        with `namespace` (the current one by default) for the entries written from now on."""
+        self.entries.clear()
+        if namespace is not None:
+            self.namespace = namespace
+        if self.db is not None:
+            self.db.execute("DELETE FROM logps")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('namespace', ?)", (self.namespace,))
+            self.db.commit()
@@ -0,0 +1,81 @@
+import unittest
+import tempfile
+import os
+import sys
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from bench_decoding import tiny_model
+from ref_logp_cache import RefLogpCache, prompt_digest, weights_fingerprint
+
+
+class TestRefLogpCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def key(self, item):
+        return prompt_digest(torch.tensor([5, 6, 7])), item
+
+    def test_lru_eviction(self):
+        cache = RefLogpCache(max_entries=2)
+        for item in range(3):
+            cache.put(self.key(item), torch.full((2,), float(item)))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(self.key(0)))
+
+        # Reading item 1 makes item 2 the least recently used
+        self.assertEqual(cache.get(self.key(1)).tolist(), [1.0, 1.0])
+        cache.put(self.key(3), torch.zeros(2))
+        self.assertIsNone(cache.get(self.key(2)))
+        self.assertIsNotNone(cache.get(self.key(1)))
+
+    def test_disk_tier(self):
+        """Evicted entries come back from disk and are promoted to memory"""
+        cache = RefLogpCache(max_entries=2, cache_dir=self.tmp.name, namespace="ref")
+        for item in range(3):
+            cache.put(self.key(item), torch.full((item + 1,), float(item), dtype=torch.bfloat16))
+        self.assertNotIn(self.key(0), cache.entries)
+        logps = cache.get(self.key(0))
+        self.assertEqual(logps.dtype, torch.float32)
+        self.assertEqual(logps.tolist(), [0.0])
+        self.assertIn(self.key(0), cache.entries)
+        self.assertNotIn(self.key(1), cache.entries)
+        cache.commit()
+
+        reopened = RefLogpCache(cache_dir=self.tmp.name, namespace="ref")
+        self.assertEqual(len(reopened), 0)
+        self.assertEqual(reopened.get(self.key(2)).tolist(), [2.0, 2.0, 2.0])
+
+    def test_namespace(self):
+        """Opening under another namespace or clearing into one empties the disk tier"""
+        cache = RefLogpCache(cache_dir=self.tmp.name, namespace="ref-a")
+        cache.put(self.key(0), torch.zeros(3))
+        cache.commit()
+
+        reopened = RefLogpCache(cache_dir=self.tmp.name, namespace="ref-b")
+        self.assertIsNone(reopened.get(self.key(0)))
+        reopened.put(self.key(1), torch.ones(3))
+        reopened.clear(namespace="ref-c")
+        self.assertEqual(reopened.namespace, "ref-c")
+        self.assertIsNone(reopened.get(self.key(1)))
+        reopened.put(self.key(2), torch.ones(3))
+        reopened.commit()
+
+        self.assertEqual(RefLogpCache(cache_dir=self.tmp.name, namespace="ref-c").get(self.key(2)).tolist(), [1.0] * 3)
+
+    def test_weights_fingerprint(self):
+        model = tiny_model(vocab_size=100)
+        fingerprint = weights_fingerprint("ref", model)
+        self.assertEqual(weights_fingerprint("ref", model), fingerprint)
+        self.assertNotEqual(weights_fingerprint("other", model), fingerprint)
+        with torch.no_grad():
+            next(model.parameters()).add_(1.0)
+        self.assertNotEqual(weights_fingerprint("ref", model), fingerprint)
+
+
+if __name__ == '__main__':
+    unittest.main()
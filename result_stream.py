@@ -0,0 +1,111 @@
+"""
+Streaming evaluation results.
+
+`evaluate.py` appends one JSON line per finished sample, keyed by its index in the test set,
+instead of dumping every prediction at the end of the run. A crash loses at most the lines
+written since the last flush, and `--resume` skips the indices already in the file. The
+readers accept both this JSONL stream and the legacy JSON list, so `calc.py` and
+`calc_level.py` work on either.
+"""
+
+import json
+import os
+import time
+
+
+def _is_stream(path):
+    return path.endswith(".jsonl")
+
+
+def iter_results(path):
+    """`(index, record)` for every complete line of a JSONL result stream.
+
+    A torn last line (the writer was killed mid-write) is skipped. If an index appears twice,
+    both are yielded; `load_results` keeps the last one.
+    """
+    with open(path) as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            yield record.pop("index"), record
+
+
+def completed_indices(path):
+    """Sample indices already written to `path`, empty if it does not exist."""
+    if not os.path.exists(path):
+        return set()
+    if _is_stream(path):
+        return {index for index, _ in iter_results(path)}
+    return set(range(len(load_results(path))))
+
+
+def load_results(path):
+    """Evaluation records ordered by sample index, from a JSONL stream or a JSON list."""
+    if not _is_stream(path):
+        with open(path) as f:
+            return json.load(f)
+    records = dict(iter_results(path))
+    return [records[index] for index in sorted(records)]
+
+
+class ResultWriter:
+    """Appends `{"index": i, **record}` lines to a JSONL file.
+
+    Lines are flushed to the OS after every `flush_every` records and synced to disk at least
+    every `sync_interval` seconds, so the file stays readable while the run is in progress.
+
+    Args:
+        path: JSONL file to write.
+        resume: keep the existing lines and append after them, otherwise start a new file.
+        flush_every: records between flushes.
+        sync_interval: seconds between `fsync` calls.
+    """
+
+    def __init__(self, path, resume=False, flush_every=64, sync_interval=60.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.sync_interval = sync_interval
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if resume and os.path.exists(path):
+            self._drop_torn_line()
+            self.file = open(path, "a")
+        else:
+            self.file = open(path, "w")
+        self.unflushed = 0
+        self.last_sync = time.monotonic()
+
+    def _drop_torn_line(self):
+        # Appending after a partial line would corrupt the next record too
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                f.truncate(end)
+
+    def write(self, index, record):
+        self.file.write(json.dumps({"index": index, **record}, ensure_ascii=False) + "\n")
+        self.unflushed += 1
+        if self.unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self, sync=False):
+        self.file.flush()
+        self.unflushed = 0
+        if sync or time.monotonic() - self.last_sync >= self.sync_interval:
+            os.fsync(self.file.fileno())
+            self.last_sync = time.monotonic()
+
+    def close(self):
+        self.flush(sync=True)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,63 @@
+import unittest
+import tempfile
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from result_stream import ResultWriter, completed_indices, iter_results, load_results
+
+
+class TestResultStream(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "out", "result.jsonl")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def record(self, index):
+        return {"output": f"<a_{index}>", "predict_items": [index, -1]}
+
+    def test_resume_after_torn_line(self):
+        """A line cut short by a crash is skipped on read and dropped before appending"""
+        with ResultWriter(self.path) as writer:
+            for index in (2, 0, 1):
+                writer.write(index, self.record(index))
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"index": 3, **self.record(3)})[:20])
+
+        self.assertEqual([index for index, _ in iter_results(self.path)], [2, 0, 1])
+        self.assertEqual(completed_indices(self.path), {0, 1, 2})
+
+        with ResultWriter(self.path, resume=True, flush_every=1) as writer:
+            for index in (3, 4):
+                writer.write(index, self.record(index))
+        self.assertEqual(load_results(self.path), [self.record(index) for index in range(5)])
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 5)
+
+    def test_duplicate_index_keeps_last(self):
+        with ResultWriter(self.path) as writer:
+            writer.write(0, self.record(0))
+            writer.write(0, self.record(7))
+        self.assertEqual(load_results(self.path), [self.record(7)])
+
+    def test_without_resume_starts_over(self):
+        with ResultWriter(self.path) as writer:
+            writer.write(0, self.record(0))
+        with ResultWriter(self.path) as writer:
+            writer.write(1, self.record(1))
+        self.assertEqual(completed_indices(self.path), {1})
+        self.assertEqual(completed_indices(os.path.join(self.tmp.name, "missing.jsonl")), set())
+
+    def test_json_list(self):
+        path = os.path.join(self.tmp.name, "result.json")
+        with open(path, "w") as f:
+            json.dump([self.record(0), self.record(1)], f)
+        self.assertEqual(load_results(path), [self.record(0), self.record(1)])
+        self.assertEqual(completed_indices(path), {0, 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
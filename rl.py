@@ -8,6 +8,7 @@ from torch.utils.data import ConcatDataset
 from transformers import AutoModelForCausalLM, AutoTokenizer
 import os
 from minionerec_trainer import ReReTrainer
+from sid_decoding import parse_beam_schedule
 from sasrec import SASRec
 from fire import Fire
 import pickle
@@ -59,6 +60,7 @@ def train(
     mask_all_zero: bool = False,
     sync_ref_model: bool = False,
     test_beam: int = 20,
+    test_beam_schedule: str = None,
     reward_type: str = "rule",
     sample_train: bool = False,
     ada_path: str = "",
@@ -69,6 +71,11 @@ def train(
     gspo: bool = False,
     sibling_grpo: bool = False,
     sibling_alpha: float = 0.5,
+    ref_logp_cache_size: int = 0,
+    ref_logp_cache_dir: str = None,
+    grouped_forward: bool = False,
+    logps_chunk_size: int = 0,
+    sid_logps: bool = False,
 ):
     torch.backends.cuda.enable_flash_sdp(False)  
     torch.backends.cuda.enable_mem_efficient_sdp(False)
@@ -332,11 +339,17 @@ def train(
         gspo=gspo,
         sibling_grpo=sibling_grpo,
         sibling_alpha=sibling_alpha,
+        ref_logp_cache_size=ref_logp_cache_size,
+        ref_logp_cache_dir=ref_logp_cache_dir,
+        grouped_forward=grouped_forward,
+        logps_chunk_size=logps_chunk_size,
+        sid_logps=sid_logps,
         add_gt=add_gt,
         dynamic_sampling=dynamic_sampling,
         beam_search=beam_search,
         test_during_training=test_during_training,
         test_beam=test_beam,
+        test_beam_schedule=parse_beam_schedule(test_beam_schedule),
         info_file=info_file,
         prompt2history=prompt2history,
         history2target=history2target,
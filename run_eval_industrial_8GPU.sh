@@ -22,52 +22,34 @@ for category in "Industrial_and_Scientific"; do
         continue
     fi
 
-    temp_dir="./temp/${category}-${exp_name_clean}"
-    mkdir -p "$temp_dir"
-
-    echo "Splitting test data..."
-    python ./split.py --input_path "$test_file" --output_path "$temp_dir" --cuda_list "0,1,2,3,4,5,6,7"
-
-    cudalist="0 1 2 3 4 5 6 7"
-    echo "Starting parallel evaluation on 8 GPUs..."
-    for i in ${cudalist}; do
-        if [[ -f "$temp_dir/${i}.csv" ]]; then
-            echo "Starting evaluation on GPU $i"
-            CUDA_VISIBLE_DEVICES=$i python -u ./evaluate.py \
-                --base_model "$EXP_NAME" \
-                --info_file "$info_file" \
-                --category ${category} \
-                --test_data_path "$temp_dir/${i}.csv" \
-                --result_json_data "$temp_dir/${i}.json" \
-                --batch_size 8 \
-                --num_beams 50 \
-                --max_new_tokens 256 &
-        fi
-    done
-    echo "Waiting for all evaluation processes..."
-    wait
+    echo "Prebuilding SID trie index..."
+    python ./sid_trie.py --base_model "$EXP_NAME" --info_file "$info_file"
 
     output_dir="./results/${exp_name_clean}"
     mkdir -p "$output_dir"
 
-    actual_cuda_list=$(ls "$temp_dir"/*.json 2>/dev/null | sed 's/.*\///g' | sed 's/\.json//g' | tr '\n' ',' | sed 's/,$//')
-    echo "Merging results from GPUs: $actual_cuda_list"
-
-    python ./merge.py \
-        --input_path "$temp_dir" \
-        --output_path "$output_dir/final_result_${category}.json" \
-        --cuda_list "$actual_cuda_list"
+    echo "Starting parallel evaluation on 8 GPUs..."
+    CUDA_VISIBLE_DEVICES=0,1,2,3,4,5,6,7 python -u ./evaluate.py \
+        --base_model "$EXP_NAME" \
+        --info_file "$info_file" \
+        --category ${category} \
+        --test_data_path "$test_file" \
+        --result_json_data "$output_dir/final_result_${category}.jsonl" \
+        --workers 8 \
+        --batch_size 8 \
+        --num_beams 50 \
+        --max_new_tokens 256
 
     echo "Calculating metrics..."
     python ./calc.py \
-        --path "$output_dir/final_result_${category}.json" \
+        --path "$output_dir/final_result_${category}.jsonl" \
         --item_path "$info_file"
 
     echo "Per-level analysis..."
     python ./calc_level.py \
-        --path "$output_dir/final_result_${category}.json"
+        --path "$output_dir/final_result_${category}.jsonl"
 
-    echo "Results saved to: $output_dir/final_result_${category}.json"
+    echo "Results saved to: $output_dir/final_result_${category}.jsonl"
     echo "----------------------------------------"
 done
 
@@ -0,0 +1,770 @@
+"""
+Decoding utilities specialised for semantic-ID generation.
+
+Under the SID trie only `trie.vocab_ids` (the SID tokens plus EOS) can ever be emitted,
+so the output projection can be cut down to those rows of the LM head (an opt-in
+approximation, as the softmax then normalizes over them only), and since every semantic ID
+has the same fixed depth the beam search can follow trie edges directly instead of going
+through `generate`. For small catalogs `SIDExhaustiveScorer` scores every item exactly.
+"""
+
+import copy
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+
+class RestrictedLMHead(nn.Module):
+    """LM head computing logits only for `vocab_ids`.
+
+    With `scatter`, the subset logits are written back into a full-vocabulary row filled with
+    -inf, so `generate` and its logits processors see regular vocabulary ids while the softmax
+    normalizes over the subset only. Without it, the head returns `(..., len(vocab_ids))`
+    logits for decoding loops that select tokens in the compact space themselves.
+    """
+
+    def __init__(self, lm_head: nn.Module, vocab_ids: torch.Tensor, scatter: bool = True):
+        super().__init__()
+        weight = lm_head.weight.detach()
+        self.vocab_size = weight.size(0)
+        self.scatter = scatter
+        self.register_buffer("vocab_ids", vocab_ids.to(weight.device), persistent=False)
+        self.register_buffer("weight", weight[self.vocab_ids].clone(), persistent=False)
+        bias = getattr(lm_head, "bias", None)
+        self.register_buffer(
+            "bias", bias.detach()[self.vocab_ids].clone() if bias is not None else None, persistent=False
+        )
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        logits = nn.functional.linear(hidden_states, self.weight, self.bias)
+        if not self.scatter:
+            return logits
+        full = logits.new_full((*logits.shape[:-1], self.vocab_size), float('-inf'))
+        return full.index_copy_(-1, self.vocab_ids, logits)
+
+
+@contextmanager
+def replaced_lm_head(model, head):
+    """Temporarily replace the model's output embeddings with `head`, e.g. a `RestrictedLMHead` built once."""
+    lm_head = model.get_output_embeddings()
+    model.set_output_embeddings(head)
+    try:
+        yield model
+    finally:
+        model.set_output_embeddings(lm_head)
+
+
+def restricted_lm_head(model, vocab_ids, scatter=True):
+    """Temporarily replace the model's output embeddings with a `RestrictedLMHead`."""
+    return replaced_lm_head(model, RestrictedLMHead(model.get_output_embeddings(), vocab_ids, scatter=scatter))
+
+
+class HiddenStatesHead(nn.Module):
+    """Stands in for the LM head so that the model returns its final hidden states as `logits`."""
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return hidden_states
+
+
+@contextmanager
+def hidden_states_head(model):
+    """Temporarily replace the model's output embeddings with a `HiddenStatesHead`, yielding the real head."""
+    lm_head = model.get_output_embeddings()
+    model.set_output_embeddings(HiddenStatesHead())
+    try:
+        yield lm_head
+    finally:
+        model.set_output_embeddings(lm_head)
+
+
+@contextmanager
+def kv_cache_enabled(model):
+    """Temporarily turn gradient checkpointing off, which disables the KV cache in training mode.
+
+    Meant for generation under `torch.no_grad()`, where checkpointing saves nothing anyway.
+    """
+    modules = [m for m in model.modules() if getattr(m, "gradient_checkpointing", False)]
+    for module in modules:
+        module.gradient_checkpointing = False
+    try:
+        yield model
+    finally:
+        for module in modules:
+            module.gradient_checkpointing = True
+
+
+def _token_logps(hidden_states, weight, bias, targets):
+    logits = nn.functional.linear(hidden_states, weight, bias).float()
+    return logits.gather(-1, targets.unsqueeze(-1)).squeeze(-1) - logits.logsumexp(-1)
+
+
+def token_logps(hidden_states, lm_head, targets, vocab_ids=None, chunk_size=0):
+    """Log-probs of `targets` (rows, steps) from the final `hidden_states` (rows, steps, hidden).
+
+    The LM head is applied `chunk_size` positions at a time (all at once for 0), and under
+    autograd every chunk is recomputed in backward instead of keeping its logits, so at most
+    `chunk_size x vocab` logits exist at any time. With `vocab_ids` (sorted, e.g. the SID tokens
+    plus EOS of the trie) only those rows of the head are used and the softmax normalizes over
+    them, as in constrained decoding. Targets outside `vocab_ids`, which only unconstrained
+    completions contain, get log-prob 0 and so drop out of the objective.
+    """
+    weight, bias = lm_head.weight, getattr(lm_head, "bias", None)
+    valid = None
+    if vocab_ids is not None:
+        vocab_ids = vocab_ids.to(targets.device)
+        weight = weight[vocab_ids]
+        bias = bias[vocab_ids] if bias is not None else None
+        local = torch.searchsorted(vocab_ids, targets.contiguous()).clamp(max=vocab_ids.numel() - 1)
+        valid = vocab_ids[local] == targets
+        targets = torch.where(valid, local, 0)
+
+    shape = targets.shape
+    hidden_states = hidden_states.reshape(-1, hidden_states.size(-1))
+    targets = targets.reshape(-1)
+    chunk_size = chunk_size or targets.numel()
+    logps = []
+    for start in range(0, targets.numel(), chunk_size):
+        chunk = (hidden_states[start:start + chunk_size], weight, bias, targets[start:start + chunk_size])
+        if torch.is_grad_enabled():
+            logps.append(checkpoint(_token_logps, *chunk, use_reentrant=False))
+        else:
+            logps.append(_token_logps(*chunk))
+    logps = torch.cat(logps).view(shape)
+    return logps if valid is None else torch.where(valid, logps, 0.0)
+
+
+@dataclass
+class SIDBeamOutput:
+    item_ids: torch.LongTensor   # (batch, num_beams) catalog item index, -1 for beams without a leaf
+    scores: torch.FloatTensor    # (batch, num_beams) sequence log-probs, best first
+    sequences: torch.LongTensor  # (batch, num_beams, steps) generated token ids
+
+
+def parse_beam_schedule(schedule):
+    """Per-level beam widths from `"16,32,50"`, `"16/32/50"`, a sequence or a single int; None stays None."""
+    if schedule is None or schedule == "":
+        return None
+    if isinstance(schedule, str):
+        schedule = [v for v in schedule.replace("/", ",").split(",") if v.strip()]
+    elif not isinstance(schedule, (list, tuple)):
+        schedule = [schedule]
+    schedule = [int(v) for v in schedule]
+    if any(width < 1 for width in schedule):
+        raise ValueError(f"Beam widths must be positive, got {schedule}")
+    return schedule
+
+
+def _position_ids(attention_mask):
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    return position_ids.masked_fill_(attention_mask == 0, 1)
+
+
+def _reorder_cache(model, cache, beam_idx):
+    if hasattr(cache, "reorder_cache"):
+        cache.reorder_cache(beam_idx)
+        return cache
+    if cache is None:
+        raise ValueError(
+            "The model returned no KV cache; gradient checkpointing disables it in training mode (see `kv_cache_enabled`)"
+        )
+    if not hasattr(model, "_reorder_cache"):
+        raise TypeError(f"Cannot reorder a KV cache of type {type(cache).__name__} for {type(model).__name__}")
+    return model._reorder_cache(cache, beam_idx)
+
+
+def _expand_cache(model, cache, batch_size, num_beams, device):
+    """Copy every prompt's cache row to its `num_beams` beam rows."""
+    index = torch.arange(batch_size, device=device).repeat_interleave(num_beams)
+    return _reorder_cache(model, cache, index)
+
+
+def common_prefix(sequences):
+    """Longest token prefix of all `sequences`, leaving at least one token of each after it."""
+    if len(sequences) == 0:
+        return []
+    prefix = list(sequences[0])
+    for seq in sequences[1:]:
+        n = 0
+        while n < min(len(prefix), len(seq)) and prefix[n] == seq[n]:
+            n += 1
+        prefix = prefix[:n]
+    return prefix[:max(min(len(seq) for seq in sequences) - 1, 0)]
+
+
+class SharedPrefixCache:
+    """KV cache of a token prefix every prompt starts with, such as the constant instruction block.
+
+    The prefix is encoded once per model weights and its cache copied under every batch, so
+    prefill only runs the per-prompt suffix. Left-padded rows `[pad][prefix][suffix]` are
+    rearranged to `[prefix][pad][suffix]` (see `split`): the prefix then sits at positions
+    0..P-1 exactly as it was encoded, the padding gap is masked out and the suffix positions
+    follow from the attention mask, which is equivalent to encoding every prompt unpadded.
+    """
+
+    def __init__(self, model, prefix_ids):
+        self.model = model
+        self.prefix_ids = torch.as_tensor(list(prefix_ids), dtype=torch.long, device=model.device)
+        self.cache = None
+        if self.prefix_ids.numel() > 0:
+            with torch.no_grad():
+                out = model(input_ids=self.prefix_ids.unsqueeze(0), use_cache=True, logits_to_keep=1)
+            self.cache = out.past_key_values
+
+    def __len__(self):
+        return self.prefix_ids.numel()
+
+    def matches(self, input_ids, attention_mask):
+        """Whether every left-padded row starts with the prefix and has a token after it."""
+        P = len(self)
+        if self.cache is None or input_ids.size(1) <= P:
+            return False
+        lengths = attention_mask.long().sum(1)
+        if (lengths <= P).any() or (attention_mask[:, -1] == 0).any():
+            return False
+        cols = (input_ids.size(1) - lengths).unsqueeze(1) + torch.arange(P, device=input_ids.device)
+        prefix = self.prefix_ids.to(input_ids.device)
+        return bool(((input_ids.gather(1, cols) == prefix) & (attention_mask.gather(1, cols) == 1)).all())
+
+    def split(self, input_ids, attention_mask):
+        """Rearrange left-padded `[pad][prefix][suffix]` rows to `[prefix][pad][suffix]`.
+
+        Rows keep their width, so completions still start at `input_ids.size(1)`.
+        """
+        P = len(self)
+        width = input_ids.size(1) - P
+        suffix_len = attention_mask.long().sum(1, keepdim=True) - P
+        keep = torch.arange(width, device=input_ids.device) >= width - suffix_len
+        suffix = torch.where(keep, input_ids[:, P:], input_ids[:, :1])
+        prefix = self.prefix_ids.to(input_ids.device).expand(input_ids.size(0), P)
+        return (
+            torch.cat([prefix, suffix], dim=1),
+            torch.cat([attention_mask.new_ones(input_ids.size(0), P), keep.to(attention_mask.dtype)], dim=1),
+        )
+
+    def forward(self, input_ids, attention_mask, **kwargs):
+        """Run the suffix of rows rearranged by `split` on top of a copy of the prefix cache."""
+        P = len(self)
+        rows = torch.zeros(input_ids.size(0), dtype=torch.long, device=input_ids.device)
+        cache = _select_cache(self.model, self.cache, rows)
+        return self.model(
+            input_ids=input_ids[:, P:], attention_mask=attention_mask,
+            position_ids=_position_ids(attention_mask)[:, P:], past_key_values=cache, use_cache=True, **kwargs
+        )
+
+
+def _encode_prompts(model, input_ids, attention_mask, prefix_cache=None, **kwargs):
+    """Prefill the prompts, through `prefix_cache` when they all start with its prefix.
+
+    Returns the model output and the prompt rows the cache corresponds to.
+    """
+    if prefix_cache is not None and prefix_cache.matches(input_ids, attention_mask):
+        input_ids, attention_mask = prefix_cache.split(input_ids, attention_mask)
+        return prefix_cache.forward(input_ids, attention_mask, **kwargs), input_ids, attention_mask
+    out = model(
+        input_ids=input_ids, attention_mask=attention_mask,
+        position_ids=_position_ids(attention_mask), use_cache=True, **kwargs
+    )
+    return out, input_ids, attention_mask
+
+
+@torch.no_grad()
+def prefill_cache(model, input_ids, attention_mask, num_beams=1, prefix_cache=None):
+    """KV cache of every prompt but its last token, encoded once and copied to `num_beams` rows.
+
+    Passed to `generate` as `past_key_values`, beam search only runs the last prompt token for
+    each beam instead of re-encoding the whole prompt `num_beams` times. Returns the cache and
+    the prompt rows to pass along with it, which `SharedPrefixCache.split` may have rearranged.
+    """
+    if prefix_cache is not None and input_ids.size(1) - 1 > len(prefix_cache) \
+            and prefix_cache.matches(input_ids, attention_mask):
+        input_ids, attention_mask = prefix_cache.split(input_ids, attention_mask)
+        out = prefix_cache.forward(input_ids[:, :-1], attention_mask[:, :-1], logits_to_keep=1)
+    else:
+        out, _, _ = _encode_prompts(model, input_ids[:, :-1], attention_mask[:, :-1], logits_to_keep=1)
+    cache = _expand_cache(model, out.past_key_values, input_ids.size(0), num_beams, input_ids.device)
+    return cache, input_ids, attention_mask
+
+
+def grouped_completion_logits(model, input_ids, attention_mask, logits_to_keep, group_size):
+    """Logits predicting the last `logits_to_keep` tokens of rows that share their prompt in groups.
+
+    Rows come in consecutive groups of `group_size` with the same prompt (every column but the
+    last `logits_to_keep`), as GRPO repeats every prompt for its generations. Each prompt is
+    encoded once and its KV cache copied to the rows of its group, which then only run their
+    completion tokens. Positions and attention mask are those of the full rows, so the result
+    matches `model(input_ids, attention_mask, logits_to_keep=logits_to_keep + 1).logits[:, :-1]`
+    up to float rounding, and gradients flow back through the shared prompt encoding.
+    """
+    P = input_ids.size(1) - logits_to_keep
+    out = model(
+        input_ids=input_ids[::group_size, :P], attention_mask=attention_mask[::group_size, :P],
+        use_cache=True, logits_to_keep=1,
+    )
+    # The last prompt position predicts the first completion token of every row in the group
+    first = out.logits[:, -1:].repeat_interleave(group_size, dim=0)
+    if logits_to_keep == 1:
+        return first
+    cache = _expand_cache(model, out.past_key_values, input_ids.size(0) // group_size, group_size, input_ids.device)
+    rest = model(
+        input_ids=input_ids[:, P:-1], attention_mask=attention_mask[:, :-1], past_key_values=cache, use_cache=True
+    ).logits
+    return torch.cat([first, rest], dim=1)
+
+
+def _select_cache(model, cache, index):
+    """Rows `index` of `cache` as a new cache, leaving `cache` itself untouched."""
+    if isinstance(cache, tuple):
+        return tuple(tuple(t.index_select(0, index) for t in layer) for layer in cache)
+    cache = copy.copy(cache)
+    if isinstance(getattr(cache, "layers", None), list):
+        cache.layers = [copy.copy(layer) for layer in cache.layers]
+    else:
+        cache.key_cache = list(cache.key_cache)
+        cache.value_cache = list(cache.value_cache)
+    return _reorder_cache(model, cache, index)
+
+
+class SIDBeamSearch:
+    """Fixed-depth beam search over the SID trie, bypassing `generate`.
+
+    Every semantic ID is the same short token path, so the search runs exactly `trie.depth`
+    steps (the SID level tokens plus EOS). Prompts are encoded once and their KV cache copied to
+    the beams. Each step only scores the trie children of every
+    beam, keeps beam scores as a dense `(batch, num_beams)` tensor and reorders the KV cache by
+    the selected parents. The leaves reached at the end give catalog item indices directly.
+    A `beam_schedule` sets the number of beams kept after each SID level: narrow beams on the
+    first levels, which have at most codebook-size choices, and `num_beams` only at the leaf.
+    With `blocked` (see `SIDTrie.blocked_nodes`, one row per prompt), excluded items and the
+    subtrees holding only excluded items are pruned before the top-k, so every beam ends on an
+    eligible item; items disabled with `SIDTrie.set_available` are pruned the same way.
+
+    Args:
+        model: causal LM.
+        trie: `SIDTrie` constraining the completions, on the device of the inputs. It is used as given,
+            so availability updates made on it (see `SIDTrie.set_available`) apply to the next call.
+        num_beams: beams kept per prompt, also the number of returned items.
+        length_penalty: exponent applied to the completion length when ranking, as in `generate`.
+        restrict_vocab: project hidden states onto `trie.vocab_ids` only (see `RestrictedLMHead`). Opt-in
+            approximation: the softmax then normalizes over the SID tokens only, which changes the
+            ranking against `generate` over the full vocabulary.
+        prefix_cache: optional `SharedPrefixCache` of the instruction block the prompts start with.
+        beam_schedule: beams kept after each decoding step, e.g. `[16, 32]`; steps past the end of
+            the schedule, and always the last one, keep `num_beams`.
+    """
+
+    def __init__(
+        self, model, trie, num_beams, length_penalty=0.0, restrict_vocab=False, prefix_cache=None, beam_schedule=None
+    ):
+        self.model = model
+        self.trie = trie
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.restrict_vocab = restrict_vocab
+        self.prefix_cache = prefix_cache
+        self.beam_schedule = parse_beam_schedule(beam_schedule) or []
+
+    def widths(self, depth):
+        """Beams kept after each of the `depth` steps."""
+        return [
+            self.beam_schedule[step] if step < len(self.beam_schedule) and step < depth - 1 else self.num_beams
+            for step in range(depth)
+        ]
+
+    def _forward(self, **kwargs):
+        out = self.model(use_cache=True, **kwargs)
+        return out.logits[:, -1, :].float(), out.past_key_values
+
+    @torch.no_grad()
+    def __call__(self, input_ids, attention_mask, blocked=None):
+        trie = self.trie
+        batch_size, num_beams = input_ids.size(0), self.num_beams
+        local = self.restrict_vocab
+        eos = trie.local_eos if local else trie.eos_token_id
+        # Per-prompt exclusions plus the items currently out of the catalog
+        blocked = trie.decoding_mask(blocked)
+        widths = self.widths(trie.depth)
+
+        if local:
+            head_context = restricted_lm_head(self.model, trie.vocab_ids, scatter=False)
+        else:
+            head_context = nullcontext()
+        with head_context:
+            # Encode every prompt once; its single root beam fans out through the first cache reorder
+            out, input_ids, attention_mask = _encode_prompts(
+                self.model, input_ids, attention_mask, self.prefix_cache, logits_to_keep=1
+            )
+            logits, cache = out.logits[:, -1, :].float(), out.past_key_values
+
+            nodes = trie.root(batch_size)
+            scores = torch.zeros(batch_size, 1, device=input_ids.device)
+            lengths = torch.zeros(batch_size, 1, dtype=torch.long, device=input_ids.device)
+            sequences = input_ids.new_zeros(batch_size, 1, 0)
+
+            for step, width in enumerate(widths):
+                log_probs = torch.log_softmax(logits, dim=-1)
+                child, keep = trie.allowed_tokens(nodes, local=local, blocked=blocked, group_size=scores.size(1))
+                # Beams already on a leaf carry over by emitting EOS at no cost
+                finished = (nodes >= 0) & (trie.leaf_item[nodes.clamp(min=0)] >= 0)
+                carry = finished.unsqueeze(1) & (torch.arange(child.size(1), device=child.device) == 0)
+                child = torch.where(finished.unsqueeze(1), eos, child)
+                cand = torch.where(finished.unsqueeze(1), 0.0, log_probs.gather(1, child))
+                cand = torch.where(keep | carry, cand, float('-inf')) + scores.view(-1, 1)
+
+                # Fewer candidates than beams (narrow first levels) leave -inf beams that never win
+                degree, prev = child.size(1), scores.size(1)
+                cand = cand.view(batch_size, prev * degree)
+                if cand.size(1) < width:
+                    cand = torch.cat([cand, cand.new_full((batch_size, width - cand.size(1)), float('-inf'))], dim=1)
+                scores, top = cand.topk(width, dim=1)
+                top = top.clamp(max=prev * degree - 1)
+                parent = top // degree
+                flat_parent = (parent + torch.arange(batch_size, device=top.device).unsqueeze(1) * prev).view(-1)
+                tokens = child.view(batch_size, prev * degree).gather(1, top)
+                if local:
+                    tokens = trie.vocab_ids[tokens]
+
+                nodes = trie.step(nodes[flat_parent], tokens.view(-1))
+                lengths = lengths.gather(1, parent) + (~finished[flat_parent]).view(batch_size, width)
+                sequences = torch.cat([sequences.gather(1, parent.unsqueeze(-1).expand(-1, -1, sequences.size(2))),
+                                       tokens.unsqueeze(-1)], dim=-1)
+
+                if step == trie.depth - 1:
+                    break
+                rows = batch_size * width
+                attention_mask = torch.cat([attention_mask[flat_parent], attention_mask.new_ones(rows, 1)], dim=1)
+                if cache is None:
+                    # Models that refuse to cache (gradient checkpointing in train mode) re-run the prefix
+                    input_ids = torch.cat([input_ids[flat_parent], tokens.view(rows, 1)], dim=1)
+                    logits, cache = self._forward(
+                        input_ids=input_ids, attention_mask=attention_mask,
+                        position_ids=_position_ids(attention_mask), logits_to_keep=1,
+                    )
+                    continue
+                cache = _reorder_cache(self.model, cache, flat_parent)
+                logits, cache = self._forward(
+                    input_ids=tokens.view(rows, 1), attention_mask=attention_mask,
+                    position_ids=attention_mask.long().sum(-1, keepdim=True) - 1, past_key_values=cache,
+                )
+
+        if self.length_penalty != 0.0:
+            scores = scores / lengths.clamp(min=1).float() ** self.length_penalty
+            scores, order = scores.sort(dim=1, descending=True)
+            nodes = nodes.view(batch_size, num_beams).gather(1, order).view(-1)
+            sequences = sequences.gather(1, order.unsqueeze(-1).expand_as(sequences))
+
+        item_ids = trie.leaf_item[nodes.clamp(min=0)].view(batch_size, num_beams)
+        item_ids = torch.where((nodes.view(batch_size, num_beams) >= 0) & (scores > float('-inf')), item_ids, -1)
+        return SIDBeamOutput(item_ids=item_ids, scores=scores, sequences=sequences)
+
+
+class StaticSIDBeamSearch:
+    """`SIDBeamSearch` with static shapes throughout, so its decoding step compiles with `torch.compile`.
+
+    Semantic IDs have a fixed depth, so the whole search fits in tensors allocated once per
+    batch: a `StaticCache` of `prompt + trie.depth` positions for `batch * num_beams` rows, a
+    full-width attention mask whose generated columns are switched on step by step, and
+    `(batch, num_beams)` score, length and node tensors. Beams are reordered by copying the
+    generated columns of the cache rows in place, so every step runs the same shapes on the same
+    buffers. The prompt is
+    encoded eagerly (dynamic cache, optionally on top of `prefix_cache`) and copied into the
+    static cache; the per-step forward and the trie/top-k beam selection are the compiled parts.
+    Results match `SIDBeamSearch` without a beam schedule.
+
+    Args:
+        model: causal LM whose `base_model` supports `StaticCache` (e.g. Qwen2, Llama).
+        trie: `SIDTrie` constraining the completions, on the device of the inputs. It is used as given,
+            so availability updates made on it (see `SIDTrie.set_available`) apply to the next call.
+        num_beams: beams kept per prompt, also the number of returned items.
+        length_penalty: exponent applied to the completion length when ranking, as in `generate`.
+        restrict_vocab: project hidden states onto `trie.vocab_ids` only (see `RestrictedLMHead`). Opt-in
+            approximation: the softmax then normalizes over the SID tokens only, which changes the
+            ranking against `generate` over the full vocabulary.
+        prefix_cache: optional `SharedPrefixCache` of the instruction block the prompts start with.
+        compile: wrap the step functions in `torch.compile`. Every new batch shape compiles once.
+        pad_multiple: with `compile`, prompts are left-padded to a multiple of this width so that
+            batches of varying prompt lengths share a few compiled shapes.
+    """
+
+    def __init__(
+        self, model, trie, num_beams, length_penalty=0.0, restrict_vocab=False, prefix_cache=None, compile=False,
+        pad_multiple=64,
+    ):
+        self.model = model
+        self.pad_multiple = pad_multiple if compile else 0
+        self.trie = trie
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.restrict_vocab = restrict_vocab
+        self.prefix_cache = prefix_cache
+        self._forward = self._decode_step
+        self._select = self._select_beams
+        if compile:
+            self._forward = torch.compile(self._decode_step, dynamic=False)
+            self._select = torch.compile(self._select_beams, dynamic=False)
+
+    def _decode_step(self, tokens, attention_mask, position_ids, cache_position, cache, head_weight, head_bias):
+        hidden = self.model.base_model(
+            input_ids=tokens, attention_mask=attention_mask, position_ids=position_ids,
+            past_key_values=cache, cache_position=cache_position, use_cache=True,
+        ).last_hidden_state[:, -1]
+        return nn.functional.linear(hidden, head_weight, head_bias).float()
+
+    def _select_beams(self, logits, nodes, scores, lengths, blocked):
+        """One beam step: score the trie children of every beam and keep the best `num_beams`."""
+        trie, local = self.trie, self.restrict_vocab
+        batch_size, num_beams = scores.shape
+        log_probs = torch.log_softmax(logits, dim=-1)
+        child, keep = trie.allowed_tokens(nodes, local=local, blocked=blocked, group_size=num_beams)
+        # Beams already on a leaf carry over by emitting EOS at no cost
+        finished = (nodes >= 0) & (trie.leaf_item[nodes.clamp(min=0)] >= 0)
+        carry = finished.unsqueeze(1) & (torch.arange(child.size(1), device=child.device) == 0)
+        child = torch.where(finished.unsqueeze(1), trie.local_eos if local else trie.eos_token_id, child)
+        cand = torch.where(finished.unsqueeze(1), 0.0, log_probs.gather(1, child))
+        cand = torch.where(keep | carry, cand, float('-inf')) + scores.view(-1, 1)
+
+        degree = child.size(1)
+        scores, top = cand.view(batch_size, num_beams * degree).topk(num_beams, dim=1)
+        parent = top // degree
+        flat_parent = (parent + torch.arange(batch_size, device=top.device).unsqueeze(1) * num_beams).view(-1)
+        tokens = child.view(batch_size, num_beams * degree).gather(1, top)
+        if local:
+            tokens = trie.vocab_ids[tokens]
+        nodes = trie.step(nodes[flat_parent], tokens.view(-1))
+        lengths = lengths.gather(1, parent) + (~finished[flat_parent]).view(batch_size, num_beams)
+        return nodes, scores, lengths, parent, flat_parent, tokens
+
+    def _static_cache(self, prompt_cache, rows, max_cache_len):
+        """A `StaticCache` for `rows` beams holding every prompt's cache copied to its beams."""
+        from transformers import StaticCache
+
+        cache = StaticCache(config=self.model.config, max_cache_len=max_cache_len)
+        keys = prompt_cache.layers[0].keys
+        cache.early_initialization(rows, keys.size(1), keys.size(3), keys.dtype, keys.device)
+        batch_size, width = keys.size(0), keys.size(2)
+        for layer, prompt_layer in zip(cache.layers, prompt_cache.layers):
+            # Broadcast every prompt row over its beams, without materializing the expanded copy
+            for static, prompt in ((layer.keys, prompt_layer.keys), (layer.values, prompt_layer.values)):
+                static.view(batch_size, rows // batch_size, *static.shape[1:])[:, :, :, :width].copy_(prompt.unsqueeze(1))
+        return cache
+
+    @torch.no_grad()
+    def __call__(self, input_ids, attention_mask, blocked=None):
+        trie = self.trie
+        batch_size, num_beams = input_ids.size(0), self.num_beams
+        rows = batch_size * num_beams
+        device = input_ids.device
+        blocked = trie.decoding_mask(blocked)
+        pad = -input_ids.size(1) % self.pad_multiple if self.pad_multiple else 0
+        if pad:
+            input_ids = torch.cat([input_ids[:, :1].expand(-1, pad), input_ids], dim=1)
+            attention_mask = torch.cat([attention_mask.new_zeros(batch_size, pad), attention_mask], dim=1)
+
+        head = self.model.get_output_embeddings()
+        head_weight, head_bias = head.weight, getattr(head, "bias", None)
+        if self.restrict_vocab:
+            head_weight = head_weight[trie.vocab_ids]
+            head_bias = head_bias[trie.vocab_ids] if head_bias is not None else None
+            head_context = restricted_lm_head(self.model, trie.vocab_ids, scatter=False)
+        else:
+            head_context = nullcontext()
+        with head_context:
+            out, input_ids, attention_mask = _encode_prompts(
+                self.model, input_ids, attention_mask, self.prefix_cache, logits_to_keep=1
+            )
+        logits = out.logits[:, -1, :].float().repeat_interleave(num_beams, dim=0)
+        prompt_len = input_ids.size(1)
+        cache = self._static_cache(out.past_key_values, rows, prompt_len + trie.depth)
+        del out
+
+        # Generated columns are switched on as the steps fill them
+        mask = attention_mask.new_zeros(rows, prompt_len + trie.depth)
+        mask[:, :prompt_len] = attention_mask.repeat_interleave(num_beams, dim=0)
+        position_ids = attention_mask.long().sum(-1).repeat_interleave(num_beams).view(rows, 1)
+        cache_position = torch.full((1,), prompt_len, dtype=torch.long, device=device)
+
+        nodes = trie.root(rows)
+        # Only the first beam of every prompt is live at the root, the others start at -inf
+        scores = torch.full((batch_size, num_beams), float('-inf'), device=device)
+        scores[:, 0] = 0.0
+        lengths = torch.zeros(batch_size, num_beams, dtype=torch.long, device=device)
+        sequences = input_ids.new_zeros(batch_size, num_beams, trie.depth)
+
+        for step in range(trie.depth):
+            nodes, scores, lengths, parent, flat_parent, tokens = self._select(logits, nodes, scores, lengths, blocked)
+            sequences = sequences.gather(1, parent.unsqueeze(-1).expand_as(sequences))
+            sequences[:, :, step] = tokens
+            if step == trie.depth - 1:
+                break
+            # Beams only move within their prompt, whose cache rows are identical, so only generated columns move
+            generated = slice(prompt_len, prompt_len + step)
+            for layer in cache.layers:
+                for states in (layer.keys[:, :, generated], layer.values[:, :, generated]):
+                    states.copy_(states.index_select(0, flat_parent))
+            mask[:, prompt_len + step] = 1
+            logits = self._forward(
+                tokens.view(rows, 1), mask, position_ids + step, cache_position + step, cache, head_weight, head_bias
+            )
+
+        if self.length_penalty != 0.0:
+            scores = scores / lengths.clamp(min=1).float() ** self.length_penalty
+            scores, order = scores.sort(dim=1, descending=True)
+            nodes = nodes.view(batch_size, num_beams).gather(1, order).view(-1)
+            sequences = sequences.gather(1, order.unsqueeze(-1).expand_as(sequences))
+
+        item_ids = trie.leaf_item[nodes.clamp(min=0)].view(batch_size, num_beams)
+        item_ids = torch.where((nodes.view(batch_size, num_beams) >= 0) & (scores > float('-inf')), item_ids, -1)
+        return SIDBeamOutput(item_ids=item_ids, scores=scores, sequences=sequences)
+
+
+class SIDExhaustiveScorer:
+    """Exact top-K over the whole catalog, scoring every semantic ID.
+
+    The prompt is encoded once. Its KV cache is then copied under groups of first-level subtrees,
+    and the trie is expanded level by level inside each group: every trie node is forwarded exactly
+    once, on top of its parent's cache, and the log-probs of its children are added to the parent's
+    score. Leaves end up with the exact sequence log-prob that beam search only approximates, at a
+    cost proportional to the number of trie nodes, so this is meant for catalogs of a few thousand
+    items. Leaves blocked for a prompt (see `SIDTrie.blocked_nodes`) or disabled with
+    `SIDTrie.set_available` are left out of its top-K.
+
+    Args:
+        model: causal LM.
+        trie: `SIDTrie` holding the catalog, on the device of the inputs. It is used as given,
+            so availability updates made on it (see `SIDTrie.set_available`) apply to the next call.
+        top_k: number of returned items per prompt.
+        length_penalty: exponent applied to the completion length when ranking, as in `generate`.
+        restrict_vocab: project hidden states onto `trie.vocab_ids` only (see `RestrictedLMHead`). Opt-in
+            approximation: the softmax then normalizes over the SID tokens only, which changes the
+            ranking against `generate` over the full vocabulary.
+        chunk_size: upper bound on the rows (prompts x trie nodes) of one forward. First-level
+            subtrees are grouped up to this size; a single subtree wider than it runs on its own.
+        prefix_cache: optional `SharedPrefixCache` of the instruction block the prompts start with.
+    """
+
+    def __init__(
+        self, model, trie, top_k, length_penalty=0.0, restrict_vocab=False, chunk_size=1024, prefix_cache=None
+    ):
+        self.model = model
+        self.trie = trie
+        self.top_k = top_k
+        self.length_penalty = length_penalty
+        self.restrict_vocab = restrict_vocab
+        self.chunk_size = chunk_size
+        self.prefix_cache = prefix_cache
+
+    def _forward(self, **kwargs):
+        out = self.model(use_cache=True, **kwargs)
+        return out.logits[:, -1, :].float(), out.past_key_values
+
+    def _level_bounds(self):
+        # BFS numbering puts the target of edge e at node e + 1, so the descendants of a contiguous
+        # range of nodes form a contiguous range on every level below: [child_ptr[lo] + 1, child_ptr[hi] + 1)
+        trie = self.trie
+        bounds = [torch.arange(1, int(trie.child_ptr[1]) + 2, device=trie.device)]
+        for _ in range(trie.depth - 2):
+            bounds.append(trie.child_ptr[bounds[-1]] + 1)
+        return [b.tolist() for b in bounds]
+
+    def _groups(self, bounds, batch_size):
+        """Split the first-level nodes into runs whose widest level fits in `chunk_size` rows."""
+        budget = max(self.chunk_size // batch_size, 1)
+        num_first = len(bounds[0]) - 1
+        groups, start, width = [], 0, None
+        for i in range(num_first):
+            counts = [b[i + 1] - b[i] for b in bounds]
+            grown = counts if width is None else [w + c for w, c in zip(width, counts)]
+            if width is not None and max(grown) > budget:
+                groups.append((start, i))
+                start, grown = i, counts
+            width = grown
+        if num_first > start:
+            groups.append((start, num_first))
+        return groups
+
+    def _paths(self, nodes, edge_parent):
+        trie = self.trie
+        paths = nodes.new_full((nodes.numel(), max(trie.depth, 1)), trie.eos_token_id)
+        rows = torch.arange(nodes.numel(), device=nodes.device)
+        cur = nodes.clone()
+        for _ in range(trie.depth):
+            depth = trie.node_depth[cur]
+            ok = depth > 0
+            paths[rows[ok], depth[ok] - 1] = trie.child_tokens[cur[ok] - 1]
+            cur = torch.where(ok, edge_parent[(cur - 1).clamp(min=0)], cur)
+        return paths
+
+    @torch.no_grad()
+    def __call__(self, input_ids, attention_mask, blocked=None):
+        trie = self.trie
+        device = input_ids.device
+        batch_size = input_ids.size(0)
+        local = self.restrict_vocab
+        child_tokens = trie.local_child_tokens if local else trie.child_tokens
+        degrees = trie.child_ptr[1:] - trie.child_ptr[:-1]
+        edge_parent = torch.repeat_interleave(torch.arange(trie.num_nodes, device=device), degrees)
+        batch_rows = torch.arange(batch_size, device=device)
+
+        if local:
+            head_context = restricted_lm_head(self.model, trie.vocab_ids, scatter=False)
+        else:
+            head_context = nullcontext()
+        with head_context:
+            out, input_ids, attention_mask = _encode_prompts(
+                self.model, input_ids, attention_mask, self.prefix_cache, logits_to_keep=1
+            )
+            logits, prompt_cache = out.logits[:, -1, :].float(), out.past_key_values
+
+            # Cumulative log-prob of every trie node for every prompt
+            scores = torch.full((batch_size, trie.num_nodes), float('-inf'), device=device)
+            scores[:, 0] = 0.0
+            root_end = int(trie.child_ptr[1])
+            scores[:, 1:root_end + 1] = torch.log_softmax(logits, dim=-1)[:, child_tokens[:root_end]]
+
+            bounds = self._level_bounds() if trie.depth > 1 else []
+            for g0, g1 in self._groups(bounds, batch_size) if bounds else []:
+                lo, hi = bounds[0][g0], bounds[0][g1]
+                width = hi - lo
+                rows = batch_rows.repeat_interleave(width)
+                cache = _select_cache(self.model, prompt_cache, rows)
+                mask = attention_mask[rows]
+                for level in range(len(bounds)):
+                    mask = torch.cat([mask, mask.new_ones(mask.size(0), 1)], dim=1)
+                    logits, cache = self._forward(
+                        input_ids=trie.child_tokens[lo - 1:hi - 1].repeat(batch_size).view(-1, 1),
+                        attention_mask=mask, position_ids=mask.long().sum(-1, keepdim=True) - 1,
+                        past_key_values=cache,
+                    )
+                    log_probs = torch.log_softmax(logits, dim=-1).view(batch_size, width, -1)
+                    e0, e1 = int(trie.child_ptr[lo]), int(trie.child_ptr[hi])
+                    parent = edge_parent[e0:e1] - lo
+                    scores[:, e0 + 1:e1 + 1] = scores[:, lo:hi][:, parent] + log_probs[:, parent, child_tokens[e0:e1]]
+                    if level == len(bounds) - 1 or e1 == e0:
+                        break
+                    # Children inherit their parent's cache row
+                    rows = (batch_rows * width).repeat_interleave(e1 - e0) + parent.repeat(batch_size)
+                    cache = _reorder_cache(self.model, cache, rows)
+                    mask = mask[rows]
+                    lo, hi, width = e0 + 1, e1 + 1, e1 - e0
+
+        leaves = (trie.leaf_item >= 0).nonzero().squeeze(1)
+        leaf_scores = scores[:, leaves]
+        if self.length_penalty != 0.0:
+            leaf_scores = leaf_scores / trie.node_depth[leaves].clamp(min=1).float() ** self.length_penalty
+        blocked = trie.decoding_mask(blocked)
+        if blocked is not None:
+            leaf_scores = leaf_scores.masked_fill(blocked[..., leaves], float('-inf'))
+        k = min(self.top_k, leaves.numel())
+        top_scores, top = leaf_scores.topk(k, dim=1)
+        nodes = leaves[top]
+        item_ids = trie.leaf_item[nodes]
+        sequences = self._paths(nodes.view(-1), edge_parent).view(batch_size, k, -1)
+        if k < self.top_k:
+            pad = self.top_k - k
+            top_scores = torch.cat([top_scores, top_scores.new_full((batch_size, pad), float('-inf'))], dim=1)
+            item_ids = torch.cat([item_ids, item_ids.new_full((batch_size, pad), -1)], dim=1)
+            sequences = torch.cat([sequences, sequences.new_full((batch_size, pad, sequences.size(2)), trie.eos_token_id)], dim=1)
+        item_ids = torch.where(top_scores > float('-inf'), item_ids, -1)
+        return SIDBeamOutput(item_ids=item_ids, scores=top_scores, sequences=sequences)
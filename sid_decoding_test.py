@@ -0,0 +1,167 @@
+import unittest
+import itertools
+import os
+import sys
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from bench_decoding import EOS, NEWLINE, PREFIX, generate_items, tiny_model
+from sid_decoding import (
+    SIDBeamSearch, SIDExhaustiveScorer, StaticSIDBeamSearch, _reorder_cache, grouped_completion_logits,
+    hidden_states_head, kv_cache_enabled, prefill_cache, token_logps,
+)
+from sid_trie import SIDTrie
+
+# 3-level SIDs over a codebook of 3, level tokens placed after the prompt tokens
+SEQUENCES = [
+    [100 + a, 110 + b, 120 + c, NEWLINE, EOS] for a, b, c in itertools.product(range(3), repeat=3)
+]
+
+
+def left_padded_prompts(lengths, vocab_low=5, vocab_high=100, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    width = max(lengths)
+    input_ids = torch.full((len(lengths), width), EOS)
+    attention_mask = torch.zeros(len(lengths), width, dtype=torch.long)
+    for row, length in enumerate(lengths):
+        input_ids[row, width - length:] = torch.randint(vocab_low, vocab_high, (length,), generator=g)
+        input_ids[row, -len(PREFIX):] = torch.tensor(PREFIX)
+        attention_mask[row, width - length:] = 1
+    return input_ids, attention_mask
+
+
+class TestSIDSearch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = tiny_model(vocab_size=1000)
+        cls.trie = SIDTrie.from_sequences(SEQUENCES, prefix_ids=PREFIX, eos_token_id=EOS)
+        cls.input_ids, cls.attention_mask = left_padded_prompts([12, 8, 10])
+
+    @torch.no_grad()
+    def brute_force_scores(self):
+        """Sequence log-prob of every item for every prompt, from one full forward per prompt"""
+        completions = torch.tensor(SEQUENCES)
+        width = self.input_ids.size(1)
+        scores = []
+        for input_ids, attention_mask in zip(self.input_ids, self.attention_mask):
+            input_ids = torch.cat([input_ids.expand(len(SEQUENCES), -1), completions], dim=1)
+            attention_mask = torch.cat([attention_mask.expand(len(SEQUENCES), -1), torch.ones_like(completions)], dim=1)
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+            logits = self.model(input_ids, attention_mask=attention_mask, position_ids=position_ids).logits
+            logps = logits[:, width - 1:-1].log_softmax(-1).gather(-1, completions.unsqueeze(-1)).squeeze(-1)
+            scores.append(logps.sum(dim=1))
+        return torch.stack(scores)
+
+    def test_exhaustive_matches_brute_force(self):
+        expected_scores, expected_items = self.brute_force_scores().topk(10, dim=1)
+        for chunk_size in (1024, 4):
+            out = SIDExhaustiveScorer(self.model, self.trie, 10, chunk_size=chunk_size)(
+                self.input_ids, self.attention_mask
+            )
+            self.assertTrue(torch.equal(out.item_ids, expected_items))
+            self.assertTrue(torch.allclose(out.scores, expected_scores, atol=1e-4))
+
+    def test_beam_search_matches_generate(self):
+        """At full vocabulary the trie beam search returns the items of constrained `generate`"""
+        expected = generate_items(self.model, self.trie, self.input_ids, self.attention_mask, 8)
+        items = SIDBeamSearch(self.model, self.trie, 8)(self.input_ids, self.attention_mask).item_ids
+        self.assertTrue(torch.equal(items, expected))
+        items = StaticSIDBeamSearch(self.model, self.trie, 8)(self.input_ids, self.attention_mask).item_ids
+        self.assertTrue(torch.equal(items, expected))
+        items = generate_items(self.model, self.trie, self.input_ids, self.attention_mask, 8, prefill_once=True)
+        self.assertTrue(torch.equal(items, expected))
+
+    def test_blocked(self):
+        """Excluded items never come back; exhaustive scoring ranks the remaining ones exactly"""
+        scores = self.brute_force_scores()
+        excluded = scores.topk(3, dim=1).indices[:, 1:]
+        blocked = self.trie.blocked_nodes(torch.cat([excluded, torch.full_like(excluded[:, :1], -1)], dim=1))
+        expected = scores.scatter(1, excluded, float('-inf')).topk(5, dim=1).indices
+        search = SIDExhaustiveScorer(self.model, self.trie, 5)
+        items = search(self.input_ids, self.attention_mask, blocked=blocked).item_ids
+        self.assertTrue(torch.equal(items, expected))
+
+        items = SIDBeamSearch(self.model, self.trie, 5)(self.input_ids, self.attention_mask, blocked=blocked).item_ids
+        self.assertTrue((items >= 0).all())
+        for row in range(items.size(0)):
+            self.assertFalse(set(items[row].tolist()) & set(excluded[row].tolist()))
+
+    def test_prefill_under_gradient_checkpointing(self):
+        """Checkpointing drops the KV cache in training mode unless it is turned off for generation"""
+        model = tiny_model(vocab_size=1000)
+        model.gradient_checkpointing_enable()
+        model.train()
+        try:
+            with self.assertRaises(ValueError):
+                prefill_cache(model, self.input_ids, self.attention_mask, 2)
+            with kv_cache_enabled(model):
+                cache, _, _ = prefill_cache(model, self.input_ids, self.attention_mask, 2)
+            self.assertTrue(model.is_gradient_checkpointing)
+        finally:
+            model.gradient_checkpointing_disable()
+            model.eval()
+        expected, _, _ = prefill_cache(model, self.input_ids, self.attention_mask, 2)
+        self.assertEqual(cache.get_seq_length(), expected.get_seq_length())
+        self.assertTrue(torch.allclose(cache.layers[0].keys, expected.layers[0].keys, atol=1e-5))
+        with self.assertRaises(ValueError):
+            _reorder_cache(model, None, torch.tensor([0]))
+
+
+class TestCompletionLogps(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = tiny_model(vocab_size=300)
+        prompt_ids, prompt_mask = left_padded_prompts([9, 6])
+        g = torch.Generator().manual_seed(1)
+        cls.group_size, cls.completion_length = 3, 4
+        completions = torch.randint(5, 300, (2 * cls.group_size, cls.completion_length), generator=g)
+        cls.input_ids = torch.cat([prompt_ids.repeat_interleave(cls.group_size, dim=0), completions], dim=1)
+        cls.attention_mask = torch.cat([
+            prompt_mask.repeat_interleave(cls.group_size, dim=0), torch.ones_like(completions)
+        ], dim=1)
+
+    def test_grouped_completion_logits(self):
+        L = self.completion_length
+        with torch.no_grad():
+            expected = self.model(
+                input_ids=self.input_ids, attention_mask=self.attention_mask, logits_to_keep=L + 1
+            ).logits[:, :-1]
+            logits = grouped_completion_logits(self.model, self.input_ids, self.attention_mask, L, self.group_size)
+        self.assertEqual(logits.shape, expected.shape)
+        self.assertTrue(torch.allclose(logits, expected, atol=1e-4))
+
+    def test_token_logps(self):
+        """Chunked and SID-restricted log-probs match log_softmax over the full logits, gradients too"""
+        L = self.completion_length
+        targets = self.input_ids[:, -L:]
+        with hidden_states_head(self.model) as lm_head:
+            hidden = self.model(
+                input_ids=self.input_ids, attention_mask=self.attention_mask, logits_to_keep=L + 1
+            ).logits[:, :-1].detach()
+        vocab_ids = torch.unique(targets[:, :2])
+
+        def reference(hidden_states, vocab_ids=None):
+            logits = lm_head(hidden_states).float()
+            if vocab_ids is None:
+                return logits.log_softmax(-1).gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+            local = torch.searchsorted(vocab_ids, targets.contiguous()).clamp(max=vocab_ids.numel() - 1)
+            valid = vocab_ids[local] == targets
+            logps = logits[..., vocab_ids].log_softmax(-1).gather(-1, local.unsqueeze(-1)).squeeze(-1)
+            return torch.where(valid, logps, 0.0)
+
+        for ids in (None, vocab_ids):
+            hidden_ref = hidden.clone().requires_grad_()
+            expected = reference(hidden_ref, ids)
+            expected.sum().backward()
+            for chunk_size in (0, 5):
+                hidden_states = hidden.clone().requires_grad_()
+                logps = token_logps(hidden_states, lm_head, targets, vocab_ids=ids, chunk_size=chunk_size)
+                self.assertTrue(torch.allclose(logps, expected, atol=1e-5))
+                logps.sum().backward()
+                self.assertTrue(torch.allclose(hidden_states.grad, hidden_ref.grad, atol=1e-5))
+        self.assertTrue((logps[:, 2:] == 0).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,533 @@
+"""
+Tensorized prefix trie over tokenized semantic IDs.
+
+Every catalog item is tokenized as `### Response:\n<a_X><b_Y><c_Z>\n` followed by EOS.
+The tokens of the shared response header form the trie prefix, the remaining tokens
+form one root-to-leaf path per item. The trie is compiled into flat tensors so that
+constrained decoding can advance all beams and build the full `(batch*beams, vocab)`
+mask with a handful of gather/scatter ops instead of a per-row Python loop:
+
+    child_ptr    (num_nodes + 1,)  CSR offsets into the edge arrays
+    child_tokens (num_edges,)      edge token ids, sorted by token within each node
+    child_nodes  (num_edges,)      edge target node ids
+    edge_keys    (num_edges,)      parent * key_stride + token, globally sorted
+    node_depth   (num_nodes,)      number of tokens between the root and the node
+    leaf_item    (num_nodes,)      item index for nodes reached through EOS, -1 otherwise
+
+Nodes are numbered breadth-first, so nodes of the same depth are contiguous and the target
+of edge `e` is node `e + 1`.
+
+Items can be taken out of (and put back into) the catalog at runtime with `set_available`,
+without rebuilding anything: updates are staged from any thread and applied in O(depth) per
+item by the decoder between batches, which swaps in a new availability snapshot so that masks
+handed out earlier never change, see `sync_availability`.
+
+Compiled tries are cached on disk keyed by a hash of the tokenizer and the info file, and
+loaded memory-mapped. The index also holds the tensors derived from the edges (vocabulary,
+parents, level ranges, subtree leaf counts, item leaves), so loading and `to` copy them
+instead of recomputing them. Prebuild the index once before fanning out workers:
+
+    python sid_trie.py --base_model path_to_model --info_file ./data/Amazon/info/xxx.txt
+"""
+
+import collections
+import hashlib
+import os
+import threading
+
+import fire
+import torch
+
+INVALID_NODE = -1
+INDEX_VERSION = 2
+TOKENIZER_FILES = [
+    "tokenizer.json", "tokenizer_config.json", "vocab.json", "merges.txt",
+    "added_tokens.json", "special_tokens_map.json", "tokenizer.model",
+]
+
+
+class SIDTrie:
+
+    def __init__(
+        self,
+        child_ptr: torch.Tensor,
+        child_tokens: torch.Tensor,
+        child_nodes: torch.Tensor,
+        node_depth: torch.Tensor,
+        leaf_item: torch.Tensor,
+        prefix_ids: torch.Tensor,
+        eos_token_id: int,
+        key_stride: int,
+        edge_keys: torch.Tensor = None,
+        vocab_ids: torch.Tensor = None,
+        local_child_tokens: torch.Tensor = None,
+        node_parent: torch.Tensor = None,
+        level_ptr: torch.Tensor = None,
+        subtree_leaves: torch.Tensor = None,
+        item_leaf: torch.Tensor = None,
+    ):
+        # Tensors derived from the edges are computed here unless passed in, as `load` and `to` do
+        self.child_ptr = child_ptr
+        self.child_tokens = child_tokens
+        self.child_nodes = child_nodes
+        self.node_depth = node_depth
+        self.leaf_item = leaf_item
+        self.prefix_ids = prefix_ids
+        self.eos_token_id = eos_token_id
+        self.key_stride = key_stride
+
+        if edge_keys is None:
+            edge_keys = self._edge_parents() * key_stride + child_tokens
+        self.edge_keys = edge_keys
+        # Union of every token the constraint can emit, for LM heads restricted to the SID vocabulary
+        if vocab_ids is None:
+            vocab_ids = torch.unique(torch.cat([child_tokens, child_tokens.new_tensor([eos_token_id])]))
+        self.vocab_ids = vocab_ids
+        if local_child_tokens is None:
+            local_child_tokens = torch.searchsorted(self.vocab_ids, child_tokens)
+        self.local_child_tokens = local_child_tokens
+        self.local_eos = int(torch.searchsorted(self.vocab_ids, child_tokens.new_tensor(eos_token_id)).item())
+        self.max_degree = int((child_ptr[1:] - child_ptr[:-1]).max().item()) if self.num_nodes > 0 else 0
+        self.depth = int(node_depth.max().item()) if self.num_nodes > 0 else 0
+
+        # Parent of every node, its BFS level ranges, and the number of leaves below it, for exclusions
+        if node_parent is None:
+            node_parent = torch.cat([child_ptr.new_full((min(self.num_nodes, 1),), INVALID_NODE), self._edge_parents()])
+        self.node_parent = node_parent
+        if level_ptr is None:
+            level_ptr = torch.searchsorted(node_depth, torch.arange(self.depth + 2, device=node_depth.device))
+        self.level_ptr = level_ptr
+        if subtree_leaves is None:
+            subtree_leaves = self._count_up((leaf_item >= 0).int().unsqueeze(0)).squeeze(0)
+        self.subtree_leaves = subtree_leaves
+        if item_leaf is None:
+            leaves = (leaf_item >= 0).nonzero().squeeze(1)
+            item_leaf = torch.full(
+                (int(leaf_item.max().item()) + 1 if self.num_nodes > 0 else 0,), INVALID_NODE,
+                dtype=torch.long, device=leaf_item.device,
+            )
+            item_leaf[leaf_item[leaves]] = leaves
+        self.item_leaf = item_leaf
+
+        # Runtime availability as one `(disabled_leaves, unavailable)` snapshot, allocated on the first
+        # update so that a static catalog costs nothing and replaced as a whole by every sync
+        self._availability = None
+        self._availability_updates = collections.deque()
+        self._availability_lock = threading.Lock()
+
+    @property
+    def num_nodes(self):
+        return self.child_ptr.numel() - 1
+
+    @property
+    def num_items(self):
+        return int((self.leaf_item >= 0).sum().item())
+
+    @property
+    def device(self):
+        return self.child_ptr.device
+
+    @property
+    def disabled_leaves(self):
+        """`(num_nodes,)` count of disabled leaves under every node, None while no item was disabled."""
+        return None if self._availability is None else self._availability[0]
+
+    @property
+    def unavailable(self):
+        """`(num_nodes,)` bool mask of the nodes without an available item, None while no item was disabled."""
+        return None if self._availability is None else self._availability[1]
+
+    def _edge_parents(self):
+        return torch.repeat_interleave(
+            torch.arange(self.num_nodes, device=self.child_ptr.device), self.child_ptr[1:] - self.child_ptr[:-1]
+        )
+
+    def _count_up(self, counts):
+        """Sum `(rows, num_nodes)` per-node counts over every subtree, one level at a time from the leaves."""
+        counts = counts.clone()
+        for depth in range(self.depth, 0, -1):
+            lo, hi = int(self.level_ptr[depth]), int(self.level_ptr[depth + 1])
+            counts.index_add_(1, self.node_parent[lo:hi], counts[:, lo:hi].clone())
+        return counts
+
+    @classmethod
+    def from_sequences(cls, sequences, prefix_ids, eos_token_id):
+        """Compile a trie from per-item token sequences.
+
+        Args:
+            sequences: list of token id lists, one per item, each ending with `eos_token_id`.
+                The position in the list is the item index stored on the leaf.
+            prefix_ids: token ids of the response header every sequence is generated after.
+            eos_token_id: id of the token terminating every sequence.
+        """
+        children = [dict()]
+        leaf_item = [INVALID_NODE]
+        depth = [0]
+        for item_index, seq in enumerate(sequences):
+            node = 0
+            for token in seq:
+                token = int(token)
+                nxt = children[node].get(token)
+                if nxt is None:
+                    nxt = len(children)
+                    children[node][token] = nxt
+                    children.append(dict())
+                    leaf_item.append(INVALID_NODE)
+                    depth.append(depth[node] + 1)
+                node = nxt
+            # Items sharing a semantic ID resolve to the first one, as in calc.py
+            if leaf_item[node] == INVALID_NODE:
+                leaf_item[node] = item_index
+
+        # Renumber breadth-first so every level is a contiguous node range
+        order = [0]
+        for node in order:
+            order.extend(children[node][t] for t in sorted(children[node]))
+        new_id = [0] * len(order)
+        for i, node in enumerate(order):
+            new_id[node] = i
+
+        child_ptr = [0]
+        child_tokens = []
+        child_nodes = []
+        for node in order:
+            for token in sorted(children[node]):
+                child_tokens.append(token)
+                child_nodes.append(new_id[children[node][token]])
+            child_ptr.append(len(child_tokens))
+
+        key_stride = max(child_tokens + [int(eos_token_id)]) + 1
+        return cls(
+            child_ptr=torch.tensor(child_ptr, dtype=torch.long),
+            child_tokens=torch.tensor(child_tokens, dtype=torch.long),
+            child_nodes=torch.tensor(child_nodes, dtype=torch.long),
+            node_depth=torch.tensor([depth[node] for node in order], dtype=torch.long),
+            leaf_item=torch.tensor([leaf_item[node] for node in order], dtype=torch.long),
+            prefix_ids=torch.tensor(list(prefix_ids), dtype=torch.long),
+            eos_token_id=int(eos_token_id),
+            key_stride=key_stride,
+        )
+
+    def state_dict(self):
+        return {
+            "child_ptr": self.child_ptr,
+            "child_tokens": self.child_tokens,
+            "child_nodes": self.child_nodes,
+            "node_depth": self.node_depth,
+            "leaf_item": self.leaf_item,
+            "prefix_ids": self.prefix_ids,
+            "edge_keys": self.edge_keys,
+            "vocab_ids": self.vocab_ids,
+            "local_child_tokens": self.local_child_tokens,
+            "node_parent": self.node_parent,
+            "level_ptr": self.level_ptr,
+            "subtree_leaves": self.subtree_leaves,
+            "item_leaf": self.item_leaf,
+            "eos_token_id": self.eos_token_id,
+            "key_stride": self.key_stride,
+        }
+
+    def save(self, path):
+        # Write next to the target and rename, so concurrent builders never expose a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save({"version": INDEX_VERSION, **self.state_dict()}, tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a saved trie. With `mmap`, tensors are backed by the file's pages, which forked
+        workers and every process on the host share instead of holding private copies."""
+        state = torch.load(path, map_location="cpu", mmap=mmap, weights_only=True)
+        if state.pop("version", None) != INDEX_VERSION:
+            raise ValueError(f"Unsupported SID trie index version in {path}")
+        return cls(**state)
+
+    def to(self, device):
+        if torch.device(device) == self.device:
+            return self
+        moved = SIDTrie(**{
+            k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in self.state_dict().items()
+        })
+        # The copy starts from the current availability; later updates go to whichever trie they are made on,
+        # so move a trie once and hand that copy to the decoders (they use the trie they are given)
+        state = self._synced_availability()
+        if state is not None:
+            moved._availability = tuple(t.to(device) for t in state)
+        return moved
+
+    def set_available(self, items, available):
+        """Stage enabling (`available=True`) or disabling the leaves of catalog item indices `items`.
+
+        Safe to call from any thread while decoding runs: updates only take effect at the next
+        `sync_availability`, so a batch never sees a half-applied change. Items sharing a semantic
+        ID share one leaf, named after the first of them.
+        """
+        self._availability_updates.append((torch.as_tensor(items, dtype=torch.long).view(-1), bool(available)))
+
+    def _synced_availability(self):
+        """Apply the staged updates and return the current `(disabled_leaves, unavailable)` snapshot.
+
+        The updates are applied to copies of the snapshot, which then replace it in one assignment,
+        so tensors returned earlier keep describing the availability they were computed from.
+        """
+        with self._availability_lock:
+            if not self._availability_updates:
+                return self._availability
+            state = self._availability
+            disabled_leaves, unavailable = (None, None) if state is None else (state[0].clone(), state[1].clone())
+            while self._availability_updates:
+                items, available = self._availability_updates.popleft()
+                if unavailable is None:
+                    if available:
+                        continue
+                    disabled_leaves = torch.zeros_like(self.subtree_leaves)
+                    unavailable = torch.zeros(self.num_nodes, dtype=torch.bool, device=self.device)
+                leaves = self.item_leaf[items.to(self.device)]
+                leaves = leaves[leaves >= 0].unique()
+                # Only leaves whose state flips move the counts
+                nodes = leaves[unavailable[leaves] == available]
+                delta = torch.full_like(nodes, -1 if available else 1, dtype=disabled_leaves.dtype)
+                while nodes.numel() > 0:
+                    disabled_leaves.index_add_(0, nodes, delta)
+                    unavailable[nodes] = disabled_leaves[nodes] == self.subtree_leaves[nodes]
+                    parent = self.node_parent[nodes]
+                    nodes, delta = parent[parent >= 0], delta[parent >= 0]
+            if unavailable is not None:
+                self._availability = (disabled_leaves, unavailable)
+            return self._availability
+
+    def sync_availability(self):
+        """Apply the staged updates and return the `(num_nodes,)` bool mask of unavailable nodes.
+
+        A leaf is unavailable while its item is disabled, an inner node while every leaf below it
+        is, so decoding never enters a subtree without an available item. Every changed leaf
+        updates the disabled-leaf counts of its `depth` ancestors. Returns None while no item has
+        ever been disabled. The mask is never modified afterwards: later syncs return a new one.
+        """
+        state = self._synced_availability()
+        return None if state is None else state[1]
+
+    def decoding_mask(self, blocked=None):
+        """Nodes a batch must not enter, from one availability snapshot.
+
+        `blocked` from `blocked_nodes` already covers the unavailable nodes of the snapshot it was
+        computed from and is returned as is; otherwise the unavailable nodes after syncing.
+        """
+        if blocked is not None:
+            return blocked
+        return self.sync_availability()
+
+    def root(self, n, device=None):
+        return torch.zeros(n, dtype=torch.long, device=device or self.device)
+
+    def match_prefix(self, input_ids):
+        """Root for rows whose prompt ends with the response header, INVALID_NODE otherwise."""
+        P = self.prefix_ids.numel()
+        if input_ids.size(1) < P:
+            return torch.full((input_ids.size(0),), INVALID_NODE, dtype=torch.long, device=input_ids.device)
+        ok = (input_ids[:, -P:] == self.prefix_ids).all(dim=1)
+        return torch.where(ok, 0, INVALID_NODE)
+
+    def step(self, nodes, tokens):
+        """Follow the edge labelled `tokens` out of every node in `nodes`.
+
+        Rows without such an edge become INVALID_NODE. Rows sitting on a leaf that emit EOS
+        (padding after a finished sequence) stay on the leaf.
+        """
+        valid = (nodes >= 0) & (tokens >= 0) & (tokens < self.key_stride)
+        keys = nodes.clamp(min=0) * self.key_stride + tokens.clamp(0, self.key_stride - 1)
+        pos = torch.searchsorted(self.edge_keys, keys).clamp(max=max(self.edge_keys.numel() - 1, 0))
+        found = valid & (self.edge_keys[pos] == keys)
+        nxt = torch.where(found, self.child_nodes[pos], INVALID_NODE)
+        finished = (nodes >= 0) & (self.leaf_item[nodes.clamp(min=0)] >= 0) & (tokens == self.eos_token_id)
+        return torch.where(finished, nodes, nxt)
+
+    def walk(self, nodes, token_matrix):
+        """Advance `nodes` over every column of `token_matrix` (rows, steps)."""
+        for i in range(token_matrix.size(1)):
+            nodes = self.step(nodes, token_matrix[:, i])
+        return nodes
+
+    def completion_items(self, completions):
+        """Item index of every completion row, read off the trie leaf it ends on.
+
+        `completions` (rows, steps) holds the tokens generated after the response header. Rows
+        that do not spell a whole SID followed only by EOS padding get INVALID_NODE.
+        """
+        completions = completions.to(self.device)
+        width = min(completions.size(1), self.depth)
+        nodes = self.walk(self.root(completions.size(0)), completions[:, :width])
+        items = torch.where(nodes >= 0, self.leaf_item[nodes.clamp(min=0)], INVALID_NODE)
+        padded = (completions[:, width:] == self.eos_token_id).all(dim=1)
+        return torch.where(padded, items, INVALID_NODE)
+
+    def blocked_nodes(self, excluded):
+        """`(rows, num_nodes)` bool mask of the nodes that no longer lead to an eligible item.
+
+        `excluded` (rows, k) holds the item indices every row must not produce, padded with -1.
+        The leaves of excluded items are blocked, and so is every node all of whose leaves are
+        excluded, so decoding never enters a subtree it can only leave through an excluded item.
+        Items sharing a semantic ID share one leaf, named after the first of them. Unavailable
+        items (see `set_available`) count as excluded for every row.
+        """
+        state = self._synced_availability()
+        excluded = excluded.to(self.device)
+        valid = (excluded >= 0) & (excluded < self.item_leaf.numel())
+        nodes = self.item_leaf[torch.where(valid, excluded, 0)] if self.item_leaf.numel() else excluded
+        valid &= nodes >= 0
+        rows = torch.arange(excluded.size(0), device=self.device).unsqueeze(1).expand_as(excluded)
+        hits = torch.zeros(excluded.size(0), self.num_nodes, dtype=torch.int, device=self.device)
+        hits[rows[valid], nodes[valid]] = 1
+        if state is None:
+            return self._count_up(hits) == self.subtree_leaves
+        # Leaves both excluded and unavailable are already in disabled_leaves
+        disabled_leaves, unavailable = state
+        hits.masked_fill_(unavailable & (self.leaf_item >= 0), 0)
+        return self._count_up(hits) + disabled_leaves == self.subtree_leaves
+
+    def allowed_tokens(self, nodes, local=False, blocked=None, group_size=1):
+        """Padded `(rows, max_degree)` table of allowed tokens and its validity mask.
+
+        With `local`, tokens are positions in `vocab_ids` instead of vocabulary ids. With
+        `blocked` (see `blocked_nodes`, one row per group of `group_size` consecutive rows, e.g.
+        the beams of a prompt, or a single `(num_nodes,)` row for all of them), edges into blocked
+        nodes are not allowed.
+        """
+        start = self.child_ptr[nodes.clamp(min=0)]
+        degree = torch.where(nodes >= 0, self.child_ptr[nodes.clamp(min=0) + 1] - start, 0)
+        offsets = torch.arange(max(self.max_degree, 1), device=nodes.device)
+        keep = offsets.unsqueeze(0) < degree.unsqueeze(1)
+        idx = (start.unsqueeze(1) + offsets.unsqueeze(0)).clamp(max=max(self.child_tokens.numel() - 1, 0))
+        if blocked is not None and blocked.dim() == 1:
+            keep = keep & ~blocked[self.child_nodes[idx]]
+        elif blocked is not None:
+            group = torch.arange(nodes.numel(), device=nodes.device) // group_size
+            keep = keep & ~blocked[group.unsqueeze(1), self.child_nodes[idx]]
+        child_tokens = self.local_child_tokens if local else self.child_tokens
+        return child_tokens[idx], keep
+
+    def allowed_mask(self, nodes, scores, local=False, blocked=None, group_size=1):
+        """Additive `(rows, vocab)` mask: 0 on allowed tokens, -inf elsewhere.
+
+        Rows with no outgoing edge (finished or invalid) are only allowed EOS. With `local`,
+        `scores` has one column per entry of `vocab_ids`. `blocked` and `group_size` are passed
+        on to `allowed_tokens`.
+        """
+        tokens, keep = self.allowed_tokens(nodes, local=local, blocked=blocked, group_size=group_size)
+        # Padded slots repeat an allowed token (or EOS for empty rows) so one scatter covers all rows
+        first = tokens.gather(1, keep.int().argmax(dim=1, keepdim=True)).squeeze(1)
+        fill = torch.where(keep.any(dim=1), first, self.local_eos if local else self.eos_token_id)
+        tokens = torch.where(keep, tokens, fill.unsqueeze(1))
+        mask = torch.full_like(scores, float('-inf'))
+        mask.scatter_(1, tokens, 0.0)
+        return mask
+
+
+def load_item_sids(info_file):
+    """Semantic ID string of every item, indexed like the trie leaves."""
+    with open(info_file, 'r') as f:
+        return [line.split('\t')[0].strip() for line in f]
+
+
+def load_item_titles(info_file):
+    """Title of every item, indexed like the trie leaves."""
+    with open(info_file, 'r') as f:
+        return [fields[1].strip() if len(fields) >= 2 else "" for fields in (line.split('\t') for line in f)]
+
+
+def item_index(names):
+    """Map from SID (or title) to the first item carrying it, the leaf the trie keeps for duplicates."""
+    index = {}
+    for i, name in enumerate(names):
+        index.setdefault(name, i)
+    return index
+
+
+def tokenize_sids(info_file, tokenizer, base_model):
+    """Tokenize every semantic ID of `info_file` the way the model emits it after the prompt.
+
+    Returns the per-item token lists (with EOS appended) and the number of leading header tokens.
+    """
+    with open(info_file, 'r') as f:
+        info = f.readlines()
+    # Parse new format: semantic_id \t item_title \t item_id
+    semantic_ids = [line.split('\t')[0].strip() + "\n" for line in info]
+    info_semantic = [f'''### Response:\n{_}''' for _ in semantic_ids]
+
+    if base_model.lower().find("llama") > -1:
+        prefixID = [tokenizer(_).input_ids[1:] for _ in info_semantic]
+    else:
+        prefixID = [tokenizer(_).input_ids for _ in info_semantic]
+    if base_model.lower().find("gpt2") > -1:
+        prefix_index = 4
+    else:
+        prefix_index = 3
+    for ID in prefixID:
+        ID.append(tokenizer.eos_token_id)
+    return prefixID, prefix_index
+
+
+def build_sid_trie(info_file, tokenizer, base_model):
+    prefixID, prefix_index = tokenize_sids(info_file, tokenizer, base_model)
+    return SIDTrie.from_sequences(
+        [ID[prefix_index:] for ID in prefixID],
+        prefix_ids=prefixID[0][:prefix_index],
+        eos_token_id=tokenizer.eos_token_id,
+    )
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash of the tokenizer files, falling back to the vocabulary for in-memory tokenizers."""
+    h = hashlib.sha1()
+    name_or_path = getattr(tokenizer, "name_or_path", "")
+    files = [os.path.join(name_or_path, f) for f in TOKENIZER_FILES] if os.path.isdir(name_or_path) else []
+    files = [f for f in files if os.path.isfile(f)]
+    if files:
+        for f in files:
+            with open(f, 'rb') as fin:
+                h.update(os.path.basename(f).encode())
+                h.update(fin.read())
+    else:
+        h.update(repr(sorted(tokenizer.get_vocab().items())).encode())
+    h.update(str(tokenizer.eos_token_id).encode())
+    return h.hexdigest()
+
+
+def index_key(info_file, tokenizer, base_model):
+    h = hashlib.sha1()
+    h.update(f"v{INDEX_VERSION}".encode())
+    with open(info_file, 'rb') as f:
+        h.update(f.read())
+    h.update(tokenizer_fingerprint(tokenizer).encode())
+    # The tokenization rules in tokenize_sids branch on the model name
+    h.update(f"llama={base_model.lower().find('llama') > -1},gpt2={base_model.lower().find('gpt2') > -1}".encode())
+    return h.hexdigest()[:16]
+
+
+def default_cache_dir(info_file):
+    return os.environ.get("SID_TRIE_CACHE", os.path.join(os.path.dirname(os.path.abspath(info_file)), ".trie_cache"))
+
+
+def load_or_build_sid_trie(info_file, tokenizer, base_model, cache_dir=None, mmap=True):
+    """Load the compiled trie for (tokenizer, info_file) from the cache, building it on a miss."""
+    cache_dir = cache_dir or default_cache_dir(info_file)
+    path = os.path.join(cache_dir, f"sid_trie-{index_key(info_file, tokenizer, base_model)}.pt")
+    if os.path.exists(path):
+        return SIDTrie.load(path, mmap=mmap)
+    trie = build_sid_trie(info_file, tokenizer, base_model)
+    os.makedirs(cache_dir, exist_ok=True)
+    trie.save(path)
+    return SIDTrie.load(path, mmap=mmap)
+
+
+def prebuild(base_model: str = "", info_file: str = "", cache_dir: str = None):
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(base_model)
+    cache_dir = cache_dir or default_cache_dir(info_file)
+    trie = load_or_build_sid_trie(info_file, tokenizer, base_model, cache_dir=cache_dir)
+    print(f"SID trie: {trie.num_items} items, {trie.num_nodes} nodes, depth {trie.depth} -> {cache_dir}")
+
+
+if __name__ == '__main__':
+    fire.Fire(prebuild)
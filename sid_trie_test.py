@@ -0,0 +1,195 @@
+import unittest
+import tempfile
+import os
+import sys
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from bench_decoding import synthetic_catalog, synthetic_prompts, tiny_model
+from sid_decoding import SIDBeamSearch
+from sid_trie import INVALID_NODE, SIDTrie
+
+EOS = 0
+NEWLINE = 1
+PREFIX = [2, 3, 4]
+# Items 0 and 1 share <a_10><b_20>, items 0-2 share <a_10>
+SEQUENCES = [
+    [10, 20, 30, NEWLINE, EOS],
+    [10, 20, 31, NEWLINE, EOS],
+    [10, 21, 30, NEWLINE, EOS],
+    [11, 20, 30, NEWLINE, EOS],
+]
+
+
+class TestSIDTrie(unittest.TestCase):
+    def setUp(self):
+        self.trie = SIDTrie.from_sequences(SEQUENCES, prefix_ids=PREFIX, eos_token_id=EOS)
+
+    def node(self, tokens):
+        trie = self.trie
+        return trie.walk(trie.root(1), torch.tensor([tokens]))[0]
+
+    def test_step(self):
+        """Steps follow trie edges, leave it on unknown tokens and stay on a leaf on EOS"""
+        trie = self.trie
+        self.assertEqual(trie.depth, 5)
+        self.assertEqual(trie.num_items, 4)
+        leaves = trie.walk(trie.root(4), torch.tensor(SEQUENCES))
+        self.assertEqual(trie.leaf_item[leaves].tolist(), [0, 1, 2, 3])
+        self.assertEqual(trie.step(leaves, torch.full((4,), EOS)).tolist(), leaves.tolist())
+
+        nodes = trie.step(trie.root(3), torch.tensor([10, 12, -1]))
+        self.assertGreaterEqual(nodes[0].item(), 0)
+        self.assertEqual(nodes[1:].tolist(), [INVALID_NODE, INVALID_NODE])
+        self.assertEqual(trie.step(nodes, torch.tensor([20, 20, 20]))[1:].tolist(), [INVALID_NODE, INVALID_NODE])
+
+    def test_allowed_mask(self):
+        """Only the children of a node are allowed, only EOS off the trie"""
+        trie = self.trie
+        nodes = torch.stack([trie.root(1)[0], self.node([10]), self.node([10, 20]), torch.tensor(INVALID_NODE)])
+        mask = trie.allowed_mask(nodes, torch.zeros(4, 40))
+        allowed = [(row == 0).nonzero().squeeze(1).tolist() for row in mask]
+        self.assertEqual(allowed, [[10, 11], [20, 21], [30, 31], [EOS]])
+
+    def test_match_prefix(self):
+        trie = self.trie
+        input_ids = torch.tensor([[7, 2, 3, 4], [2, 3, 4, 7], [7, 7, 3, 4]])
+        self.assertEqual(trie.match_prefix(input_ids).tolist(), [0, INVALID_NODE, INVALID_NODE])
+        self.assertEqual(trie.match_prefix(input_ids[:, :2]).tolist(), [INVALID_NODE] * 3)
+
+    def test_completion_items(self):
+        """Whole SIDs followed only by EOS padding map to their item, anything else to -1"""
+        completions = torch.tensor([
+            SEQUENCES[2] + [EOS, EOS],
+            SEQUENCES[0] + [EOS, EOS],
+            SEQUENCES[3][:3] + [EOS] * 4,
+            SEQUENCES[1] + [EOS, 17],
+            [12, 20, 30, NEWLINE, EOS, EOS, EOS],
+        ])
+        self.assertEqual(self.trie.completion_items(completions).tolist(), [2, 0, -1, -1, -1])
+        self.assertEqual(self.trie.completion_items(torch.tensor([SEQUENCES[3][:4]])).tolist(), [-1])
+
+    def test_decoding_mask(self):
+        trie = self.trie
+        self.assertIsNone(trie.decoding_mask())
+        blocked = torch.zeros(2, trie.num_nodes, dtype=torch.bool)
+        self.assertIs(trie.decoding_mask(blocked), blocked)
+        trie.set_available([3], False)
+        unavailable = trie.decoding_mask()
+        self.assertEqual(unavailable.nonzero().squeeze(1).tolist(), sorted(
+            self.node(SEQUENCES[3][:n]).item() for n in range(1, 6)
+        ))
+
+    def test_blocked_nodes(self):
+        """Excluded leaves are blocked, and so are nodes all of whose leaves are excluded"""
+        trie = self.trie
+        blocked = trie.blocked_nodes(torch.tensor([[0, 1, -1], [0, 2, 9]]))
+        self.assertTrue(blocked[0, self.node(SEQUENCES[0])] and blocked[0, self.node(SEQUENCES[1])])
+        self.assertTrue(blocked[0, self.node([10, 20])])
+        self.assertFalse(blocked[0, self.node([10])] or blocked[0, self.node(SEQUENCES[2])])
+        self.assertFalse(blocked[1, self.node([10, 20])] or blocked[1, self.node([10])])
+        # The <c_30>, newline and leaf nodes of item 0, and the whole <b_21> branch of item 2
+        self.assertEqual(int(blocked[1].sum()), 3 + 4)
+
+        mask = trie.allowed_mask(torch.stack([self.node([10])] * 2), torch.zeros(2, 40), blocked=blocked)
+        self.assertEqual((mask[0] == 0).nonzero().squeeze(1).tolist(), [21])
+        self.assertEqual((mask[1] == 0).nonzero().squeeze(1).tolist(), [20])
+
+    def test_set_available(self):
+        """Disabling every leaf under a node makes it unavailable, re-enabling one restores it"""
+        trie = self.trie
+        trie.set_available([0], True)
+        self.assertIsNone(trie.sync_availability())
+        trie.set_available([0, 1], False)
+        unavailable = trie.sync_availability()
+        self.assertTrue(unavailable[self.node([10, 20])])
+        self.assertFalse(unavailable[self.node([10])] or unavailable[0])
+        self.assertEqual(trie.disabled_leaves[self.node([10])].item(), 2)
+
+        trie.set_available([2], False)
+        trie.set_available([1], True)
+        unavailable = trie.sync_availability()
+        self.assertFalse(unavailable[self.node([10, 20])] or unavailable[self.node([10])])
+        self.assertTrue(unavailable[self.node(SEQUENCES[2])] and unavailable[self.node([10, 21])])
+
+        # Unavailable items count as excluded for every row
+        blocked = trie.blocked_nodes(torch.tensor([[1, -1]]))
+        self.assertTrue(blocked[0, self.node([10])])
+
+    def test_save_load(self):
+        trie = self.trie
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trie.pt")
+            trie.save(path)
+            loaded = SIDTrie.load(path)
+            for name, value in trie.state_dict().items():
+                if isinstance(value, torch.Tensor):
+                    self.assertTrue(torch.equal(getattr(loaded, name), value), name)
+                else:
+                    self.assertEqual(getattr(loaded, name), value, name)
+            self.assertEqual(loaded.completion_items(torch.tensor(SEQUENCES)).tolist(), [0, 1, 2, 3])
+
+
+class TestSIDTrieAvailability(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = tiny_model(vocab_size=1000)
+        cls.input_ids, cls.attention_mask = synthetic_prompts(batch_size=2, prompt_len=16)
+
+    def setUp(self):
+        self.trie = synthetic_catalog(200, codebook_size=8)
+
+    def test_sync_swaps_snapshot(self):
+        """Masks returned by earlier syncs keep the availability they were computed from"""
+        trie = self.trie
+        trie.set_available([0, 1], False)
+        before = trie.sync_availability()
+        kept = before.clone()
+        trie.set_available([1], True)
+        trie.set_available([2], False)
+        after = trie.sync_availability()
+        self.assertTrue(torch.equal(before, kept))
+        self.assertEqual(after[trie.item_leaf[[0, 1, 2]]].tolist(), [True, False, True])
+
+    def test_blocked_nodes_single_snapshot(self):
+        """decoding_mask keeps the snapshot blocked_nodes was computed from"""
+        trie = self.trie
+        trie.set_available([0], False)
+        blocked = trie.blocked_nodes(torch.tensor([[3, -1]]))
+        trie.set_available([4], False)
+        self.assertIs(trie.decoding_mask(blocked), blocked)
+        self.assertTrue(blocked[0, trie.item_leaf[[0, 3]]].all())
+        self.assertFalse(blocked[0, trie.item_leaf[4]])
+        self.assertTrue(trie.decoding_mask()[trie.item_leaf[4]])
+
+    def test_toggle_during_decoding(self):
+        """Items disabled while a batch decodes only drop out from the next batch on"""
+        trie = self.trie
+        search = SIDBeamSearch(self.model, trie, 5)
+        trie.set_available([0], False)
+        expected = search(self.input_ids, self.attention_mask).item_ids
+
+        calls = []
+
+        def disable_results(module, args, output):
+            calls.append(module)
+            if len(calls) == 2:
+                trie.set_available(expected.flatten(), False)
+                trie.sync_availability()
+
+        handle = self.model.register_forward_hook(disable_results)
+        try:
+            items = search(self.input_ids, self.attention_mask).item_ids
+        finally:
+            handle.remove()
+        self.assertGreater(len(calls), 2)
+        self.assertTrue(torch.equal(items, expected))
+
+        items = search(self.input_ids, self.attention_mask).item_ids
+        self.assertTrue((items >= 0).all())
+        self.assertFalse(set(items.flatten().tolist()) & set(expected.flatten().tolist()))
+
+
+if __name__ == '__main__':
+    unittest.main()
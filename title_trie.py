@@ -0,0 +1,381 @@
+"""
+Path-compressed (radix) trie over tokenized item titles, for title-constrained decoding.
+
+Every catalog item is tokenized as `### Response:\n<title>\n` followed by EOS, like the
+semantic IDs in `sid_trie.py`. Titles are long and share little beyond their first words, so
+a trie with one node per token is mostly single-child chains. Here every chain is collapsed
+into one edge labelled with its token run, and the trie is compiled into flat tensors:
+
+    label_ptr    (num_nodes + 1,)  CSR offsets into label_tokens, the run leading into each node
+    label_tokens (num_positions,)  edge labels of all nodes, the root holds a single sentinel
+    child_ptr    (num_nodes + 1,)  CSR offsets into the child arrays
+    child_tokens (num_edges,)      first label token of every child, sorted within each node
+    child_nodes  (num_edges,)      child node ids
+    edge_keys    (num_edges,)      parent * key_stride + first token, globally sorted
+    leaf_item    (num_nodes,)      item index for nodes whose label ends with EOS, -1 otherwise
+
+A decoding state is a position in `label_tokens`: inside a label the only allowed token is the
+next one of the run, at the end of a label the children's first tokens are. The class exposes
+the state interface of `SIDTrie` used by `ConstrainedLogitsProcessor` (`root`, `step`,
+`allowed_mask`, ...), so the processor runs on either. Print memory and lookup cost against
+the per-prefix hash dict for a catalog with:
+
+    python title_trie.py --base_model path_to_model --info_file ./data/Amazon/info/xxx.txt
+"""
+
+import sys
+import time
+
+import fire
+import torch
+
+from sid_trie import INVALID_NODE, SIDTrie
+
+ROOT_LABEL = -1
+
+
+class TitleTrie:
+
+    def __init__(
+        self,
+        label_ptr: torch.Tensor,
+        label_tokens: torch.Tensor,
+        child_ptr: torch.Tensor,
+        child_tokens: torch.Tensor,
+        child_nodes: torch.Tensor,
+        leaf_item: torch.Tensor,
+        prefix_ids: torch.Tensor,
+        eos_token_id: int,
+        key_stride: int,
+        depth: int,
+        edge_keys: torch.Tensor = None,
+    ):
+        self.label_ptr = label_ptr
+        self.label_tokens = label_tokens
+        self.child_ptr = child_ptr
+        self.child_tokens = child_tokens
+        self.child_nodes = child_nodes
+        self.leaf_item = leaf_item
+        self.prefix_ids = prefix_ids
+        self.eos_token_id = eos_token_id
+        self.key_stride = key_stride
+        self.depth = depth
+
+        if edge_keys is None:
+            parents = torch.repeat_interleave(
+                torch.arange(self.num_nodes, device=child_ptr.device), child_ptr[1:] - child_ptr[:-1]
+            )
+            edge_keys = parents * key_stride + child_tokens
+        self.edge_keys = edge_keys
+        self.vocab_ids = torch.unique(torch.cat([label_tokens[1:], label_tokens.new_tensor([eos_token_id])]))
+        self.local_label_tokens = torch.searchsorted(self.vocab_ids, label_tokens)
+        self.local_child_tokens = torch.searchsorted(self.vocab_ids, child_tokens)
+        self.local_eos = int(torch.searchsorted(self.vocab_ids, label_tokens.new_tensor(eos_token_id)).item())
+        self.max_degree = int((child_ptr[1:] - child_ptr[:-1]).max().item()) if self.num_nodes > 0 else 0
+
+    @property
+    def num_nodes(self):
+        return self.label_ptr.numel() - 1
+
+    @property
+    def num_items(self):
+        return int((self.leaf_item >= 0).sum().item())
+
+    @property
+    def device(self):
+        return self.label_ptr.device
+
+    @classmethod
+    def from_sequences(cls, sequences, prefix_ids, eos_token_id):
+        """Compile a radix trie from per-item token sequences.
+
+        Args:
+            sequences: list of token id lists, one per item, each ending with `eos_token_id`.
+                The position in the list is the item index stored on the leaf.
+            prefix_ids: token ids of the response header every sequence is generated after.
+            eos_token_id: id of the token terminating every sequence.
+        """
+        children = [dict()]
+        leaf_item = [INVALID_NODE]
+        for item_index, seq in enumerate(sequences):
+            node = 0
+            for token in seq:
+                token = int(token)
+                nxt = children[node].get(token)
+                if nxt is None:
+                    nxt = len(children)
+                    children[node][token] = nxt
+                    children.append(dict())
+                    leaf_item.append(INVALID_NODE)
+                node = nxt
+            # Items sharing a title resolve to the first one, as the title lookup did
+            if leaf_item[node] == INVALID_NODE:
+                leaf_item[node] = item_index
+
+        # Collapse single-child chains: an edge runs on until it reaches a branch or a leaf
+        label_ptr, label_tokens = [0, 1], [ROOT_LABEL]
+        child_ptr, child_tokens, child_nodes = [0], [], []
+        radix_leaf, depth = [INVALID_NODE], 0
+        queue = [(0, 0)]
+        for node, length in queue:
+            for token in sorted(children[node]):
+                run, cur = [token], children[node][token]
+                while len(children[cur]) == 1 and leaf_item[cur] == INVALID_NODE:
+                    (nxt_token, cur), = children[cur].items()
+                    run.append(nxt_token)
+                child_tokens.append(token)
+                child_nodes.append(len(radix_leaf))
+                label_tokens.extend(run)
+                label_ptr.append(len(label_tokens))
+                radix_leaf.append(leaf_item[cur])
+                depth = max(depth, length + len(run))
+                queue.append((cur, length + len(run)))
+            child_ptr.append(len(child_tokens))
+
+        key_stride = max(label_tokens + [int(eos_token_id)]) + 1
+        return cls(
+            label_ptr=torch.tensor(label_ptr, dtype=torch.long),
+            label_tokens=torch.tensor(label_tokens, dtype=torch.long),
+            child_ptr=torch.tensor(child_ptr, dtype=torch.long),
+            child_tokens=torch.tensor(child_tokens, dtype=torch.long),
+            child_nodes=torch.tensor(child_nodes, dtype=torch.long),
+            leaf_item=torch.tensor(radix_leaf, dtype=torch.long),
+            prefix_ids=torch.tensor(list(prefix_ids), dtype=torch.long),
+            eos_token_id=int(eos_token_id),
+            key_stride=key_stride,
+            depth=depth,
+        )
+
+    def state_dict(self):
+        return {
+            "label_ptr": self.label_ptr,
+            "label_tokens": self.label_tokens,
+            "child_ptr": self.child_ptr,
+            "child_tokens": self.child_tokens,
+            "child_nodes": self.child_nodes,
+            "leaf_item": self.leaf_item,
+            "prefix_ids": self.prefix_ids,
+            "edge_keys": self.edge_keys,
+            "eos_token_id": self.eos_token_id,
+            "key_stride": self.key_stride,
+            "depth": self.depth,
+        }
+
+    def to(self, device):
+        if torch.device(device) == self.device:
+            return self
+        return TitleTrie(**{
+            k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in self.state_dict().items()
+        })
+
+    def root(self, n, device=None):
+        return torch.zeros(n, dtype=torch.long, device=device or self.device)
+
+    def match_prefix(self, input_ids):
+        """Root for rows whose prompt ends with the response header, INVALID_NODE otherwise."""
+        P = self.prefix_ids.numel()
+        if input_ids.size(1) < P:
+            return torch.full((input_ids.size(0),), INVALID_NODE, dtype=torch.long, device=input_ids.device)
+        ok = (input_ids[:, -P:] == self.prefix_ids).all(dim=1)
+        return torch.where(ok, 0, INVALID_NODE)
+
+    def _locate(self, pos):
+        # Node owning every label position, and whether the position ends its label
+        node = torch.searchsorted(self.label_ptr, pos, right=True) - 1
+        return node, pos + 1 == self.label_ptr[node + 1]
+
+    def step(self, states, tokens):
+        """Advance every state by `tokens`: along its label, or into the child starting with the token.
+
+        Rows without such a continuation become INVALID_NODE. Rows on a leaf that emit EOS
+        (padding after a finished sequence) stay on the leaf.
+        """
+        valid = (states >= 0) & (tokens >= 0) & (tokens < self.key_stride)
+        pos = states.clamp(min=0)
+        node, at_end = self._locate(pos)
+        inner = self.label_tokens[(pos + 1).clamp(max=self.label_tokens.numel() - 1)] == tokens
+        keys = node * self.key_stride + tokens.clamp(0, self.key_stride - 1)
+        edge = torch.searchsorted(self.edge_keys, keys).clamp(max=max(self.edge_keys.numel() - 1, 0))
+        found = self.edge_keys[edge] == keys if self.edge_keys.numel() else torch.zeros_like(valid)
+        nxt = torch.where(at_end, torch.where(found, self.label_ptr[self.child_nodes[edge]], INVALID_NODE),
+                          torch.where(inner, pos + 1, INVALID_NODE))
+        nxt = torch.where(valid, nxt, INVALID_NODE)
+        finished = (states >= 0) & at_end & (self.leaf_item[node] >= 0) & (tokens == self.eos_token_id)
+        return torch.where(finished, states, nxt)
+
+    def walk(self, states, token_matrix):
+        """Advance `states` over every column of `token_matrix` (rows, steps)."""
+        for i in range(token_matrix.size(1)):
+            states = self.step(states, token_matrix[:, i])
+        return states
+
+    def items(self, states):
+        """Item index of states sitting on a leaf, INVALID_NODE for the others."""
+        pos = states.clamp(min=0)
+        node, at_end = self._locate(pos)
+        return torch.where((states >= 0) & at_end, self.leaf_item[node], INVALID_NODE)
+
+    def completion_items(self, completions):
+        """Item index of every completion row, INVALID_NODE unless it spells a whole title then EOS padding."""
+        completions = completions.to(self.device)
+        width = min(completions.size(1), self.depth)
+        items = self.items(self.walk(self.root(completions.size(0)), completions[:, :width]))
+        padded = (completions[:, width:] == self.eos_token_id).all(dim=1)
+        return torch.where(padded, items, INVALID_NODE)
+
+    def decoding_mask(self, blocked=None):
+        if blocked is not None:
+            raise ValueError("Title tries do not support item exclusions")
+        return None
+
+    def allowed_tokens(self, states, local=False):
+        """Padded `(rows, max(max_degree, 1))` table of allowed tokens and its validity mask.
+
+        With `local`, tokens are positions in `vocab_ids` instead of vocabulary ids.
+        """
+        pos = states.clamp(min=0)
+        node, at_end = self._locate(pos)
+        start = self.child_ptr[node]
+        degree = torch.where(at_end, self.child_ptr[node + 1] - start, 1)
+        degree = torch.where(states >= 0, degree, 0)
+        offsets = torch.arange(max(self.max_degree, 1), device=states.device)
+        keep = offsets.unsqueeze(0) < degree.unsqueeze(1)
+        idx = (start.unsqueeze(1) + offsets.unsqueeze(0)).clamp(max=max(self.child_tokens.numel() - 1, 0))
+        child_tokens = self.local_child_tokens if local else self.child_tokens
+        label_tokens = self.local_label_tokens if local else self.label_tokens
+        inner = label_tokens[(pos + 1).clamp(max=label_tokens.numel() - 1)]
+        return torch.where(at_end.unsqueeze(1), child_tokens[idx], inner.unsqueeze(1)), keep
+
+    def allowed_mask(self, states, scores, local=False, blocked=None, group_size=1):
+        """Additive `(rows, vocab)` mask: 0 on allowed tokens, -inf elsewhere.
+
+        Rows with no continuation (finished or invalid) are only allowed EOS. With `local`,
+        `scores` has one column per entry of `vocab_ids`.
+        """
+        self.decoding_mask(blocked)
+        tokens, keep = self.allowed_tokens(states, local=local)
+        # Padded slots repeat the first allowed token (or EOS for empty rows) so one scatter covers all rows
+        fill = torch.where(keep[:, 0], tokens[:, 0], self.local_eos if local else self.eos_token_id)
+        tokens = torch.where(keep, tokens, fill.unsqueeze(1))
+        mask = torch.full_like(scores, float('-inf'))
+        mask.scatter_(1, tokens, 0.0)
+        return mask
+
+
+def tokenize_titles(info_file, tokenizer, base_model):
+    """Tokenize every item title of `info_file` the way the model emits it after the prompt.
+
+    Returns the per-item token lists (with EOS appended) and the number of leading header tokens.
+    """
+    with open(info_file, 'r') as f:
+        info = f.readlines()
+    # Parse new format: semantic_id \t item_title \t item_id
+    item_titles = [line.split('\t')[1].strip() + "\n" if len(line.split('\t')) >= 2 else "\n" for line in info]
+    info_titles = [f'''### Response:\n{_}''' for _ in item_titles]
+
+    if base_model.lower().find("llama") > -1:
+        prefixTitleID = [tokenizer(_).input_ids[1:] for _ in info_titles]
+    else:
+        prefixTitleID = [tokenizer(_).input_ids for _ in info_titles]
+    if base_model.lower().find("gpt2") > -1:
+        prefix_index = 4
+    else:
+        prefix_index = 3
+    for ID in prefixTitleID:
+        ID.append(tokenizer.eos_token_id)
+    return prefixTitleID, prefix_index
+
+
+def build_title_trie(info_file, tokenizer, base_model):
+    prefixTitleID, prefix_index = tokenize_titles(info_file, tokenizer, base_model)
+    return TitleTrie.from_sequences(
+        [ID[prefix_index:] for ID in prefixTitleID],
+        prefix_ids=prefixTitleID[0][:prefix_index],
+        eos_token_id=tokenizer.eos_token_id,
+    )
+
+
+def _tensor_bytes(trie):
+    # Everything a compiled trie holds, including the tensors derived at load time
+    return sum(t.numel() * t.element_size() for t in vars(trie).values() if isinstance(t, torch.Tensor))
+
+
+def _deep_sizeof(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k) + _deep_sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, set, tuple)):
+        size += sum(_deep_sizeof(v) for v in obj)
+    return size
+
+
+def _hash_dict(sequences, prefix_ids):
+    """The string-keyed dict of every token prefix the title constraint used to build."""
+    table = {}
+    for seq in sequences:
+        for i in range(len(seq)):
+            key = '-'.join(str(t) for t in (prefix_ids if i == 0 else seq[:i]))
+            table.setdefault(key, set()).add(seq[i])
+    return {key: list(tokens) for key, tokens in table.items()}
+
+
+def report(base_model: str = "", info_file: str = "", rows: int = 400, repeat: int = 20, seed: int = 0):
+    """Memory and per-step lookup cost of the radix trie against the token trie and the prefix hash dict.
+
+    `rows` decoding states (e.g. batch 8 x 50 beams) are sampled along random titles; a step
+    is the allowed-token mask plus the state update for all of them.
+    """
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(base_model)
+    prefixTitleID, prefix_index = tokenize_titles(info_file, tokenizer, base_model)
+    sequences = [ID[prefix_index:] for ID in prefixTitleID]
+    prefix_ids = prefixTitleID[0][:prefix_index]
+    radix = TitleTrie.from_sequences(sequences, prefix_ids, tokenizer.eos_token_id)
+    token_trie = SIDTrie.from_sequences(sequences, prefix_ids, tokenizer.eos_token_id)
+    table = _hash_dict(sequences, prefix_ids)
+
+    mb = 2 ** 20
+    print(f"{len(sequences)} titles, {sum(map(len, sequences))} tokens, longest {radix.depth}")
+    print(f"{'prefix hash dict':18s}: {len(table):9d} keys   {_deep_sizeof(table) / mb:8.2f} MB")
+    print(f"{'token trie':18s}: {token_trie.num_nodes:9d} nodes  {_tensor_bytes(token_trie) / mb:8.2f} MB")
+    print(f"{'radix trie':18s}: {radix.num_nodes:9d} nodes  {_tensor_bytes(radix) / mb:8.2f} MB")
+
+    # Decoding states `rows` steps into random titles, as the processor sees them mid-generation
+    g = torch.Generator().manual_seed(seed)
+    picks = torch.randint(len(sequences), (rows,), generator=g).tolist()
+    cut = [int(torch.randint(len(sequences[i]), (1,), generator=g)) for i in picks]
+    paths = [sequences[i][:c] for i, c in zip(picks, cut)]
+    width = max(cut)
+    tokens = torch.tensor([p + [tokenizer.eos_token_id] * (width - len(p)) for p in paths], dtype=torch.long)
+    lengths = torch.tensor(cut)
+    next_tokens = torch.tensor([sequences[i][c] for i, c in zip(picks, cut)], dtype=torch.long)
+    scores = torch.zeros(rows, len(tokenizer))
+
+    def states_of(trie):
+        states = trie.root(rows)
+        for i in range(width):
+            states = torch.where(lengths > i, trie.step(states, tokens[:, i]), states)
+        return states
+
+    for name, trie in (("token trie", token_trie), ("radix trie", radix)):
+        states = states_of(trie)
+        mask = trie.allowed_mask(states, scores)
+        assert bool((mask.gather(1, next_tokens.unsqueeze(1)) == 0).all())
+        start = time.perf_counter()
+        for _ in range(repeat):
+            trie.allowed_mask(states, scores)
+            trie.step(states, next_tokens)
+        print(f"{name:18s}: {(time.perf_counter() - start) / repeat * 1000:8.3f} ms/step for {rows} rows")
+
+    keys = [prefix_ids if c == 0 else p for p, c in zip(paths, cut)]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        mask = torch.full_like(scores, float('-inf'))
+        for row, key in enumerate(keys):
+            mask[row, table.get('-'.join(str(t) for t in key), [])] = 0
+    print(f"{'prefix hash dict':18s}: {(time.perf_counter() - start) / repeat * 1000:8.3f} ms/step for {rows} rows")
+
+
+if __name__ == '__main__':
+    fire.Fire(report)